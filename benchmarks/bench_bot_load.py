@@ -0,0 +1,314 @@
+"""Load-tests the Slack and Teams bots offline with a stand-in AsyncPinionAIClient.
+
+Drives chat_slack.handle_message_events and chat_teams.PinionAIBot.on_message_activity
+with simulated conversations. Every conversation is given a FakePinionAIClient
+whose turns sleep for a lognormally distributed latency and return replies of
+lognormally distributed size. Slack and Teams API calls are replaced with
+stubs that take --platform-latency-ms. Nothing leaves the machine.
+
+Reports throughput, end-to-end reply latency percentiles (from the handler call
+to the reply reaching the stubbed platform API), event loop lag, and memory.
+
+Usage:
+    python benchmarks/bench_bot_load.py [--frontend slack|teams|both] [--conversations 200]
+        [--messages 5] [--latency-ms 800] [--latency-sigma 0.5] [--response-chars 600]
+        [--think-ms 0] [--burst] [--json results.json]
+
+Bot settings (DISPATCH_MAX_WORKERS, DISPATCH_MAX_QUEUE_DEPTH, SLACK_PROGRESSIVE_UPDATES,
+TEAMS_ASYNC_PROCESSING, ...) are read from the environment as usual.
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import resource
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def lognormal(median: float, sigma: float) -> float:
+    return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def rss_mb() -> float:
+    """Current resident set size in MB (Linux), falling back to the peak."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class FakePinionAIClient:
+    """Stands in for AsyncPinionAIClient: no network, configurable turn latency and reply size."""
+
+    def __init__(self, latency_ms: float, latency_sigma: float, response_chars: int, session_write_ms: float):
+        self.session_id = uuid.uuid4().hex
+        self._agent_id = "load-test"
+        self._grpc_stub = None
+        self.var = {"agentTitle": "Load Test"}
+        self.chat_messages = []
+        self.transfer_requested = False
+        self.next_intent = None
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.response_chars = response_chars
+        self.session_write_ms = session_write_ms
+
+    def add_message_to_history(self, role: str, content: str):
+        self.chat_messages.append({"role": role, "content": content})
+
+    def get_chat_messages_for_display(self):
+        return list(self.chat_messages)
+
+    async def process_user_input(self, user_input: str, sender: str = "user") -> str:
+        await asyncio.sleep(lognormal(self.latency_ms, self.latency_sigma) / 1000)
+        size = max(1, int(lognormal(self.response_chars, self.latency_sigma)))
+        # The reply ends with the user's message id so the stubbed platform can match it up.
+        response = ("lorem ipsum dolor sit amet " * (size // 27 + 1))[:size] + f" [{user_input}]"
+        self.add_message_to_history("assistant", response)
+        return response
+
+    async def update_pinion_session(self):
+        await asyncio.sleep(self.session_write_ms / 1000)
+
+    async def end_grpc_chat_session(self, send_goodbye: bool = True):
+        pass
+
+    async def close(self):
+        pass
+
+class ReplyTracker:
+    """Matches replies seen by the platform stubs to the messages that caused them."""
+
+    def __init__(self):
+        self.queue_full_message = None
+        self._waiting: dict[str, tuple[float, asyncio.Future]] = {}
+        self.latencies: list[float] = []
+        self.rejected = 0
+        self.api_calls = 0
+
+    def expect(self, message_id: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[message_id] = (time.perf_counter(), future)
+        return future
+
+    def seen(self, message_id: str, text: str):
+        self.api_calls += 1
+        if message_id not in self._waiting:
+            return
+        if text == self.queue_full_message:
+            self.rejected += 1
+        elif not text.endswith(f"[{message_id}]"):
+            return  # Placeholder, progressive edit or status message.
+        else:
+            self.latencies.append(time.perf_counter() - self._waiting[message_id][0])
+        _, future = self._waiting.pop(message_id)
+        future.set_result(None)
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes a sleeping task."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags: list[float] = []
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - start - self.interval)
+
+def slack_driver(args, tracker: ReplyTracker):
+    """Returns (send(conversation, message_id, text), sessions, dispatcher) for chat_slack with stubbed Slack APIs."""
+    import chat_slack
+    logging.getLogger().setLevel(logging.WARNING)  # The bot configures INFO logging on import.
+    tracker.queue_full_message = chat_slack.QUEUE_FULL_MESSAGE
+
+    async def platform_call():
+        await asyncio.sleep(args.platform_latency_ms / 1000)
+
+    ts_to_message: dict[str, str] = {}
+
+    async def chat_update(channel, ts, text, **kwargs):
+        await platform_call()
+        tracker.seen(ts_to_message.get(ts, ""), text)
+
+    async def chat_delete(channel, ts, **kwargs):
+        await platform_call()
+
+    async def chat_postMessage(channel, text, **kwargs):
+        await platform_call()
+
+    chat_slack.app.client.chat_update = chat_update
+    chat_slack.app.client.chat_delete = chat_delete
+    chat_slack.app.client.chat_postMessage = chat_postMessage
+
+    async def send(conversation: str, message_id: str, text: str):
+        async def say(message):
+            await platform_call()
+            ts = uuid.uuid4().hex
+            ts_to_message[ts] = message_id
+            tracker.seen(message_id, message)
+            return {"channel": conversation, "ts": ts}
+
+        event = {"type": "message", "channel": conversation, "user": "U_LOAD", "text": text}
+        await chat_slack.handle_message_events(event, say)
+
+    return send, chat_slack.sessions, chat_slack.dispatcher
+
+def teams_driver(args, tracker: ReplyTracker):
+    """Returns (send(conversation, message_id, text), sessions, dispatcher) for chat_teams with stubbed Bot Framework calls."""
+    import chat_teams
+    from botbuilder.schema import Activity, ActivityTypes, ChannelAccount, ConversationAccount
+    logging.getLogger().setLevel(logging.WARNING)  # The bot configures INFO logging on import.
+    tracker.queue_full_message = chat_teams.QUEUE_FULL_MESSAGE
+
+    async def platform_call():
+        await asyncio.sleep(args.platform_latency_ms / 1000)
+
+    async def send_proactive(reference, message):
+        await platform_call()
+        tracker.seen(reference.activity_id, message)
+
+    chat_teams.send_proactive = send_proactive
+
+    class FakeTurnContext:
+        def __init__(self, activity):
+            self.activity = activity
+
+        async def send_activity(self, message):
+            await platform_call()
+            if isinstance(message, str):
+                tracker.seen(self.activity.id, message)
+
+    async def send(conversation: str, message_id: str, text: str):
+        activity = Activity(
+            type=ActivityTypes.message,
+            id=message_id,
+            text=text,
+            channel_id="msteams",
+            service_url="https://smba.invalid/",
+            conversation=ConversationAccount(id=conversation),
+            from_property=ChannelAccount(id="user-load"),
+            recipient=ChannelAccount(id="bot-load"),
+        )
+        await chat_teams.BOT.on_message_activity(FakeTurnContext(activity))
+
+    return send, chat_teams.sessions, chat_teams.dispatcher
+
+async def run_load(frontend: str, args) -> dict:
+    tracker = ReplyTracker()
+    send, sessions, dispatcher = (slack_driver if frontend == "slack" else teams_driver)(args, tracker)
+
+    conversations = [f"{frontend}-conv-{i}" for i in range(args.conversations)]
+    for conversation in conversations:
+        sessions[conversation] = FakePinionAIClient(args.latency_ms, args.latency_sigma, args.response_chars, args.session_write_ms)
+
+    async def converse(conversation: str):
+        message_ids = [f"{conversation}-msg-{n}" for n in range(args.messages)]
+        if args.burst:
+            waits = [tracker.expect(message_id) for message_id in message_ids]
+            for message_id in message_ids:
+                await send(conversation, message_id, message_id)
+            await asyncio.wait_for(asyncio.gather(*waits), args.timeout)
+            return
+        for message_id in message_ids:
+            wait = tracker.expect(message_id)
+            await send(conversation, message_id, message_id)
+            await asyncio.wait_for(wait, args.timeout)
+            if args.think_ms:
+                await asyncio.sleep(lognormal(args.think_ms, 0.5) / 1000)
+
+    monitor = LoopLagMonitor()
+    monitor_task = asyncio.create_task(monitor.run())
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(converse(conversation) for conversation in conversations), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    monitor_task.cancel()
+    # Let background session writes settle before measuring memory.
+    await asyncio.sleep(max(0.5, args.session_write_ms / 1000 * 2))
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    for error in errors[:3]:
+        logging.error(f"{frontend} conversation failed: {error!r}")
+    return {
+        "frontend": frontend,
+        "conversations": args.conversations,
+        "messages": args.conversations * args.messages,
+        "completed": len(tracker.latencies),
+        "rejected": tracker.rejected,
+        "failed_conversations": len(errors),
+        "elapsed_s": elapsed,
+        "throughput_msg_s": len(tracker.latencies) / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(tracker.latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(tracker.latencies, 0.95) * 1000,
+        "latency_p99_ms": percentile(tracker.latencies, 0.99) * 1000,
+        "latency_max_ms": max(tracker.latencies, default=0.0) * 1000,
+        "loop_lag_p50_ms": percentile(monitor.lags, 0.50) * 1000,
+        "loop_lag_p99_ms": percentile(monitor.lags, 0.99) * 1000,
+        "loop_lag_max_ms": max(monitor.lags, default=0.0) * 1000,
+        "platform_api_calls": tracker.api_calls,
+        "rss_before_mb": rss_before,
+        "rss_after_mb": rss_mb(),
+        "session_bytes_estimate": sessions.stats()["bytes"],
+        "dispatcher": dispatcher.stats(),
+    }
+
+def print_report(result: dict):
+    print(f"\n== {result['frontend']}: {result['conversations']} conversations, {result['messages']} messages ==")
+    print(f"completed {result['completed']}  rejected {result['rejected']}  failed conversations {result['failed_conversations']}")
+    print(f"elapsed {result['elapsed_s']:.2f} s  throughput {result['throughput_msg_s']:.1f} msg/s  platform API calls {result['platform_api_calls']}")
+    print(f"reply latency ms   p50 {result['latency_p50_ms']:8.1f}  p95 {result['latency_p95_ms']:8.1f}  "
+          f"p99 {result['latency_p99_ms']:8.1f}  max {result['latency_max_ms']:8.1f}")
+    print(f"event loop lag ms  p50 {result['loop_lag_p50_ms']:8.2f}  p99 {result['loop_lag_p99_ms']:8.2f}  max {result['loop_lag_max_ms']:8.2f}")
+    print(f"RSS MB {result['rss_before_mb']:.1f} -> {result['rss_after_mb']:.1f}  "
+          f"session estimate {result['session_bytes_estimate'] / 1024 / 1024:.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the Slack and Teams bots.")
+    parser.add_argument("--frontend", choices=["slack", "teams", "both"], default="both")
+    parser.add_argument("--conversations", type=int, default=200, help="Simulated channels/conversations.")
+    parser.add_argument("--messages", type=int, default=5, help="Messages sent per conversation.")
+    parser.add_argument("--latency-ms", type=float, default=800, help="Median agent turn latency.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Lognormal spread of turn latency and reply size.")
+    parser.add_argument("--response-chars", type=int, default=600, help="Median reply size.")
+    parser.add_argument("--session-write-ms", type=float, default=50, help="Latency of update_pinion_session.")
+    parser.add_argument("--platform-latency-ms", type=float, default=50, help="Latency of each Slack/Teams API call.")
+    parser.add_argument("--think-ms", type=float, default=0, help="Median pause between a reply and the next message.")
+    parser.add_argument("--burst", action="store_true", help="Send each conversation's messages at once instead of one per reply.")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for any one reply.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sys.path.insert(0, REPO_ROOT)
+    # Keep sessions in process (restoring from a store would rebuild real clients), and don't
+    # let the bots load agents from the environment. Empty values also win over a .env file.
+    for name in ("SESSION_STORE_URL", "SESSION_SNAPSHOT_DIR", "agent_id", "client_id", "client_secret"):
+        os.environ[name] = ""
+    os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-load-test")
+    os.environ.setdefault("SLACK_APP_TOKEN", "xapp-load-test")
+
+    frontends = ["slack", "teams"] if args.frontend == "both" else [args.frontend]
+    results = []
+    for frontend in frontends:
+        results.append(asyncio.run(run_load(frontend, args)))
+        print_report(results[-1])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Measures Streamlit rerun time of the chat history display vs. conversation length.
+
+Runs pinionai_display.display_chat_messages headlessly with Streamlit's AppTest,
+once rendering the full history (window=0) and once with the default window,
+and prints the median rerun time for each history length.
+
+Usage:
+    python benchmarks/bench_chat_render.py [--lengths 10 100 500 1000] [--runs 5]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+from streamlit.testing.v1 import AppTest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def render_app():
+    import sys
+    import streamlit as st
+    sys.path.insert(0, st.session_state.repo_root)
+    from pinionai_display import display_chat_messages
+
+    messages = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i}: " + "lorem ipsum **dolor** sit amet " * 8}
+        for i in range(st.session_state.history_length)
+    ]
+    display_chat_messages(messages, None, None, window=st.session_state.window)
+
+def time_reruns(history_length: int, window: int, runs: int) -> float:
+    """Returns the median wall time in milliseconds of a rerun at the given history length."""
+    at = AppTest.from_function(render_app, default_timeout=120)
+    at.session_state.repo_root = REPO_ROOT
+    at.session_state.history_length = history_length
+    at.session_state.window = window
+    at.run()  # Warm up imports and caches.
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        at.run()
+        timings.append((time.perf_counter() - start) * 1000)
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return statistics.median(timings)
+
+def main():
+    sys.path.insert(0, REPO_ROOT)
+    from pinionai_display import CHAT_HISTORY_WINDOW
+
+    parser = argparse.ArgumentParser(description="Benchmark chat history rerun time.")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 100, 500, 1000])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--window", type=int, default=CHAT_HISTORY_WINDOW)
+    args = parser.parse_args()
+
+    print(f"{'messages':>10} {'full (ms)':>12} {'window=' + str(args.window) + ' (ms)':>18}")
+    for length in args.lengths:
+        full_ms = time_reruns(length, 0, args.runs)
+        windowed_ms = time_reruns(length, args.window, args.runs)
+        print(f"{length:>10} {full_ms:>12.1f} {windowed_ms:>18.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -2,59 +2,83 @@ import streamlit as st
 import os
 import time
 import asyncio
-from io import StringIO
 from pinionai import AsyncPinionAIClient
 from pinionai.exceptions import PinionAIConfigurationError, PinionAIError
-import threading
+from pinionai_agents import acquire_client, get_agent_file_cache, read_aia_file
+from pinionai_cache import get_audio_cache, get_tool_cache
+from pinionai_display import display_chat_messages
+from pinionai_live import attach_update_notifier, wait_for_updates
+from pinionai_metrics import get_metrics, start_metrics_server
+from pinionai_runtime import get_loop_pool
+from pinionai_sessions import get_session_persister
 from dotenv import load_dotenv
 load_dotenv()
 
+# Turn-stage latency metrics, served from a sidecar thread on METRICS_PORT when set.
+get_metrics().frontend = "streamlit"
+get_metrics().register_stats("aia_cache", get_agent_file_cache().stats)
+get_metrics().register_stats("tts_cache", get_audio_cache().stats)
+get_metrics().register_stats("tool_cache", get_tool_cache().stats)
+get_metrics().register_stats("session_writes", get_session_persister().stats)
+get_metrics().register_stats("event_loops", get_loop_pool().stats)
+start_metrics_server()
+
 def run_coroutine_in_event_loop(coroutine):
     """Runs a coroutine in the app's persistent event loop."""
     loop = get_event_loop()
     return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
 
 def get_event_loop():
-    """Gets or creates the app's persistent event loop."""
-    if "event_loop" not in st.session_state:
-        st.session_state.event_loop = asyncio.new_event_loop()
-        threading.Thread(target=st.session_state.event_loop.run_forever, daemon=True).start()
-    return st.session_state.event_loop
+    """Gets the shared event loop assigned to this browser session."""
+    return get_loop_lease().loop
 
-def display_chat_messages(messages,user_img,assistant_img):
-    """Displays chat messages in the Streamlit app."""
-    chat_container = st.container()
-    with chat_container:
-        for message in messages:
-            avatar = user_img if message["role"] == "user" else assistant_img
-            with st.chat_message(message["role"], avatar=avatar):
-                st.markdown(message["content"])
+def get_loop_lease():
+    """
+    Gets or assigns this session's lease on the process-wide loop pool. When the
+    session ends and its state is dropped, the lease is released and any clients
+    tracked on it are closed.
+    """
+    if "loop_lease" not in st.session_state:
+        st.session_state.loop_lease = get_loop_pool().lease()
+    return st.session_state.loop_lease
 
-def poll_for_updates(client: AsyncPinionAIClient, timeout: int, http_poll_start: int = 30, http_poll_interval: int = 5):
-    """Polls for updates and returns True if a rerun is needed."""
-    start_time = time.time()
-    next_http_poll_time = start_time + http_poll_start
+def persist_session(client: AsyncPinionAIClient):
+    """Schedules a background, coalesced session update on the session's event loop."""
+    get_event_loop().call_soon_threadsafe(get_session_persister().schedule, client)
 
-    while time.time() - start_time < timeout:
-        # Primary check: Has a gRPC message arrived recently?
-        if (time.time() - client._grpc_last_update_time) < 2.0:
-            return True
-        # Fallback check: Poll HTTP endpoint no response in a while.
-        now = time.time()
-        if now >= next_http_poll_time:
-            try:
-                lastmodified_server, _ = run_coroutine_in_event_loop(client.get_latest_session_modification_time())
-                if lastmodified_server and lastmodified_server != client.last_session_post_modified:
-                    return True
-                # Schedule the next poll
-                next_http_poll_time = now + http_poll_interval
-            except Exception as e:
-                # Using print instead of st.warning to avoid cluttering the UI
-                st.warning(f"Warning: Could not check for session updates: {e}")
-                # Don't hammer on failure, schedule next poll
-                next_http_poll_time = now + http_poll_interval
-        time.sleep(0.1) # Prevent busy-waiting
-    return False # Timeout
+def render_assistant_response(client: AsyncPinionAIClient, user_input: str) -> str:
+    """Runs one AI turn behind a spinner, renders the response and returns it."""
+    with st.spinner("Thinking..."):
+        response = run_coroutine_in_event_loop(client.process_user_input(user_input, sender="user"))
+        st.markdown(response)
+    return response
+
+def play_response_audio(client: AsyncPinionAIClient, text: str):
+    """Synthesizes text with the agent's TTS settings and autoplays it."""
+    with st.spinner("Generating audio..."):
+        try:
+            audio_bytes = run_coroutine_in_event_loop(get_audio_cache().synthesize(client, text))
+            if audio_bytes:
+                # Auto-detect format from magic bytes (RIFF = WAV, OggS = OGG, default to MP3)
+                audio_format = "audio/mp3"
+                if audio_bytes.startswith(b"RIFF"):
+                    audio_format = "audio/wav"
+                elif audio_bytes.startswith(b"OggS"):
+                    audio_format = "audio/ogg"
+                st.audio(audio_bytes, format=audio_format, autoplay=True)
+        except Exception as e:
+            st.error(f"Failed to generate TTS audio: {e}")
+
+def poll_for_updates(client: AsyncPinionAIClient, timeout: int, http_poll_start: int = 30, http_poll_interval: int = 5):
+    """Waits for a live-agent update and returns True if a rerun is needed."""
+    return wait_for_updates(
+        client,
+        timeout,
+        run_coroutine=run_coroutine_in_event_loop,
+        http_poll_start=http_poll_start,
+        http_poll_interval=http_poll_interval,
+        on_poll_error=lambda e: st.warning(f"Warning: Could not check for session updates: {e}"),
+    )
 
 def ensure_grpc_is_active(client: AsyncPinionAIClient):
     """
@@ -62,6 +86,8 @@ def ensure_grpc_is_active(client: AsyncPinionAIClient):
     and starts it if not. Makes the app fork-safe.
     """
     if not client._grpc_stub:
+        # Hook message arrival before the listener starts so no early reply is missed.
+        attach_update_notifier(client)
         try:
             is_started = run_coroutine_in_event_loop(client.start_grpc_client_listener(sender_id="user"))
             if is_started:
@@ -91,8 +117,8 @@ if 'awaiting_key_secret' not in st.session_state:
     st.session_state.awaiting_key_secret = False
 if 'merging_aia' not in st.session_state:
     st.session_state.merging_aia = False
-if 'uploaded_file_bytes' not in st.session_state:
-    st.session_state.uploaded_file_bytes = None
+if 'uploaded_aia_text' not in st.session_state:
+    st.session_state.uploaded_aia_text = None
 
 if not os.environ.get("agent_id"):
     if st.session_state.awaiting_key_secret or st.session_state.get("merging_aia"):
@@ -109,15 +135,14 @@ if not os.environ.get("agent_id"):
                         if st.session_state.get("merging_aia"):
                             with st.spinner("Decrypting and merging agent..."):
                                 try:
-                                    file_bytes = st.session_state.uploaded_file_bytes
-                                    stringio = StringIO(file_bytes.decode("utf-8"))
-                                    result_msg = run_coroutine_in_event_loop(st.session_state.pinion_client.add_agent_from_aia(
-                                        file_stream=stringio.read(),
+                                    result_msg = run_coroutine_in_event_loop(get_agent_file_cache().add_agent(
+                                        st.session_state.pinion_client,
+                                        file_stream=st.session_state.uploaded_aia_text,
                                         key_secret=key_secret
                                     ))
                                     if "Error" not in result_msg:
                                         st.session_state.merging_aia = False
-                                        st.session_state.uploaded_file_bytes = None
+                                        st.session_state.uploaded_aia_text = None
                                         st.success(result_msg)
                                         time.sleep(1)
                                         st.rerun()
@@ -127,23 +152,21 @@ if not os.environ.get("agent_id"):
                                     st.error(f"Merge failed: {e}")
                         else:
                             # Clear main session state before loading new agent
-                            keys_to_keep = ["logged_in", "user_login", "user_email", "accountSelectedUId", "accountPermissions", "awaiting_key_secret", "uploaded_file_bytes"]
+                            keys_to_keep = ["logged_in", "user_login", "user_email", "accountSelectedUId", "accountPermissions", "awaiting_key_secret", "uploaded_aia_text"]
                             keys_to_delete = [key for key in st.session_state.keys() if key not in keys_to_keep]
                             for key in keys_to_delete:
                                 del st.session_state[key]
                             with st.spinner("Decrypting and loading agent..."):
                                 try:
-                                    file_bytes = st.session_state.uploaded_file_bytes
-                                    stringio = StringIO(file_bytes.decode("utf-8"))
-                                    client, init_message = run_coroutine_in_event_loop(AsyncPinionAIClient.create_from_stream(
-                                        file_stream=stringio.read(),
+                                    client, init_message = run_coroutine_in_event_loop(get_agent_file_cache().create_client(
+                                        file_stream=st.session_state.uploaded_aia_text,
                                         host_url=os.environ.get("host_url"),
                                         key_secret=key_secret
                                     ))
                                     if client:
                                         st.session_state.pinion_client = client
                                         st.session_state.awaiting_key_secret = False # Clean up temp state on success
-                                        st.session_state.uploaded_file_bytes = None
+                                        st.session_state.uploaded_aia_text = None
                                         st.success("Agent loaded successfully!")
                                         st.rerun()
                                     else:
@@ -157,7 +180,7 @@ if not os.environ.get("agent_id"):
                     # Clean up temp state and go back
                     st.session_state.awaiting_key_secret = False
                     st.session_state.merging_aia = False
-                    st.session_state.uploaded_file_bytes = None
+                    st.session_state.uploaded_aia_text = None
                     st.rerun()
         st.stop()
     else:
@@ -176,15 +199,14 @@ if not os.environ.get("agent_id"):
                         for key in keys_to_delete:
                             del st.session_state[key]
                         try:
-                            file_bytes = uploaded_file.getvalue()
-                            stringio = StringIO(file_bytes.decode("utf-8"))
-                            client, init_message = run_coroutine_in_event_loop(AsyncPinionAIClient.create_from_stream(
-                                file_stream=stringio.read(),
+                            aia_text = read_aia_file(uploaded_file)
+                            client, init_message = run_coroutine_in_event_loop(get_agent_file_cache().create_client(
+                                file_stream=aia_text,
                                 host_url=os.environ.get("host_url")
                                 ))
                             if init_message == 'key_secret required for private version':
                                 st.session_state.awaiting_key_secret = True
-                                st.session_state.uploaded_file_bytes = file_bytes
+                                st.session_state.uploaded_aia_text = aia_text
                                 st.rerun()
                             elif client:
                                 st.session_state.pinion_client = client
@@ -206,17 +228,17 @@ if not os.environ.get("agent_id"):
                         st.error("No active session to merge into.")
                     else:
                         try:
-                            file_bytes = uploaded_file.getvalue()
-                            stringio = StringIO(file_bytes.decode("utf-8"))
+                            aia_text = read_aia_file(uploaded_file)
                             
-                            result_msg = run_coroutine_in_event_loop(st.session_state.pinion_client.add_agent_from_aia(
-                                file_stream=stringio.read()
+                            result_msg = run_coroutine_in_event_loop(get_agent_file_cache().add_agent(
+                                st.session_state.pinion_client,
+                                file_stream=aia_text
                             ))
 
                             if result_msg == 'key_secret required for private version':
-                                # Set flag and store file bytes to show key form
+                                # Set flag and store the file's credential line to show key form
                                 st.session_state.merging_aia = True
-                                st.session_state.uploaded_file_bytes = file_bytes
+                                st.session_state.uploaded_aia_text = aia_text
                                 st.rerun()
                             elif "Error" not in result_msg:
                                 st.success(result_msg)
@@ -229,13 +251,14 @@ if not os.environ.get("agent_id"):
 else:                    
     if "pinion_client" not in st.session_state:
             try:
-                st.session_state.pinion_client = run_coroutine_in_event_loop(AsyncPinionAIClient.create(
+                # Sessions on the same event loop share a pool of prewarmed clients.
+                st.session_state.pinion_client = run_coroutine_in_event_loop(acquire_client(dict(
                     agent_id=os.environ.get("agent_id"),
                     host_url=os.environ.get("host_url"),
                     client_id=os.environ.get("client_id"),
                     client_secret=os.environ.get("client_secret"),
                     version=os.environ.get("version", None) # Change to serve specific version (draft, development, test, live, archived). None loads latest in progress.
-                ))
+                )))
                 if not st.session_state.pinion_client.chat_messages and st.session_state.pinion_client.var.get("agentStart"):
                     st.session_state.pinion_client.add_message_to_history(
                         "assistant", st.session_state.pinion_client.var["agentStart"]
@@ -246,6 +269,7 @@ else:
 
 if st.session_state.pinion_client:
     client: AsyncPinionAIClient = st.session_state.pinion_client
+    get_loop_lease().track(client)
     var = client.var # Convenience to the client's var dictionary
 else:
     st.stop()
@@ -281,6 +305,7 @@ if var["transferAllowed"]:
         with col2:
             if st.form_submit_button("End Chat"):
                 st.session_state.end_chat_clicked = "yes"
+                run_coroutine_in_event_loop(get_session_persister().flush(client))
                 run_coroutine_in_event_loop(client.end_grpc_chat_session()) 
                 st.rerun()
             
@@ -321,50 +346,22 @@ if input_text is not None:
                 st.warning("No new messages in the last 3 minutes. Please click Continue or End Chat.")
     else: # AI AGENT MODE
         with st.chat_message("assistant", avatar=assistant_img):
-            with st.spinner("Thinking..."):
-                full_ai_response_string = run_coroutine_in_event_loop(client.process_user_input(input_text, sender="user"))
-                st.markdown(full_ai_response_string)
+            full_ai_response_string = render_assistant_response(client, input_text)
             # The client's process_user_input method already adds the assistant's response to its chat_messages
-            run_coroutine_in_event_loop(client.update_pinion_session())
+            persist_session(client)
             
             if var.get("ttsAudio"):
-                with st.spinner("Generating audio..."):
-                    try:
-                        audio_bytes = run_coroutine_in_event_loop(client.convert_text_to_audio(full_ai_response_string))
-                        if audio_bytes:
-                            # Auto-detect format from magic bytes (RIFF = WAV, OggS = OGG, default to MP3)
-                            audio_format = "audio/mp3"
-                            if audio_bytes.startswith(b"RIFF"):
-                                audio_format = "audio/wav"
-                            elif audio_bytes.startswith(b"OggS"):
-                                audio_format = "audio/ogg"
-                            st.audio(audio_bytes, format=audio_format, autoplay=True)
-                    except Exception as e:
-                        st.error(f"Failed to generate TTS audio: {e}")
+                play_response_audio(client, full_ai_response_string)
             
             # Handle if a next_intent was set by the AI's processing. Next_intent turn handled internally
             if client.next_intent:
                 with st.chat_message("assistant", avatar=assistant_img):
-                    with st.spinner("Thinking..."):
-                        # Process the next_intent (user_input might be empty or the next_intent itself)
-                        full_next_intent_response_string = run_coroutine_in_event_loop(client.process_user_input(user_input="", sender="user"))
-                        st.markdown(full_next_intent_response_string)
-                    run_coroutine_in_event_loop(client.update_pinion_session())
+                    # Process the next_intent (user_input might be empty or the next_intent itself)
+                    full_next_intent_response_string = render_assistant_response(client, "")
+                    persist_session(client)
 
                     if var.get("ttsAudio"):
-                        with st.spinner("Generating audio..."):
-                            try:
-                                audio_bytes = run_coroutine_in_event_loop(client.convert_text_to_audio(full_next_intent_response_string))
-                                if audio_bytes:
-                                    # Auto-detect format from magic bytes (RIFF = WAV, OggS = OGG, default to MP3)
-                                    audio_format = "audio/mp3"
-                                    if audio_bytes.startswith(b"RIFF"):
-                                        audio_format = "audio/wav"
-                                    elif audio_bytes.startswith(b"OggS"):
-                                        audio_format = "audio/ogg"
-                                    st.audio(audio_bytes, format=audio_format, autoplay=True)
-                            except Exception as e:
-                                st.error(f"Failed to generate TTS audio: {e}")
+                        play_response_audio(client, full_next_intent_response_string)
                                       
         if client.transfer_requested:
             # Start gRPC client listener if agent transfer is requested
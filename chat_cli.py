@@ -2,157 +2,524 @@
 
 Usage:
     python chat_cli.py
+    python chat_cli.py --batch conversations.jsonl [--output results.jsonl] [--concurrency 8]
+    python chat_cli.py --replay results.jsonl --version test [--warmup 1] [--repeat 3]
 
 Controls:
     /end    - end chat session and exit
-    /continue - continue polling or force refresh
+    /continue - check the server for missed updates and show the conversation
 
-This client uses AsyncPinionAIClient and interacts via stdin/stdout.
+This client uses AsyncPinionAIClient and interacts via stdin/stdout. Reading
+stdin, agent turns and live-agent messages all run on one asyncio event loop,
+so messages from a live agent are printed the moment they arrive.
+
+Batch mode reads one conversation per line of a JSONL file, e.g.
+    {"id": "refund-1", "turns": ["Hi", "I want a refund"], "version": "test"}
+    {"id": "aia-1", "turns": ["Hello"], "aia_file": "agents/support.aia"}
+runs them concurrently on one event loop, and writes a "turn" record per
+agent response and a "conversation" record per conversation to the output.
+
+Replay mode re-runs a recording (batch output) against --version and reports
+per-turn latency, size and token deltas, and responses that changed.
 """
 import argparse
 import os
+import sys
+import json
 import time
 import asyncio
-import threading
+import difflib
 import getpass
+import statistics
 from pinionai import AsyncPinionAIClient
 from pinionai.exceptions import PinionAIConfigurationError, PinionAIError
+from pinionai_agents import acquire_client, agent_config_from_env, close_client_pools, get_agent_file_cache, read_aia_file
+from pinionai_http import close_http_clients
+from pinionai_live import LiveAgentBridge, attach_update_notifier
+from pinionai_metrics import get_metrics, instrument_client, start_metrics_server
+from pinionai_runtime import close_client
+from pinionai_sessions import SessionStore, get_session_persister
+from pinionai_store import shared_conversations_from_env
 from dotenv import load_dotenv
 load_dotenv()
 
-# Persistent event loop management 
-_event_loop = None
-_event_loop_lock = threading.Lock()
-
-def get_event_loop():
-    global _event_loop
-    with _event_loop_lock:
-        if _event_loop is None:
-            _event_loop = asyncio.new_event_loop()
-            threading.Thread(target=_event_loop.run_forever, daemon=True).start()
-    return _event_loop
-
-def run_coroutine_in_event_loop(coroutine):
-    loop = get_event_loop()
-    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
-
-def poll_for_updates(client: AsyncPinionAIClient, timeout: int, http_poll_start: int = 30, http_poll_interval: int = 5):
-    """Polls for updates and returns True if a rerun is needed."""
-    start_time = time.time()
-    next_http_poll_time = start_time + http_poll_start
-
-    while time.time() - start_time < timeout:
-        # Primary check: Has a gRPC message arrived recently?
-        if (time.time() - client._grpc_last_update_time) < 2.0:
-            return True
-        # Fallback check: Poll HTTP endpoint
-        now = time.time()
-        if now >= next_http_poll_time:
-            try:
-                lastmodified_server, _ = run_coroutine_in_event_loop(client.get_latest_session_modification_time())
-                if lastmodified_server and lastmodified_server != client.last_session_post_modified:
-                    return True
-                next_http_poll_time = now + http_poll_interval
-            except Exception as e:
-                print(f"Warning: Could not check for session updates: {e}")
-                next_http_poll_time = now + http_poll_interval
-        time.sleep(0.1)
-    return False
+LIVE_SESSION_KEY = "cli"
+
+class AsyncConsole:
+    """
+    Line-based terminal I/O on the running event loop.
+
+    stdin is watched with loop.add_reader, so waiting for the user's next line
+    never blocks agent output. Where stdin cannot be watched (a redirected
+    regular file, or an event loop without add_reader), each line is read on a
+    worker thread instead.
+    """
+
+    def __init__(self):
+        self._fd = sys.stdin.fileno()
+        self._reader = asyncio.StreamReader()
+        self._watching = False
+        self._threaded = False
+        self._eof = False
+        self._prompt = None
+        self._tty = sys.stdout.isatty()
 
-def ensure_grpc_is_active(client: AsyncPinionAIClient):
-    if not client._grpc_stub:
+    def start(self):
         try:
-            is_started = run_coroutine_in_event_loop(client.start_grpc_client_listener(sender_id="user"))
-            if is_started:
-                print("Connecting to live agent...")
-                return True
+            asyncio.get_running_loop().add_reader(self._fd, self._on_readable)
+            self._watching = True
+        except (OSError, ValueError, NotImplementedError):
+            self._threaded = True
+
+    def _on_readable(self):
+        data = os.read(self._fd, 65536)
+        if data:
+            self._reader.feed_data(data)
+        else:
+            self._eof = True
+            self._reader.feed_eof()
+            self.pause()
+
+    def pause(self):
+        if self._watching:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._watching = False
+
+    def resume(self):
+        if not self._threaded and not self._eof and not self._watching:
+            asyncio.get_running_loop().add_reader(self._fd, self._on_readable)
+            self._watching = True
+
+    async def input(self, prompt: str = "") -> str:
+        """Prompts for and returns one line, without its newline. Raises EOFError at end of input."""
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        self._prompt = prompt
+        try:
+            if self._threaded:
+                line = await asyncio.to_thread(sys.stdin.readline)
             else:
-                print("Could not connect to live agent service.")
-                return False
-        except Exception as e:
-            print(f"Failed to start gRPC listener: {e}")
-            return False
-    return True
+                line = (await self._reader.readline()).decode("utf-8", errors="replace")
+        finally:
+            self._prompt = None
+        if not line:
+            raise EOFError
+        return line.rstrip("\r\n")
+
+    async def getpass(self, prompt: str) -> str:
+        """Reads a secret without echo. getpass uses the terminal directly, so stdin watching is paused meanwhile."""
+        self.pause()
+        try:
+            return await asyncio.to_thread(getpass.getpass, prompt)
+        finally:
+            self.resume()
 
-def display_messages(messages, user_img=None, assistant_img=None):
+    def print(self, text: str = ""):
+        """Prints text, redrawing the prompt below it if a prompt is waiting for input."""
+        if self._prompt is None:
+            print(text, flush=True)
+        elif self._tty:
+            sys.stdout.write(f"\r\x1b[K{text}\n{self._prompt}")
+            sys.stdout.flush()
+        else:
+            sys.stdout.write(f"\n{text}\n{self._prompt}")
+            sys.stdout.flush()
+
+def display_messages(messages, user_img=None, assistant_img=None, out=print):
     for message in messages:
         role = message.get("role")
         content = message.get("content")
         prefix = "User: " if role == "user" else "Agent: "
-        print(f"{prefix}{content}")
+        out(f"{prefix}{content}")
+
+def read_batch_file(path: str):
+    """Yields (line_number, conversation dict or error message) for each non-blank line of a JSONL file."""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                conversation = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(conversation, dict) or not isinstance(conversation.get("turns"), list):
+                yield line_number, "Expected an object with a 'turns' list"
+                continue
+            yield line_number, conversation
+
+async def open_batch_client(conversation: dict, default_version: str | None, aia_file: str | None, key_secret: str | None = None) -> AsyncPinionAIClient:
+    """
+    Creates the client for one batch conversation from its aia_file, or from the environment's agent config.
+    A private aia_file is opened with the conversation's key_secret, else the given default.
+    """
+    aia_file = conversation.get("aia_file") or aia_file
+    if aia_file:
+        def read():
+            with open(aia_file, "rb") as f:
+                return read_aia_file(f)
+        client, init_message = await get_agent_file_cache().create_client(
+            file_stream=await asyncio.to_thread(read),
+            host_url=os.environ.get("host_url"),
+            key_secret=conversation.get("key_secret") or key_secret,
+        )
+        if client is None:
+            raise PinionAIError(init_message)
+        return client
+    config = agent_config_from_env()
+    if config is None:
+        raise PinionAIConfigurationError("Set client_id, client_secret, agent_id and host_url, or give the conversation an aia_file.")
+    if conversation.get("version") or default_version:
+        config["version"] = conversation.get("version") or default_version
+    return await acquire_client(config)
 
-def cleanup_client(client: AsyncPinionAIClient):
-    """Clean up client resources, particularly the HTTP session."""
+def model_usage_totals(client: AsyncPinionAIClient) -> tuple[int, int]:
+    """Input and output tokens used so far, summed over the models in the client's model_usage variable."""
+    usage = (client.var or {}).get("model_usage") or {}
+    models = [model for model in usage.values() if isinstance(model, dict)]
+    return sum(model.get("input_tokens", 0) for model in models), sum(model.get("output_tokens", 0) for model in models)
+
+async def run_batch_conversation(conversation_id: str, conversation: dict, args, write):
+    """Runs one conversation's turns in order, writing a record per turn and one for the conversation."""
+    record = {
+        "type": "conversation",
+        "conversation_id": conversation_id,
+        "version": conversation.get("version") or args.version,
+        "aia_file": conversation.get("aia_file") or args.aia_file,
+        "turns": 0,
+        "errors": 0,
+        "setup_seconds": None,
+        "seconds": None,
+        "error": None,
+    }
+    start = time.perf_counter()
     try:
-        if hasattr(client, '_http_session') and client._http_session:
-            run_coroutine_in_event_loop(client._http_session.aclose())
+        client = await open_batch_client(conversation, args.version, args.aia_file, args.key_secret)
     except Exception as e:
-        print(f"Warning: Error closing HTTP session: {e}")
+        record["error"] = f"{type(e).__name__}: {e}"
+        write(record)
+        return record
+    record["setup_seconds"] = time.perf_counter() - start
+    try:
+        for index, prompt in enumerate(conversation["turns"]):
+            turn = {"type": "turn", "conversation_id": conversation_id, "turn": index, "input": prompt,
+                    "response": None, "follow_up": None, "seconds": None, "transfer_requested": False,
+                    "input_tokens": 0, "output_tokens": 0, "error": None}
+            tokens_before = model_usage_totals(client)
+            turn_start = time.perf_counter()
+            try:
+                client.add_message_to_history("user", prompt)
+                turn["response"] = await client.process_user_input(prompt, sender="user")
+                if client.next_intent:
+                    turn["follow_up"] = await client.process_user_input(prompt, sender="user")
+                get_session_persister().schedule(client)
+                turn["transfer_requested"] = bool(client.transfer_requested)
+            except Exception as e:
+                turn["error"] = f"{type(e).__name__}: {e}"
+                record["errors"] += 1
+            turn["seconds"] = time.perf_counter() - turn_start
+            tokens_after = model_usage_totals(client)
+            turn["input_tokens"] = tokens_after[0] - tokens_before[0]
+            turn["output_tokens"] = tokens_after[1] - tokens_before[1]
+            record["turns"] += 1
+            write(turn)
+    finally:
+        await close_client(client)
+    record["seconds"] = time.perf_counter() - start
+    write(record)
+    return record
 
-def main():
-    parser = argparse.ArgumentParser(description="CLI for interacting with an agent.")
-    
-    # Add the new argument for the .aia file
-    parser.add_argument(
-        "-f", "--aia-file",
-        type=str,
-        help="Path to the .aia agent file to run. If provided, environment variables for client/agent IDs are ignored."
+async def run_batch(args):
+    """Runs every conversation in args.batch with at most args.concurrency in flight, streaming records to args.output."""
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+
+    def write(record: dict):
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+
+    results = []
+    conversations = read_batch_file(args.batch)
+
+    async def worker():
+        # Workers share one iterator, so the file is read as conversations are started.
+        for line_number, conversation in conversations:
+            if isinstance(conversation, str):
+                results.append({"type": "conversation", "conversation_id": f"line-{line_number}", "turns": 0, "errors": 0, "error": conversation})
+                write(results[-1])
+                continue
+            conversation_id = str(conversation.get("id", f"line-{line_number}"))
+            results.append(await run_batch_conversation(conversation_id, conversation, args, write))
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+    finally:
+        await get_session_persister().flush_all()
+        await close_client_pools()
+        await close_http_clients()
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    turns = sum(result["turns"] for result in results)
+    failed = sum(1 for result in results if result["error"])
+    print(
+        f"{len(results)} conversations ({failed} failed), {turns} turns, "
+        f"{sum(result['errors'] for result in results)} turn errors in {elapsed:.1f}s "
+        f"({turns / elapsed if elapsed else 0:.2f} turns/s)",
+        file=sys.stderr,
     )
-    # You might have other arguments, keep them here
-    # parser.add_argument(...) 
-    args = parser.parse_args()
 
-    def load_agent_from_aia_path(path: str):
-        """Load an agent from a .aia file path. Returns client or None."""
-        if not os.path.exists(path):
-            print(f"Error: File not found at '{path}'")
-            return None
-        try:
-            with open(path, "rb") as f:
-                raw = f.read()
-            file_text = raw.decode("utf-8")
-            client, init_message = run_coroutine_in_event_loop(AsyncPinionAIClient.create_from_stream(
-                file_stream=file_text,
-                host_url=os.environ.get("host_url")
-            ))
-            if client:
-                return client
-            if init_message == 'key_secret required for private version':
-                print("This AIA file requires a key_secret to decrypt.")
-                for attempt in range(3):
-                    key_secret = getpass.getpass("Enter key_secret: ")
-                    if not key_secret:
-                        print("No key_secret entered; try again.")
-                        continue
-                    try:
-                        client, init_message = run_coroutine_in_event_loop(AsyncPinionAIClient.create_from_stream(
-                            file_stream=file_text,
-                            host_url=os.environ.get("host_url"),
-                            key_secret=key_secret
-                        ))
-                        if client:
-                            return client
-                        else:
-                            print(f"Failed to load agent: {init_message}")
-                    except PinionAIError as e:
-                        print(f"Failed to decrypt AIA file with provided key_secret: {e}")
-                print("Exceeded key_secret attempts. Aborting.")
-                return None
-            else:
-                print(f"Could not create agent from file: {init_message}")
-                return None
-        except PinionAIError as e:
-            print(f"Failed to initialize PinionAI client from AIA file: {e}")
+def read_recording(path: str) -> dict[str, dict]:
+    """
+    Reads a recorded transcript as {conversation_id: {"aia_file": ..., "key_secret": ..., "turns": [turn, ...]}}.
+
+    Accepts --batch output (its "turn" and "conversation" records), or one
+    conversation per line as {"id": ..., "turns": [{"input": ..., "response": ..., "seconds": ...}, ...]}.
+    Batch output never contains key_secret; private AIA files there need --key-secret.
+    """
+    conversations: dict[str, dict] = {}
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("type") == "turn":
+                conversation = conversations.setdefault(record["conversation_id"], {"aia_file": None, "key_secret": None, "turns": []})
+                conversation["turns"].append(record)
+            elif record.get("type") == "conversation":
+                conversations.setdefault(record["conversation_id"], {"aia_file": None, "key_secret": None, "turns": []})["aia_file"] = record.get("aia_file")
+            elif isinstance(record.get("turns"), list):
+                conversations[str(record.get("id", f"line-{line_number}"))] = {
+                    "aia_file": record.get("aia_file"),
+                    "key_secret": record.get("key_secret"),
+                    "turns": [turn if isinstance(turn, dict) else {"input": turn} for turn in record["turns"]],
+                }
+    for conversation in conversations.values():
+        conversation["turns"].sort(key=lambda turn: turn.get("turn", 0))
+    return conversations
+
+def response_text(turn: dict) -> str:
+    return "\n".join(part for part in (turn.get("response"), turn.get("follow_up")) if part)
+
+def normalize_response(text: str) -> str:
+    return " ".join(text.split())
+
+def format_delta(recorded: float | None, replayed: float | None, scale: float = 1.0, unit: str = "") -> str:
+    """Formats 'recorded -> replayed (+delta, +percent)', or just the replayed value if nothing was recorded."""
+    if replayed is None:
+        return "n/a"
+    if not recorded:
+        return f"{replayed * scale:.1f}{unit}"
+    delta = replayed - recorded
+    return f"{recorded * scale:.1f}{unit} -> {replayed * scale:.1f}{unit} ({delta * scale:+.1f}{unit}, {delta / recorded * 100:+.1f}%)"
+
+async def run_replay(args):
+    """
+    Replays a recorded transcript against args.version: args.warmup unmeasured
+    runs, then args.repeat measured runs. Prints latency, size and token deltas
+    against the recording and lists responses that changed.
+    """
+    recording = read_recording(args.replay)
+    turn_count = sum(len(conversation["turns"]) for conversation in recording.values())
+    runs: list[dict[tuple[str, int], dict]] = []
+    try:
+        for run in range(args.warmup + args.repeat):
+            replayed: dict[tuple[str, int], dict] = {}
+
+            def collect(record: dict):
+                if record["type"] == "turn":
+                    replayed[(record["conversation_id"], record["turn"])] = record
+                elif record["error"]:
+                    print(f"{record['conversation_id']}: {record['error']}", file=sys.stderr)
+
+            pending = iter(recording.items())
+
+            async def worker():
+                for conversation_id, conversation in pending:
+                    # The recorded version is deliberately ignored: args.version is the one under test.
+                    turns = {
+                        "turns": [turn["input"] for turn in conversation["turns"]],
+                        "aia_file": conversation["aia_file"],
+                        "key_secret": conversation["key_secret"],
+                    }
+                    await run_batch_conversation(conversation_id, turns, args, collect)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+            label = "warmup" if run < args.warmup else "run"
+            print(f"{label} {run + 1}/{args.warmup + args.repeat}: {len(replayed)} turns in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            if run >= args.warmup:
+                runs.append(replayed)
+    finally:
+        await get_session_persister().flush_all()
+        await close_client_pools()
+        await close_http_clients()
+
+    out = None if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    recorded_seconds, replayed_seconds = [], []
+    totals = {"recorded_chars": 0, "replayed_chars": 0, "recorded_tokens": 0, "replayed_tokens": 0, "errors": 0}
+    changed, slower = [], []
+    for conversation_id, conversation in recording.items():
+        for index, recorded in enumerate(conversation["turns"]):
+            attempts = [run[(conversation_id, index)] for run in runs if (conversation_id, index) in run]
+            timings = [attempt["seconds"] for attempt in attempts if not attempt["error"]]
+            seconds = statistics.median(timings) if timings else None
+            latest = attempts[-1] if attempts else {"response": None, "error": "not replayed"}
+            totals["errors"] += sum(1 for attempt in attempts if attempt["error"]) + (0 if attempts else 1)
+            totals["recorded_chars"] += len(response_text(recorded))
+            totals["replayed_chars"] += len(response_text(latest))
+            totals["recorded_tokens"] += (recorded.get("input_tokens") or 0) + (recorded.get("output_tokens") or 0)
+            totals["replayed_tokens"] += (latest.get("input_tokens") or 0) + (latest.get("output_tokens") or 0)
+            similarity = None
+            if recorded.get("response") is not None and not latest["error"]:
+                similarity = difflib.SequenceMatcher(None, normalize_response(response_text(recorded)), normalize_response(response_text(latest))).ratio()
+                if similarity < 1.0:
+                    changed.append((similarity, conversation_id, index, recorded, latest))
+            if recorded.get("seconds") and seconds is not None:
+                recorded_seconds.append(recorded["seconds"])
+                replayed_seconds.append(seconds)
+                slower.append((seconds - recorded["seconds"], conversation_id, index, recorded["seconds"], seconds))
+            if out is not None:
+                out.write(json.dumps({
+                    "type": "replay_turn", "conversation_id": conversation_id, "turn": index, "input": recorded["input"],
+                    "recorded_seconds": recorded.get("seconds"), "replayed_seconds": seconds, "runs": timings,
+                    "recorded_response": response_text(recorded), "replayed_response": response_text(latest),
+                    "similarity": similarity, "error": latest["error"],
+                }, ensure_ascii=False) + "\n")
+    if out is not None:
+        out.close()
+
+    def p95(values):
+        return sorted(values)[min(len(values) - 1, int(0.95 * len(values)))] if values else None
+
+    version = args.version or os.environ.get("version") or "(latest)"
+    print(f"\nReplayed {len(recording)} conversations ({turn_count} turns) against version {version}: "
+          f"{args.warmup} warmup + {args.repeat} measured runs")
+    if recorded_seconds:
+        print(f"  turn latency p50   {format_delta(statistics.median(recorded_seconds), statistics.median(replayed_seconds), 1000, ' ms')}")
+        print(f"  turn latency p95   {format_delta(p95(recorded_seconds), p95(replayed_seconds), 1000, ' ms')}")
+        print(f"  total turn time    {format_delta(sum(recorded_seconds), sum(replayed_seconds), 1, ' s')}")
+    else:
+        print("  (the recording has no timings; latency deltas are not available)")
+    print(f"  response chars     {format_delta(totals['recorded_chars'], totals['replayed_chars'])}")
+    if totals["recorded_tokens"] or totals["replayed_tokens"]:
+        print(f"  tokens             {format_delta(totals['recorded_tokens'], totals['replayed_tokens'])}")
+    print(f"  turn errors        {totals['errors']}")
+    print(f"  changed responses  {len(changed)} of {turn_count}")
+    for similarity, conversation_id, index, recorded, latest in sorted(changed, key=lambda item: item[0])[:args.show_diffs]:
+        print(f"\n  {conversation_id} turn {index} (similarity {similarity:.2f}): {recorded['input'][:80]!r}")
+        print(f"    recorded: {normalize_response(response_text(recorded))[:200]}")
+        print(f"    replayed: {normalize_response(response_text(latest))[:200]}")
+    regressions = [item for item in sorted(slower, reverse=True) if item[0] > 0][:args.show_diffs]
+    if regressions:
+        print("\n  slowest turns vs. recording:")
+        for delta, conversation_id, index, recorded_s, replayed_s in regressions:
+            print(f"    {conversation_id} turn {index}: {recorded_s * 1000:.0f} ms -> {replayed_s * 1000:.0f} ms ({delta * 1000:+.0f} ms)")
+
+async def load_agent_from_aia_path(console: AsyncConsole, path: str):
+    """Load an agent from a .aia file path. Returns client or None."""
+    if not os.path.exists(path):
+        console.print(f"Error: File not found at '{path}'")
+        return None
+    try:
+        with open(path, "rb") as f:
+            file_text = read_aia_file(f)
+        client, init_message = await get_agent_file_cache().create_client(
+            file_stream=file_text,
+            host_url=os.environ.get("host_url")
+        )
+        if client:
+            return client
+        if init_message == 'key_secret required for private version':
+            console.print("This AIA file requires a key_secret to decrypt.")
+            for attempt in range(3):
+                key_secret = await console.getpass("Enter key_secret: ")
+                if not key_secret:
+                    console.print("No key_secret entered; try again.")
+                    continue
+                try:
+                    client, init_message = await get_agent_file_cache().create_client(
+                        file_stream=file_text,
+                        host_url=os.environ.get("host_url"),
+                        key_secret=key_secret
+                    )
+                    if client:
+                        return client
+                    else:
+                        console.print(f"Failed to load agent: {init_message}")
+                except PinionAIError as e:
+                    console.print(f"Failed to decrypt AIA file with provided key_secret: {e}")
+            console.print("Exceeded key_secret attempts. Aborting.")
             return None
-        except Exception as e:
-            print(f"Unexpected error while reading AIA file: {e}")
+        else:
+            console.print(f"Could not create agent from file: {init_message}")
             return None
+    except PinionAIError as e:
+        console.print(f"Failed to initialize PinionAI client from AIA file: {e}")
+        return None
+    except Exception as e:
+        console.print(f"Unexpected error while reading AIA file: {e}")
+        return None
+
+async def merge_agent_from_aia_path(console: AsyncConsole, client: AsyncPinionAIClient, aia_path: str) -> bool:
+    """Merges an AIA agent into the current session. Returns True on success."""
+    if not os.path.exists(aia_path):
+        console.print(f"Error: File not found at '{aia_path}'")
+        return False
+    try:
+        with open(aia_path, "rb") as f:
+            file_text = read_aia_file(f)
+
+        result_msg = await get_agent_file_cache().add_agent(client, file_stream=file_text)
+
+        if result_msg == 'key_secret required for private version':
+            console.print("This AIA file is private and requires a secret key to decrypt.")
+            key_secret = await console.getpass("Enter key_secret: ")
+            result_msg = await get_agent_file_cache().add_agent(client, file_stream=file_text, key_secret=key_secret)
+
+        if "Error" not in result_msg:
+            console.print(f"Success: {result_msg}")
+            return True
+        console.print(f"Merge failed: {result_msg}")
+    except Exception as e:
+        console.print(f"Error merging AIA file: {e}")
+    return False
+
+async def refresh_from_server(console: AsyncConsole, client: AsyncPinionAIClient):
+    """Pulls the session from the server if it changed there (e.g. messages that bypassed gRPC)."""
+    try:
+        lastmodified_server, _ = await client.get_latest_session_modification_time()
+        if lastmodified_server and lastmodified_server != client.last_session_post_modified:
+            await client.sync_session_from_server()
+            # Syncing replaces chat_messages; re-hook it so live messages keep printing.
+            attach_update_notifier(client)
+    except Exception as e:
+        console.print(f"Warning: Could not check for session updates: {e}")
+
+async def chat(args):
+    """Runs the interactive chat until /end or end of input."""
+    console = AsyncConsole()
+    console.start()
+
+    # With SESSION_SNAPSHOT_DIR (or SESSION_STORE_URL) set, a conversation left without /end is resumed next time.
+    sessions = SessionStore("cli_sessions", ttl=None, max_entries=1)
+    shared = shared_conversations_from_env(sessions, SessionStore("cli_pending_agents", ttl=None, max_entries=1))
+    session_key = f"cli:{os.path.abspath(args.aia_file)}" if args.aia_file else f"cli:{os.environ.get('agent_id')}"
+    try:
+        await shared.load(session_key)
+    except Exception as e:
+        console.print(f"Warning: Could not restore previous conversation: {e}")
+    lost = shared.pop_lost(session_key)
+    if lost:
+        console.print(f"Previous conversation could not be restored ({lost}); starting a new one.")
+    client = sessions.get(session_key)
+    if client is not None:
+        console.print("Resumed previous conversation.")
 
-    client = None
     # Try AIA file from CLI flag first
-    if args.aia_file:
-        print(f"Loading agent from file: {args.aia_file}")
-        client = load_agent_from_aia_path(args.aia_file)
+    if client is None and args.aia_file:
+        console.print(f"Loading agent from file: {args.aia_file}")
+        client = await load_agent_from_aia_path(console, args.aia_file)
 
     # If no AIA file or it failed, try env-based creation (only if all required env vars are present)
     if client is None:
@@ -160,41 +527,70 @@ def main():
         host_url = os.environ.get("host_url")
         client_id = os.environ.get("client_id")
         client_secret = os.environ.get("client_secret")
-        
+
         # Check if all required environment variables are set
         if agent_id and host_url and client_id and client_secret:
             try:
-                client = run_coroutine_in_event_loop(AsyncPinionAIClient.create(
+                client = instrument_client(await AsyncPinionAIClient.create(
                     agent_id=agent_id,
                     host_url=host_url,
                     client_id=client_id,
                     client_secret=client_secret,
-                    version=os.environ.get("version", None),
+                    version=args.version or os.environ.get("version", None),
                 ))
             except (PinionAIConfigurationError, Exception) as e:
-                print(f"Failed to initialize PinionAI client from environment: {e}")
+                console.print(f"Failed to initialize PinionAI client from environment: {e}")
                 client = None
-        
+
         # If env-based creation failed or env vars are missing, prompt for AIA file
         if client is None:
             if not (agent_id and host_url and client_id and client_secret):
-                print("Environment variables (client_id, client_secret, agent_id, host_url) not found.")
-            aia_path = input("Enter path to .aia file to load the agent (or leave empty to abort): ").strip()
+                console.print("Environment variables (client_id, client_secret, agent_id, host_url) not found.")
+            try:
+                aia_path = (await console.input("Enter path to .aia file to load the agent (or leave empty to abort): ")).strip()
+            except EOFError:
+                aia_path = ""
             if aia_path:
-                client = load_agent_from_aia_path(aia_path)
+                client = await load_agent_from_aia_path(console, aia_path)
             else:
-                print("No .aia file provided. Exiting.")
+                console.print("No .aia file provided. Exiting.")
+            if client is None:
+                await shared.close()
                 return
 
+    sessions[session_key] = client
+    snapshots = asyncio.create_task(shared.run_snapshots(float(os.environ.get("SESSION_SNAPSHOT_INTERVAL", 30))))
+
+    async def show_live_message(key, message: dict):
+        if message.get("content"):
+            console.print(f"Agent: {message['content']}")
+
+    async def announce_live_end(key):
+        console.print("Live agent session ended.")
+
+    # Prints live-agent messages as they arrive, while the prompt keeps waiting for input.
+    live_bridge = LiveAgentBridge(deliver=show_live_message, on_end=announce_live_end, max_workers=1)
+
+    async def save_conversation(ended: bool = False):
+        """Marks the conversation for the next snapshot, or forgets it once ended."""
+        if ended:
+            sessions.pop(session_key, None)
+        try:
+            await shared.save(session_key)
+            if ended:
+                await shared.flush()
+        except Exception as e:
+            console.print(f"Warning: Could not save conversation snapshot: {e}")
+
     var = client.var
-    print(var.get("agentTitle"),"PinionAI Terminal Chat")
-    print(var.get("agentSubtitle"))
-    print("Type your message and press Enter.")
-    print("Commands:")
-    print("  /add <path> - merge an AIA agent into the current session")
-    print("  /end        - end chat session and exit")
-    print("  /continue   - continue polling or force refresh")
-    
+    console.print(f"{var.get('agentTitle')} PinionAI Terminal Chat")
+    console.print(var.get("agentSubtitle"))
+    console.print("Type your message and press Enter.")
+    console.print("Commands:")
+    console.print("  /add <path> - merge an AIA agent into the current session")
+    console.print("  /end        - end chat session and exit")
+    console.print("  /continue   - check the server for missed updates and show the conversation")
+
     user_img = var.get("userImage")
     assistant_img = var.get("assistImage")
 
@@ -202,106 +598,132 @@ def main():
     if not client.chat_messages and var.get("agentStart"):
         client.add_message_to_history("assistant", var["agentStart"])
 
-    display_messages(client.get_chat_messages_for_display(), user_img, assistant_img)
+    display_messages(client.get_chat_messages_for_display(), user_img, assistant_img, out=console.print)
 
-    while True:
-        try:
-            prompt = input("You: ")
-        except EOFError:
-            print("EOF received, exiting.")
-            cleanup_client(client)
-            break
-
-        if not prompt:
-            continue
-        
-        trimmed_prompt = prompt.strip().lower()
-        if trimmed_prompt == "/end":
-            run_coroutine_in_event_loop(client.end_grpc_chat_session())
-            print("Chat ended.")
-            cleanup_client(client)
-            break
-        if trimmed_prompt == "/continue":
-            print("Continuing / refreshing...")
-            # show any new messages
-            if poll_for_updates(client, timeout=5):
-                display_messages(client.get_chat_messages_for_display(), user_img, assistant_img)
-            continue
-        
-        if trimmed_prompt.startswith("/add "):
-            aia_path = prompt.strip()[5:].strip()
-            if not os.path.exists(aia_path):
-                print(f"Error: File not found at '{aia_path}'")
-                continue
+    # A resumed conversation may still be with a live agent.
+    if client.transfer_requested and await live_bridge.start(LIVE_SESSION_KEY, client):
+        console.print("Reconnected to live agent.")
+
+    ended = False
+    try:
+        while True:
             try:
-                with open(aia_path, "rb") as f:
-                    raw = f.read()
-                file_text = raw.decode("utf-8")
-                
-                result_msg = run_coroutine_in_event_loop(client.add_agent_from_aia(
-                    file_stream=file_text
-                ))
+                prompt = await console.input("You: ")
+            except EOFError:
+                console.print("EOF received, exiting.")
+                break
 
-                if result_msg == 'key_secret required for private version':
-                    print("This AIA file is private and requires a secret key to decrypt.")
-                    key_secret = getpass.getpass("Enter key_secret: ")
-                    result_msg = run_coroutine_in_event_loop(client.add_agent_from_aia(
-                        file_stream=file_text,
-                        key_secret=key_secret
-                    ))
-                
-                if "Error" not in result_msg:
-                    print(f"Success: {result_msg}")
+            if not prompt:
+                continue
+
+            trimmed_prompt = prompt.strip().lower()
+            if trimmed_prompt == "/end":
+                await live_bridge.stop(LIVE_SESSION_KEY)
+                await get_session_persister().flush(client)
+                await client.end_grpc_chat_session()
+                console.print("Chat ended.")
+                ended = True
+                break
+            if trimmed_prompt == "/continue":
+                console.print("Continuing / refreshing...")
+                await refresh_from_server(console, client)
+                display_messages(client.get_chat_messages_for_display(), user_img, assistant_img, out=console.print)
+                continue
+
+            if trimmed_prompt.startswith("/add "):
+                if await merge_agent_from_aia_path(console, client, prompt.strip()[5:].strip()):
                     # Refresh vars as they might have changed
                     var = client.var
                     user_img = var.get("userImage")
                     assistant_img = var.get("assistImage")
+                await save_conversation()
+                continue
+
+            # Add user message
+            client.add_message_to_history("user", prompt)
+
+            if client.transfer_requested:
+                # Live agent mode: relay to the agent; their replies are printed by live_bridge
+                if await live_bridge.start(LIVE_SESSION_KEY, client):
+                    await get_session_persister().write(client)
+                    await client.send_grpc_message(prompt)
                 else:
-                    print(f"Merge failed: {result_msg}")
-            except Exception as e:
-                print(f"Error merging AIA file: {e}")
-            continue
-
-        # Add user message
-        client.add_message_to_history("user", prompt)
-        # print(f"You: {prompt}")
-
-        if client.transfer_requested:
-            if ensure_grpc_is_active(client):
-                run_coroutine_in_event_loop(client.update_pinion_session())
-                run_coroutine_in_event_loop(client.send_grpc_message(prompt))
-                if poll_for_updates(client, timeout=180):
-                    display_messages(client.get_chat_messages_for_display(), user_img, assistant_img)
-                else:
-                    print("No new messages in the last 3 minutes. Type /continue or /end.")
+                    console.print("Could not connect to live agent service.")
             else:
-                print("Could not connect to live agent service.")
-        else:
-            # AI flow
-            try:
-                full_ai_response_string = run_coroutine_in_event_loop(client.process_user_input(prompt, sender="user"))
-                print(f"Agent: {full_ai_response_string}")
-                run_coroutine_in_event_loop(client.update_pinion_session())
+                # AI flow
+                try:
+                    full_ai_response_string = await client.process_user_input(prompt, sender="user")
+                    console.print(f"Agent: {full_ai_response_string}")
+                    get_session_persister().schedule(client)
 
-                if client.next_intent:
-                    full_ai_response_string = run_coroutine_in_event_loop(client.process_user_input(prompt, sender="user"))
-                    print(f"Agent (follow-up): {full_ai_response_string}")
-                    run_coroutine_in_event_loop(client.update_pinion_session())
-
-                # After AI response, check if transfer requested
-                if client.transfer_requested:
-                    if ensure_grpc_is_active(client):
-                        print("Transfer to live agent initiated... Waiting for agent to connect.")
-                        if poll_for_updates(client, timeout=180):
-                            display_messages(client.get_chat_messages_for_display(), user_img, assistant_img)
+                    if client.next_intent:
+                        full_ai_response_string = await client.process_user_input(prompt, sender="user")
+                        console.print(f"Agent (follow-up): {full_ai_response_string}")
+                        get_session_persister().schedule(client)
+
+                    # After AI response, check if transfer requested
+                    if client.transfer_requested:
+                        if await live_bridge.start(LIVE_SESSION_KEY, client):
+                            console.print("Transfer to live agent initiated... Waiting for agent to connect.")
                         else:
-                            print("No new messages in the last 3 minutes. Type /continue or /end.")
-                    else:
-                        print("Could not connect to live agent service for transfer.")
-            except PinionAIError as e:
-                print(f"Error from PinionAI: {e}")
-            except Exception as e:
-                print(f"Unexpected error: {e}")
+                            console.print("Could not connect to live agent service for transfer.")
+                except PinionAIError as e:
+                    console.print(f"Error from PinionAI: {e}")
+                except Exception as e:
+                    console.print(f"Unexpected error: {e}")
+            await save_conversation()
+    finally:
+        console.pause()
+        snapshots.cancel()
+        await live_bridge.stop_all()
+        await save_conversation(ended=ended)
+        try:
+            await get_session_persister().flush(client)
+        except Exception as e:
+            console.print(f"Warning: Error saving session: {e}")
+        try:
+            await client.close()
+        except Exception as e:
+            console.print(f"Warning: Error closing HTTP session: {e}")
+        await shared.close()
+        await close_http_clients()
+
+def main():
+    get_metrics().frontend = "cli"
+    start_metrics_server()
+    parser = argparse.ArgumentParser(description="CLI for interacting with an agent.")
+
+    # Add the new argument for the .aia file
+    parser.add_argument(
+        "-f", "--aia-file",
+        type=str,
+        help="Path to the .aia agent file to run. If provided, environment variables for client/agent IDs are ignored."
+    )
+    parser.add_argument("--version", help="Agent version for environment-configured agents (overrides the version variable).")
+    parser.add_argument("--batch", metavar="JSONL", help="Run the conversations in this JSONL file instead of chatting interactively.")
+    parser.add_argument("--output", default="-", help="Batch mode: JSONL file for results (default: stdout).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Batch and replay modes: conversations run at once.")
+    parser.add_argument(
+        "--key-secret",
+        default=os.environ.get("AIA_KEY_SECRET"),
+        help="Batch and replay modes: key_secret for private AIA files whose conversation doesn't give one (default: AIA_KEY_SECRET).",
+    )
+    parser.add_argument("--replay", metavar="JSONL", help="Replay a recorded transcript (e.g. --batch output) against --version and compare.")
+    parser.add_argument("--warmup", type=int, default=1, help="Replay mode: unmeasured runs before measuring.")
+    parser.add_argument("--repeat", type=int, default=3, help="Replay mode: measured runs; per-turn latency is their median.")
+    parser.add_argument("--show-diffs", type=int, default=10, help="Replay mode: changed responses and slowest turns to list.")
+    args = parser.parse_args()
+
+    if args.replay:
+        mode = run_replay(args)
+    elif args.batch:
+        mode = run_batch(args)
+    else:
+        mode = chat(args)
+    try:
+        asyncio.run(mode)
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -10,12 +10,22 @@ It supports loading agents from uploaded .aia files.
 import os
 import asyncio
 import logging
-import httpx
 import re
+from typing import Awaitable
 from slack_bolt.async_app import AsyncApp
 from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.errors import SlackApiError
 from pinionai import AsyncPinionAIClient
 from pinionai.exceptions import PinionAIConfigurationError, PinionAIError
+from pinionai_agents import acquire_client, agent_config_from_env, download_aia_file, get_agent_file_cache, get_client_pool
+from pinionai_http import close_http_clients
+from pinionai_live import LiveAgentBridge
+from pinionai_metrics import get_metrics, start_metrics_site
+from pinionai_runtime import ConversationDispatcher, close_client
+from pinionai_sessions import estimate_client_bytes, get_session_persister, session_store_from_env
+from pinionai_store import shared_conversations_from_env
+from pinionai_tracing import get_tracer
+from pinionai_cache import get_tool_cache
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -35,11 +45,51 @@ if not SLACK_BOT_TOKEN or not SLACK_APP_TOKEN:
 
 app = AsyncApp(token=SLACK_BOT_TOKEN)
 
-# Session management: channel_id -> AsyncPinionAIClient
-sessions = {}
+# Post a placeholder right away and edit the reply into it, instead of posting only the finished reply.
+SLACK_PROGRESSIVE_UPDATES = os.environ.get("SLACK_PROGRESSIVE_UPDATES", "true").lower() in ("1", "true", "yes")
+SLACK_PLACEHOLDER_TEXT = "_Thinking..._"
+
+# Session management: channel_id -> AsyncPinionAIClient, evicted when idle or over the size limits
+sessions = session_store_from_env("sessions", on_evict=close_client, size_of=estimate_client_bytes)
+
+# Per-channel ordered work queues, with a global limit on concurrent agent turns
+dispatcher = ConversationDispatcher(
+    max_workers=int(os.environ.get("DISPATCH_MAX_WORKERS", 8)),
+    max_queue_depth=int(os.environ.get("DISPATCH_MAX_QUEUE_DEPTH", 5)),
+)
+QUEUE_FULL_MESSAGE = "I'm still working through your earlier messages. Please wait a moment and try again."
+LOST_CONVERSATION_MESSAGE = "Your previous conversation could not be restored ({reason}), so this starts a new one."
+# Don't evict (and close) a client whose channel has turns queued or running.
+sessions.is_busy = dispatcher.is_busy
+
+async def post_live_message(channel_id: str, message: dict):
+    """Posts a message from the live agent to the channel."""
+    if message.get("content"):
+        with get_tracer().start_trace("live_message", frontend="slack", channel_id=channel_id), get_tracer().span("slack.post"):
+            await app.client.chat_postMessage(channel=channel_id, text=message["content"])
+
+async def announce_live_end(channel_id: str):
+    """Tells the channel the live-agent stream has closed."""
+    await app.client.chat_postMessage(channel=channel_id, text="_Live agent session ended._")
+
+# Live-agent transfers: one bridge pushes every channel's incoming agent messages to Slack
+live_bridge = LiveAgentBridge(
+    deliver=post_live_message,
+    on_end=announce_live_end,
+    max_workers=int(os.environ.get("DISPATCH_MAX_WORKERS", 8)),
+    max_pending=int(os.environ.get("LIVE_MAX_PENDING", 50)),
+)
 
 # State management for private AIA files: channel_id -> { "file_content": ..., "awaiting_secret": True, "is_merge": False }
-pending_agents = {}
+pending_agents = session_store_from_env(
+    "pending_agents",
+    ttl=float(os.environ.get("PENDING_AGENT_TTL", 900)),
+    size_of=lambda pending: len(pending["file_content"]),
+)
+
+# Shares sessions with other workers (SESSION_STORE_URL) or keeps them across restarts (SESSION_SNAPSHOT_DIR)
+shared = shared_conversations_from_env(sessions, pending_agents)
+SESSION_SNAPSHOT_INTERVAL = float(os.environ.get("SESSION_SNAPSHOT_INTERVAL", 30))
 
 def clean_slack_text(text: str) -> str:
     """
@@ -54,27 +104,29 @@ def clean_slack_text(text: str) -> str:
     text = re.sub(r'<([^|>]+)(\|[^>]+)?>', r'\1', text)
     return text
 
+async def run_turn(channel_id: str, job):
+    """Runs a queued job for the channel as one traced turn, between shared-state load and save."""
+    with get_tracer().start_trace("turn", frontend="slack", channel_id=channel_id):
+        await shared.run(channel_id, job)
+
+def traced_say(say):
+    """Wraps say so each post is a span of the current turn."""
+    async def post(*args, **kwargs):
+        with get_tracer().span("slack.post"):
+            return await say(*args, **kwargs)
+    return post
+
 async def get_client(channel_id: str) -> AsyncPinionAIClient:
     """Gets or initializes the PinionAI client for a given channel."""
     if channel_id in sessions:
         return sessions[channel_id]
     
-    # Try to initialize from environment variables
-    agent_id = os.environ.get("agent_id")
-    host_url = os.environ.get("host_url")
-    client_id = os.environ.get("client_id")
-    client_secret = os.environ.get("client_secret")
-    
-    if agent_id and host_url and client_id and client_secret:
+    # Try to initialize from environment variables, using a prewarmed client when one is ready
+    config = agent_config_from_env()
+    if config:
         try:
             logger.info(f"Initializing default agent for channel {channel_id}")
-            client = await AsyncPinionAIClient.create(
-                agent_id=agent_id,
-                host_url=host_url,
-                client_id=client_id,
-                client_secret=client_secret,
-                version=os.environ.get("version", None),
-            )
+            client = await acquire_client(config)
             # Add initial greeting if defined
             if not client.chat_messages and client.var.get("agentStart"):
                 client.add_message_to_history("assistant", client.var["agentStart"])
@@ -86,12 +138,57 @@ async def get_client(channel_id: str) -> AsyncPinionAIClient:
     
     return None
 
+async def say_with_placeholder(say, reply: Awaitable[str]) -> str:
+    """Posts a placeholder message, awaits reply and edits the placeholder into it. Returns the reply."""
+    placeholder = await say(SLACK_PLACEHOLDER_TEXT)
+    channel, ts = placeholder["channel"], placeholder["ts"]
+    try:
+        text = await reply
+    except BaseException:
+        await delete_message(channel, ts)
+        raise
+    if not text or not text.strip():
+        await delete_message(channel, ts)
+        return text
+    try:
+        with get_tracer().span("slack.update"):
+            await app.client.chat_update(channel=channel, ts=ts, text=text)
+    except SlackApiError as e:
+        logger.warning(f"Could not finalize reply in {channel} ({e.response.get('error')}); posting it instead.")
+        await delete_message(channel, ts)
+        await say(text)
+    return text
+
+async def delete_message(channel: str, ts: str):
+    """Deletes a bot message, ignoring Slack API errors."""
+    try:
+        with get_tracer().span("slack.delete"):
+            await app.client.chat_delete(channel=channel, ts=ts)
+    except SlackApiError as e:
+        logger.warning(f"Could not delete message {ts} in {channel}: {e.response.get('error')}")
+
+async def respond(p_client: AsyncPinionAIClient, user_input: str, say):
+    """Runs one agent turn and posts the reply, into a placeholder posted straight away if enabled."""
+    if SLACK_PROGRESSIVE_UPDATES:
+        await say_with_placeholder(say, p_client.process_user_input(user_input, sender="user"))
+    else:
+        response_text = await p_client.process_user_input(user_input, sender="user")
+        await say(response_text)
+    get_session_persister().schedule(p_client)
+
 @app.command("/end")
 async def handle_end_command(ack, body, say):
-    """Handles the /end slash command."""
+    """Handles the /end slash command, after any messages already queued for the channel."""
     await ack()
     channel_id = body["channel_id"]
+    if not dispatcher.submit(channel_id, lambda: run_turn(channel_id, lambda: end_session(channel_id, traced_say(say)))):
+        await say(QUEUE_FULL_MESSAGE)
+
+async def end_session(channel_id: str, say):
+    """Ends the channel's live-agent stream and clears its session."""
     if channel_id in sessions:
+        await live_bridge.stop(channel_id)
+        await get_session_persister().flush(sessions[channel_id])
         await sessions[channel_id].end_grpc_chat_session()
         del sessions[channel_id]
         await say("Conversation ended and session cleared.")
@@ -100,15 +197,22 @@ async def handle_end_command(ack, body, say):
 
 @app.event("message")
 async def handle_message_events(event, say):
-    """Handles incoming messages and file uploads."""
+    """Queues incoming messages and file uploads on the channel's ordered work queue."""
+    # Ignore bot messages to prevent loops
+    if event.get("bot_id") or not event.get("user"):
+        return
+    channel_id = event["channel"]
+    if not dispatcher.submit(channel_id, lambda: run_turn(channel_id, lambda: process_message_event(event, traced_say(say)))):
+        await say(QUEUE_FULL_MESSAGE)
+
+async def process_message_event(event, say):
+    """Handles an incoming message or file upload."""
     channel_id = event["channel"]
-    user_id = event.get("user")
     raw_text = event.get("text", "").strip()
     text = clean_slack_text(raw_text)
-    
-    # Ignore bot messages to prevent loops
-    if event.get("bot_id") or not user_id:
-        return
+    lost = shared.pop_lost(channel_id)
+    if lost:
+        await say(LOST_CONVERSATION_MESSAGE.format(reason=lost))
 
     # 1. Handle Secret Key for private AIA files
     if channel_id in pending_agents and pending_agents[channel_id].get("awaiting_secret"):
@@ -116,7 +220,8 @@ async def handle_message_events(event, say):
         try:
             if pending.get("is_merge"):
                 await say("Decrypting and merging agent...")
-                result_msg = await sessions[channel_id].add_agent_from_aia(
+                result_msg = await get_agent_file_cache().add_agent(
+                    sessions[channel_id],
                     file_stream=pending["file_content"],
                     key_secret=text
                 )
@@ -126,7 +231,7 @@ async def handle_message_events(event, say):
                     await say(f"Failed to merge agent: {result_msg}")
             else:
                 await say("Decrypting and loading agent...")
-                p_client, init_message = await AsyncPinionAIClient.create_from_stream(
+                p_client, init_message = await get_agent_file_cache().create_client(
                     file_stream=pending["file_content"],
                     host_url=os.environ.get("host_url"),
                     key_secret=text
@@ -148,55 +253,53 @@ async def handle_message_events(event, say):
             if file["name"].endswith(".aia"):
                 file_url = file["url_private"]
                 headers = {"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
-                async with httpx.AsyncClient() as http_client:
-                    try:
-                        response = await http_client.get(file_url, headers=headers)
-                        response.raise_for_status()
-                        file_content = response.text
+                try:
+                    file_content = await download_aia_file(file_url, headers=headers)
                         
-                        if channel_id in sessions:
-                            # Additive merge
-                            result_msg = await sessions[channel_id].add_agent_from_aia(
-                                file_stream=file_content
-                            )
-                            if result_msg == 'key_secret required for private version':
-                                pending_agents[channel_id] = {
-                                    "file_content": file_content,
-                                    "awaiting_secret": True,
-                                    "is_merge": True
-                                }
-                                await say("This AIA file is private and requires a secret key to merge. Please reply with the key.")
-                                return
-                            elif "Error" not in result_msg:
-                                await say(f"Agent merged successfully: {result_msg}")
-                                return
-                            else:
-                                await say(f"Could not merge agent: {result_msg}")
+                    if channel_id in sessions:
+                        # Additive merge
+                        result_msg = await get_agent_file_cache().add_agent(
+                            sessions[channel_id],
+                            file_stream=file_content
+                        )
+                        if result_msg == 'key_secret required for private version':
+                            pending_agents[channel_id] = {
+                                "file_content": file_content,
+                                "awaiting_secret": True,
+                                "is_merge": True
+                            }
+                            await say("This AIA file is private and requires a secret key to merge. Please reply with the key.")
+                            return
+                        elif "Error" not in result_msg:
+                            await say(f"Agent merged successfully: {result_msg}")
+                            return
                         else:
-                            # Load new session
-                            p_client, init_message = await AsyncPinionAIClient.create_from_stream(
-                                file_stream=file_content,
-                                host_url=os.environ.get("host_url")
-                            )
+                            await say(f"Could not merge agent: {result_msg}")
+                    else:
+                        # Load new session
+                        p_client, init_message = await get_agent_file_cache().create_client(
+                            file_stream=file_content,
+                            host_url=os.environ.get("host_url")
+                        )
                             
-                            if init_message == 'key_secret required for private version':
-                                pending_agents[channel_id] = {
-                                    "file_content": file_content,
-                                    "awaiting_secret": True,
-                                    "is_merge": False
-                                }
-                                await say("This AIA file is private and requires a secret key. Please reply with the key.")
-                                return
-                            elif p_client:
-                                sessions[channel_id] = p_client
-                                greeting = p_client.var.get("agentStart", "Agent loaded successfully!")
-                                await say(f"*{p_client.var.get('agentTitle', 'Agent')}* loaded from file.\n{greeting}")
-                                return
-                            else:
-                                await say(f"Could not load agent: {init_message}")
-                    except Exception as e:
-                        logger.error(f"Error downloading/processing AIA file: {e}")
-                        await say(f"Error processing AIA file: {e}")
+                        if init_message == 'key_secret required for private version':
+                            pending_agents[channel_id] = {
+                                "file_content": file_content,
+                                "awaiting_secret": True,
+                                "is_merge": False
+                            }
+                            await say("This AIA file is private and requires a secret key. Please reply with the key.")
+                            return
+                        elif p_client:
+                            sessions[channel_id] = p_client
+                            greeting = p_client.var.get("agentStart", "Agent loaded successfully!")
+                            await say(f"*{p_client.var.get('agentTitle', 'Agent')}* loaded from file.\n{greeting}")
+                            return
+                        else:
+                            await say(f"Could not load agent: {init_message}")
+                except Exception as e:
+                    logger.error(f"Error downloading/processing AIA file: {e}")
+                    await say(f"Error processing AIA file: {e}")
                 return
 
     if not text:
@@ -204,12 +307,7 @@ async def handle_message_events(event, say):
 
     # 3. Handle Commands
     if text.lower() in ["/end", "!end"]:
-        if channel_id in sessions:
-            await sessions[channel_id].end_grpc_chat_session()
-            del sessions[channel_id]
-            await say("Conversation ended and session cleared.")
-        else:
-            await say("No active session to end.")
+        await end_session(channel_id, say)
         return
 
     # 4. Process Message with PinionAI
@@ -217,27 +315,37 @@ async def handle_message_events(event, say):
     if not p_client:
         await say("No agent is active in this channel. Upload an `.aia` file or ensure environment variables are set.")
         return
+    get_tracer().set_attribute("session_id", p_client.session_id)
 
     try:
         p_client.add_message_to_history("user", text)
+
+        # Live agent mode: relay to the agent; their replies are pushed by live_bridge
+        if p_client.transfer_requested:
+            if await live_bridge.start(channel_id, p_client):
+                # The session (with this message and the transfer state) must reach the server before the agent does.
+                await get_session_persister().write(p_client)
+                await p_client.send_grpc_message(text)
+            else:
+                await say("Could not connect to live agent service.")
+            return
         
-        # In Slack, we don't have a 'spinner', so we can optionally send a 'typing' indicator or just wait.
-        # Socket Mode doesn't support easy typing indicators via this API, so we just process.
+        # In Slack, we don't have a 'spinner'. With SLACK_PROGRESSIVE_UPDATES a placeholder message
+        # is posted at once and edited into the reply when it is ready (see say_with_placeholder).
         
         # AI Processing
-        response_text = await p_client.process_user_input(text, sender="user")
-        await say(response_text)
-        await p_client.update_pinion_session()
+        await respond(p_client, text, say)
         
         # Handle follow-up intents
         if p_client.next_intent:
-             follow_up = await p_client.process_user_input("", sender="user")
-             await say(follow_up)
-             await p_client.update_pinion_session()
+             await respond(p_client, "", say)
              
-        # Note: gRPC live transfer is not fully implemented here as it would require
-        # a long-running background task per channel to listen for gRPC updates
-        # and push them to Slack.
+        # Start relaying the live agent if the turn requested a transfer
+        if p_client.transfer_requested:
+            if await live_bridge.start(channel_id, p_client):
+                await say("Transfer to live agent initiated... Waiting for agent to connect.")
+            else:
+                await say("Could not connect to live agent service for transfer.")
              
     except PinionAIError as e:
         logger.error(f"PinionAI Error: {e}")
@@ -246,10 +354,44 @@ async def handle_message_events(event, say):
         logger.exception("Unexpected error during message processing")
         await say(f"An unexpected error occurred: {e}")
 
+def register_metrics():
+    """Labels this process's metrics and exports the bot's queue, session and cache gauges."""
+    metrics = get_metrics()
+    metrics.frontend = "slack"
+    metrics.register_stats("sessions", sessions.stats)
+    metrics.register_stats("pending_agents", pending_agents.stats)
+    metrics.register_stats("dispatcher", dispatcher.stats)
+    metrics.register_stats("live_bridge", live_bridge.stats)
+    metrics.register_stats("session_writes", get_session_persister().stats)
+    metrics.register_stats("aia_cache", get_agent_file_cache().stats)
+    metrics.register_stats("tracing", get_tracer().stats)
+    metrics.register_stats("tool_cache", get_tool_cache().stats)
+
 async def main():
     logger.info("Starting PinionAI Slack Bot in Socket Mode...")
     handler = AsyncSocketModeHandler(app, SLACK_APP_TOKEN)
-    await handler.start_async()
+    register_metrics()
+    metrics_runner = None
+    if metrics_port := int(os.environ.get("METRICS_PORT", 0) or 0):
+        metrics_runner = await start_metrics_site(metrics_port)
+    # Start warming clients for the default agent before the first message arrives.
+    if config := agent_config_from_env():
+        get_client_pool(config).start()
+    sweepers = [asyncio.create_task(store.run_sweeper()) for store in (sessions, pending_agents)]
+    sweepers.append(asyncio.create_task(shared.run_snapshots(SESSION_SNAPSHOT_INTERVAL)))
+    try:
+        await handler.start_async()
+    finally:
+        for sweeper in sweepers:
+            sweeper.cancel()
+        await live_bridge.stop_all()
+        # Write out any session updates still queued behind recent turns.
+        await get_session_persister().flush_all()
+        await shared.close()
+        await close_http_clients()
+        get_tracer().shutdown()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     try:
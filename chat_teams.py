@@ -11,7 +11,7 @@ import os
 import sys
 import asyncio
 import logging
-import httpx
+from collections import Counter
 from aiohttp import web
 from botbuilder.core import (
     BotFrameworkAdapter,
@@ -19,9 +19,17 @@ from botbuilder.core import (
     TurnContext,
     ActivityHandler,
 )
-from botbuilder.schema import Activity, ActivityTypes
+from botbuilder.schema import Activity, ActivityTypes, ConversationReference
 from pinionai import AsyncPinionAIClient
 from pinionai.exceptions import PinionAIConfigurationError, PinionAIError
+from pinionai_agents import acquire_client, agent_config_from_env, download_aia_file, get_agent_file_cache, get_client_pool
+from pinionai_http import close_http_clients
+from pinionai_metrics import get_metrics, metrics_handler, start_metrics_site
+from pinionai_runtime import ConversationDispatcher, close_client
+from pinionai_sessions import estimate_client_bytes, get_session_persister, session_store_from_env
+from pinionai_store import shared_conversations_from_env
+from pinionai_tracing import get_tracer
+from pinionai_cache import get_tool_cache
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -39,33 +47,62 @@ PORT = int(os.environ.get("PORT", 3978))
 SETTINGS = BotFrameworkAdapterSettings(APP_ID, APP_PASSWORD)
 ADAPTER = BotFrameworkAdapter(SETTINGS)
 
-# Session management: conversation_id -> AsyncPinionAIClient
-sessions = {}
+# Session management: conversation_id -> AsyncPinionAIClient, evicted when idle or over the size limits
+sessions = session_store_from_env("sessions", on_evict=close_client, size_of=estimate_client_bytes)
 
 # State management for private AIA files: conversation_id -> { "file_content": ..., "awaiting_secret": True, "is_merge": False }
-pending_agents = {}
+pending_agents = session_store_from_env(
+    "pending_agents",
+    ttl=float(os.environ.get("PENDING_AGENT_TTL", 900)),
+    size_of=lambda pending: len(pending["file_content"]),
+)
+
+# Shares sessions with other workers (SESSION_STORE_URL) or keeps them across restarts (SESSION_SNAPSHOT_DIR)
+shared = shared_conversations_from_env(sessions, pending_agents)
+SESSION_SNAPSHOT_INTERVAL = float(os.environ.get("SESSION_SNAPSHOT_INTERVAL", 30))
+
+# Acknowledge-then-process: turns run on per-conversation ordered queues and reply proactively
+TEAMS_ASYNC_PROCESSING = os.environ.get("TEAMS_ASYNC_PROCESSING", "true").lower() in ("1", "true", "yes")
+dispatcher = ConversationDispatcher(
+    max_workers=int(os.environ.get("DISPATCH_MAX_WORKERS", 8)),
+    max_queue_depth=int(os.environ.get("DISPATCH_MAX_QUEUE_DEPTH", 5)),
+)
+QUEUE_FULL_MESSAGE = "I'm still working through your earlier messages. Please wait a moment and try again."
+LOST_CONVERSATION_MESSAGE = "Your previous conversation could not be restored ({reason}), so this starts a new one."
+# Conversations with a turn running inline (TEAMS_ASYNC_PROCESSING off). Neither those nor
+# conversations with dispatcher work queued or running have their client evicted.
+inline_turns: Counter = Counter()
+sessions.is_busy = lambda key: dispatcher.is_busy(key) or inline_turns[key] > 0
+
+async def send_proactive(reference: ConversationReference, message: str):
+    """Sends a message into a conversation outside of its original request."""
+    async def send(turn_context: TurnContext):
+        await turn_context.send_activity(message)
+    await ADAPTER.continue_conversation(reference, send, APP_ID)
+
+async def run_turn(conversation_id: str, job):
+    """Runs a job for the conversation as one traced turn, between shared-state load and save."""
+    with get_tracer().start_trace("turn", frontend="teams", conversation_id=conversation_id):
+        await shared.run(conversation_id, job)
+
+def traced_reply(send):
+    """Wraps send so each outbound message is a span of the current turn."""
+    async def reply(message):
+        with get_tracer().span("teams.post"):
+            return await send(message)
+    return reply
 
 async def get_client(conversation_id: str) -> AsyncPinionAIClient:
     """Gets or initializes the PinionAI client for a given conversation."""
     if conversation_id in sessions:
         return sessions[conversation_id]
     
-    # Try to initialize from environment variables
-    agent_id = os.environ.get("agent_id")
-    host_url = os.environ.get("host_url")
-    client_id = os.environ.get("client_id")
-    client_secret = os.environ.get("client_secret")
-    
-    if agent_id and host_url and client_id and client_secret:
+    # Try to initialize from environment variables, using a prewarmed client when one is ready
+    config = agent_config_from_env()
+    if config:
         try:
             logger.info(f"Initializing default agent for conversation {conversation_id}")
-            client = await AsyncPinionAIClient.create(
-                agent_id=agent_id,
-                host_url=host_url,
-                client_id=client_id,
-                client_secret=client_secret,
-                version=os.environ.get("version", None),
-            )
+            client = await acquire_client(config)
             # Add initial greeting if defined
             if not client.chat_messages and client.var.get("agentStart"):
                 client.add_message_to_history("assistant", client.var["agentStart"])
@@ -79,26 +116,57 @@ async def get_client(conversation_id: str) -> AsyncPinionAIClient:
 
 class PinionAIBot(ActivityHandler):
     async def on_message_activity(self, turn_context: TurnContext):
-        conversation_id = turn_context.activity.conversation.id
-        text = turn_context.activity.text.strip() if turn_context.activity.text else ""
+        """
+        Acknowledges the message and queues the turn, so the HTTP request returns
+        before the agent runs. Replies are sent proactively using the stored
+        conversation reference. With TEAMS_ASYNC_PROCESSING off, the turn runs inline.
+        """
+        activity = turn_context.activity
+        if not TEAMS_ASYNC_PROCESSING:
+            inline_turns[activity.conversation.id] += 1
+            try:
+                await run_turn(activity.conversation.id, lambda: self.process_message(activity, traced_reply(turn_context.send_activity)))
+            finally:
+                inline_turns[activity.conversation.id] -= 1
+                if inline_turns[activity.conversation.id] <= 0:
+                    del inline_turns[activity.conversation.id]
+            return
+        reference = TurnContext.get_conversation_reference(activity)
+
+        async def reply(message: str):
+            await send_proactive(reference, message)
+
+        if not dispatcher.submit(activity.conversation.id, lambda: run_turn(activity.conversation.id, lambda: self.process_message(activity, traced_reply(reply)))):
+            await turn_context.send_activity(QUEUE_FULL_MESSAGE)
+            return
+        await turn_context.send_activity(Activity(type=ActivityTypes.typing))
+
+    async def process_message(self, activity: Activity, reply):
+        """Handles a message activity, sending responses with reply(text)."""
+        conversation_id = activity.conversation.id
+        text = activity.text.strip() if activity.text else ""
+        lost = shared.pop_lost(conversation_id)
+        if lost:
+            await reply(LOST_CONVERSATION_MESSAGE.format(reason=lost))
         
         # 1. Handle Secret Key for private AIA files
         if conversation_id in pending_agents and pending_agents[conversation_id].get("awaiting_secret"):
             pending = pending_agents.pop(conversation_id)
             try:
                 if pending.get("is_merge"):
-                    await turn_context.send_activity("Decrypting and merging agent...")
-                    result_msg = await sessions[conversation_id].add_agent_from_aia(
+                    await reply("Decrypting and merging agent...")
+                    result_msg = await get_agent_file_cache().add_agent(
+                        sessions[conversation_id],
                         file_stream=pending["file_content"],
                         key_secret=text
                     )
                     if "Error" not in result_msg:
-                        await turn_context.send_activity(f"Agent merged successfully: {result_msg}")
+                        await reply(f"Agent merged successfully: {result_msg}")
                     else:
-                        await turn_context.send_activity(f"Failed to merge agent: {result_msg}")
+                        await reply(f"Failed to merge agent: {result_msg}")
                 else:
-                    await turn_context.send_activity("Decrypting and loading agent...")
-                    p_client, init_message = await AsyncPinionAIClient.create_from_stream(
+                    await reply("Decrypting and loading agent...")
+                    p_client, init_message = await get_agent_file_cache().create_client(
                         file_stream=pending["file_content"],
                         host_url=os.environ.get("host_url"),
                         key_secret=text
@@ -106,70 +174,68 @@ class PinionAIBot(ActivityHandler):
                     if p_client:
                         sessions[conversation_id] = p_client
                         greeting = p_client.var.get("agentStart", "Agent loaded successfully!")
-                        await turn_context.send_activity(f"**{p_client.var.get('agentTitle', 'Agent')}** loaded.\n\n{greeting}")
+                        await reply(f"**{p_client.var.get('agentTitle', 'Agent')}** loaded.\n\n{greeting}")
                     else:
-                        await turn_context.send_activity(f"Failed to load agent: {init_message}")
+                        await reply(f"Failed to load agent: {init_message}")
             except Exception as e:
                 logger.error(f"Error loading agent with secret: {e}")
-                await turn_context.send_activity(f"Error loading agent: {e}")
+                await reply(f"Error loading agent: {e}")
             return
 
         # 2. Handle AIA File Uploads
-        if turn_context.activity.attachments:
-            for attachment in turn_context.activity.attachments:
+        if activity.attachments:
+            for attachment in activity.attachments:
                 if attachment.name and attachment.name.endswith(".aia"):
                     file_url = attachment.content_url
-                    async with httpx.AsyncClient() as http_client:
-                        try:
-                            # Note: Teams file downloads might require Auth headers if not public
-                            # For simplicity, we assume the URL is accessible or handle it here
-                            response = await http_client.get(file_url)
-                            response.raise_for_status()
-                            file_content = response.text
+                    try:
+                        # Note: Teams file downloads might require Auth headers if not public
+                        # For simplicity, we assume the URL is accessible or handle it here
+                        file_content = await download_aia_file(file_url)
                             
-                            if conversation_id in sessions:
-                                # Additive merge
-                                result_msg = await sessions[conversation_id].add_agent_from_aia(
-                                    file_stream=file_content
-                                )
-                                if result_msg == 'key_secret required for private version':
-                                    pending_agents[conversation_id] = {
-                                        "file_content": file_content,
-                                        "awaiting_secret": True,
-                                        "is_merge": True
-                                    }
-                                    await turn_context.send_activity("This AIA file is private and requires a secret key to merge. Please reply with the key.")
-                                    return
-                                elif "Error" not in result_msg:
-                                    await turn_context.send_activity(f"Agent merged successfully: {result_msg}")
-                                    return
-                                else:
-                                    await turn_context.send_activity(f"Could not merge agent: {result_msg}")
+                        if conversation_id in sessions:
+                            # Additive merge
+                            result_msg = await get_agent_file_cache().add_agent(
+                                sessions[conversation_id],
+                                file_stream=file_content
+                            )
+                            if result_msg == 'key_secret required for private version':
+                                pending_agents[conversation_id] = {
+                                    "file_content": file_content,
+                                    "awaiting_secret": True,
+                                    "is_merge": True
+                                }
+                                await reply("This AIA file is private and requires a secret key to merge. Please reply with the key.")
+                                return
+                            elif "Error" not in result_msg:
+                                await reply(f"Agent merged successfully: {result_msg}")
+                                return
                             else:
-                                # Load new session
-                                p_client, init_message = await AsyncPinionAIClient.create_from_stream(
-                                    file_stream=file_content,
-                                    host_url=os.environ.get("host_url")
-                                )
+                                await reply(f"Could not merge agent: {result_msg}")
+                        else:
+                            # Load new session
+                            p_client, init_message = await get_agent_file_cache().create_client(
+                                file_stream=file_content,
+                                host_url=os.environ.get("host_url")
+                            )
                                 
-                                if init_message == 'key_secret required for private version':
-                                    pending_agents[conversation_id] = {
-                                        "file_content": file_content,
-                                        "awaiting_secret": True,
-                                        "is_merge": False
-                                    }
-                                    await turn_context.send_activity("This AIA file is private and requires a secret key. Please reply with the key.")
-                                    return
-                                elif p_client:
-                                    sessions[conversation_id] = p_client
-                                    greeting = p_client.var.get("agentStart", "Agent loaded successfully!")
-                                    await turn_context.send_activity(f"**{p_client.var.get('agentTitle', 'Agent')}** loaded from file.\n\n{greeting}")
-                                    return
-                                else:
-                                    await turn_context.send_activity(f"Could not load agent: {init_message}")
-                        except Exception as e:
-                            logger.error(f"Error downloading/processing AIA file: {e}")
-                            await turn_context.send_activity(f"Error processing AIA file: {e}")
+                            if init_message == 'key_secret required for private version':
+                                pending_agents[conversation_id] = {
+                                    "file_content": file_content,
+                                    "awaiting_secret": True,
+                                    "is_merge": False
+                                }
+                                await reply("This AIA file is private and requires a secret key. Please reply with the key.")
+                                return
+                            elif p_client:
+                                sessions[conversation_id] = p_client
+                                greeting = p_client.var.get("agentStart", "Agent loaded successfully!")
+                                await reply(f"**{p_client.var.get('agentTitle', 'Agent')}** loaded from file.\n\n{greeting}")
+                                return
+                            else:
+                                await reply(f"Could not load agent: {init_message}")
+                    except Exception as e:
+                        logger.error(f"Error downloading/processing AIA file: {e}")
+                        await reply(f"Error processing AIA file: {e}")
                     return
 
         if not text:
@@ -178,39 +244,41 @@ class PinionAIBot(ActivityHandler):
         # 3. Handle Commands
         if text.lower() == "/end":
             if conversation_id in sessions:
+                await get_session_persister().flush(sessions[conversation_id])
                 await sessions[conversation_id].end_grpc_chat_session()
                 del sessions[conversation_id]
-                await turn_context.send_activity("Conversation ended and session cleared.")
+                await reply("Conversation ended and session cleared.")
             else:
-                await turn_context.send_activity("No active session to end.")
+                await reply("No active session to end.")
             return
 
         # 4. Process Message with PinionAI
         p_client = await get_client(conversation_id)
         if not p_client:
-            await turn_context.send_activity("No agent is active in this conversation. Upload an `.aia` file or ensure environment variables are set.")
+            await reply("No agent is active in this conversation. Upload an `.aia` file or ensure environment variables are set.")
             return
+        get_tracer().set_attribute("session_id", p_client.session_id)
 
         try:
             p_client.add_message_to_history("user", text)
             
             # AI Processing
             response_text = await p_client.process_user_input(text, sender="user")
-            await turn_context.send_activity(response_text)
-            await p_client.update_pinion_session()
+            await reply(response_text)
+            get_session_persister().schedule(p_client)
             
             # Handle follow-up intents
             if p_client.next_intent:
                  follow_up = await p_client.process_user_input("", sender="user")
-                 await turn_context.send_activity(follow_up)
-                 await p_client.update_pinion_session()
+                 await reply(follow_up)
+                 get_session_persister().schedule(p_client)
                  
         except PinionAIError as e:
             logger.error(f"PinionAI Error: {e}")
-            await turn_context.send_activity(f"Agent Error: {e}")
+            await reply(f"Agent Error: {e}")
         except Exception as e:
             logger.exception("Unexpected error during message processing")
-            await turn_context.send_activity(f"An unexpected error occurred: {e}")
+            await reply(f"An unexpected error occurred: {e}")
 
 BOT = PinionAIBot()
 
@@ -228,8 +296,43 @@ async def messages(request: web.Request) -> web.Response:
         return web.json_response(data=response.body, status=response.status)
     return web.Response(status=201)
 
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0) or 0)
+
+get_metrics().frontend = "teams"
+get_metrics().register_stats("sessions", sessions.stats)
+get_metrics().register_stats("pending_agents", pending_agents.stats)
+get_metrics().register_stats("dispatcher", dispatcher.stats)
+get_metrics().register_stats("session_writes", get_session_persister().stats)
+get_metrics().register_stats("aia_cache", get_agent_file_cache().stats)
+get_metrics().register_stats("tracing", get_tracer().stats)
+get_metrics().register_stats("tool_cache", get_tool_cache().stats)
+
+async def on_startup(app: web.Application):
+    """Starts warming clients for the default agent before the first message arrives."""
+    if METRICS_PORT and METRICS_PORT != PORT:
+        app["metrics_runner"] = await start_metrics_site(METRICS_PORT)
+    if config := agent_config_from_env():
+        get_client_pool(config).start()
+    app["session_sweepers"] = [asyncio.create_task(store.run_sweeper()) for store in (sessions, pending_agents)]
+    app["session_sweepers"].append(asyncio.create_task(shared.run_snapshots(SESSION_SNAPSHOT_INTERVAL)))
+
+async def on_shutdown(app: web.Application):
+    """Writes out any session updates still queued behind recent turns and closes pooled HTTP connections."""
+    for sweeper in app.get("session_sweepers", []):
+        sweeper.cancel()
+    await get_session_persister().flush_all()
+    await shared.close()
+    await close_http_clients()
+    get_tracer().shutdown()
+    if "metrics_runner" in app:
+        await app["metrics_runner"].cleanup()
+
 APP = web.Application()
 APP.router.add_post("/api/messages", messages)
+if METRICS_PORT == PORT:
+    APP.router.add_get("/metrics", metrics_handler)
+APP.on_startup.append(on_startup)
+APP.on_shutdown.append(on_shutdown)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,492 @@
+"""Agent loading helpers shared by the PinionAI front ends.
+
+AgentFileCache remembers, per AIA file content hash (plus a fingerprint of the
+key_secret for private versions), the decrypted agent for merges into existing
+sessions and whether the file needs a key_secret. It does not make loading a
+file as a new session cheaper: each load still goes through /filesession, since
+it needs its own token and server session, and pinionai has no public
+constructor that takes an already decrypted agent.
+
+AIAReader ingests AIA files incrementally with a size cap, so downloads and
+uploads are never held in memory more than once.
+
+ClientPool keeps ready-to-use clients for the env-configured agent, so a new
+conversation does not pay for authentication and agent setup on its first message.
+Each prewarmed client holds a server session, which the client API can't end, so
+idle clients are refreshed onto their own session rather than replaced.
+"""
+import os
+import copy
+import math
+import time
+import codecs
+import asyncio
+import hashlib
+import logging
+import threading
+import weakref
+from collections import OrderedDict, deque
+from pinionai import AsyncPinionAIClient
+from pinionai_http import get_http_client
+from pinionai_metrics import agent_label, get_metrics, instrument_client
+
+logger = logging.getLogger(__name__)
+
+KEY_SECRET_REQUIRED = 'key_secret required for private version'
+
+def parse_aia_header(file_text: str) -> dict | None:
+    """
+    Parses the 'aia_{version_name}_{key_id}_{datetimeiso}_{encrypted_payload}' credential
+    line. Returns None if the text does not look like an AIA file.
+    """
+    first_line = file_text.split("\n", 1)[0].strip()
+    parts = first_line.split("_", 4)
+    if len(parts) < 4 or parts[0] != "aia":
+        return None
+    return {
+        "version_name": parts[1],
+        "key_id": parts[2],
+        "date_time": parts[3],
+        "has_payload": len(parts) == 5 and bool(parts[4].strip()),
+    }
+
+AIA_PREFIX = "aia_"
+AIA_READ_CHUNK = 64 * 1024
+
+def aia_max_bytes() -> int:
+    """Largest AIA file accepted, from AIA_MAX_BYTES (default 16 MB)."""
+    return int(os.environ.get("AIA_MAX_BYTES", 16 * 1024 * 1024))
+
+class AIAReader:
+    """
+    Incrementally decodes an AIA file fed in byte chunks.
+
+    The loaders only read the file's first line (the credential line and its
+    encrypted payload), so reading stops there. Content that is not UTF-8, does
+    not start with 'aia_', or exceeds max_bytes is rejected with ValueError as
+    soon as it is seen.
+    """
+
+    def __init__(self, max_bytes: int | None = None):
+        self.max_bytes = aia_max_bytes() if max_bytes is None else max_bytes
+        self.size = 0
+        self.done = False
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._parts: list[str] = []
+        self._checked = False
+        self._head = ""
+
+    def feed(self, chunk: bytes) -> bool:
+        """Consumes chunk. Returns True once the credential line is complete."""
+        if self.done:
+            return True
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise ValueError(f"AIA file is larger than the {self.max_bytes} byte limit.")
+        self._accept(self._decode(chunk))
+        return self.done
+
+    def _decode(self, chunk: bytes, final: bool = False) -> str:
+        try:
+            return self._decoder.decode(chunk, final)
+        except UnicodeDecodeError as e:
+            raise ValueError("File is not a valid AIA file (not UTF-8 text).") from e
+
+    def _accept(self, text: str):
+        newline = text.find("\n")
+        if newline >= 0:
+            text, self.done = text[:newline], True
+        if not self._checked:
+            # Hold back the first few characters until the header can be checked.
+            self._head += text
+            head = self._head.lstrip(" \t")
+            if len(head) < len(AIA_PREFIX) and not self.done:
+                return
+            if not head.startswith(AIA_PREFIX):
+                raise ValueError("File is not a valid AIA file (missing 'aia_' header).")
+            self._checked = True
+            text, self._head = self._head, ""
+        if text:
+            self._parts.append(text)
+
+    def result(self) -> str:
+        """Returns the credential line, ready for the loaders' file_stream argument."""
+        if not self.done:
+            self.done = True
+            self._accept(self._decode(b"", final=True))
+        text = "".join(self._parts)
+        self._parts = [text]
+        return text
+
+def read_aia_file(file_obj, max_bytes: int | None = None) -> str:
+    """Reads an AIA file from a binary file object (e.g. open(path, 'rb') or an uploaded file) in chunks."""
+    reader = AIAReader(max_bytes)
+    while not reader.done:
+        chunk = file_obj.read(AIA_READ_CHUNK)
+        if not chunk:
+            break
+        reader.feed(chunk)
+    return reader.result()
+
+async def download_aia_file(url: str, headers: dict | None = None, max_bytes: int | None = None) -> str:
+    """Streams an AIA file from url through the shared HTTP client, stopping at the size cap or the end of the credential line."""
+    reader = AIAReader(max_bytes)
+    async with get_http_client(url).stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > reader.max_bytes:
+            raise ValueError(f"AIA file is larger than the {reader.max_bytes} byte limit.")
+        async for chunk in response.aiter_bytes(AIA_READ_CHUNK):
+            if reader.feed(chunk):
+                break
+    return reader.result()
+
+class _AgentFileEntry:
+    """What the cache remembers about one AIA file (and key_secret)."""
+    __slots__ = ("size", "requires_secret", "merge_data")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.requires_secret = False
+        # Decrypted agent from the file's payload, as the argument for AsyncPinionAIClient.merge_new_agent.
+        self.merge_data = None
+
+# client -> the AIA file (and key_secret) it was created from, so a stored conversation can load it again.
+_aia_sources: "weakref.WeakKeyDictionary[AsyncPinionAIClient, dict]" = weakref.WeakKeyDictionary()
+
+def aia_source(client: AsyncPinionAIClient) -> dict | None:
+    """{"file_stream", "key_secret"} for a client created by AgentFileCache.create_client, else None."""
+    return _aia_sources.get(client)
+
+def decrypted_agent_payload(client: AsyncPinionAIClient) -> dict | None:
+    """
+    The agent that create_from_stream decrypted from an AIA payload into the client's session data,
+    or None if it isn't where this client version puts it.
+    """
+    raw_session_data = getattr(client, "_raw_session_data", None)
+    if not isinstance(raw_session_data, dict):
+        return None
+    agent_data = raw_session_data.get("data", {}).get("session", {}).get("data")
+    return agent_data if isinstance(agent_data, dict) and agent_data else None
+
+class AgentFileCache:
+    """
+    A size-bounded LRU cache of what is learned from AIA files, for two things:
+
+    - merges: the decrypted agent from the file's payload, so add_agent() of a
+      file already loaded or merged goes straight to merge_new_agent() without
+      another /filesession round trip and decryption.
+    - private files: the fact that a file needs a key_secret, so uploading it
+      again without one is answered without a request.
+
+    create_client() always calls AsyncPinionAIClient.create_from_stream, so every
+    load gets its own credentials and server session; no tokens are kept.
+    """
+
+    def __init__(self, max_entries: int = 128, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _AgentFileEntry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(file_text: str, key_secret: str | None = None) -> str:
+        """Hash of the file content, plus a fingerprint of key_secret if one was given."""
+        key = hashlib.sha256(file_text.encode("utf-8")).hexdigest()
+        if key_secret:
+            key += ":" + hashlib.sha256(key_secret.encode("utf-8")).hexdigest()[:16]
+        return key
+
+    def _get(self, key: str) -> _AgentFileEntry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def _put(self, key: str, entry: _AgentFileEntry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+
+    def _remember(self, key: str, file_text: str, requires_secret: bool = False, merge_data: dict | None = None):
+        with self._lock:
+            entry = self._entries.get(key)
+        entry = entry or _AgentFileEntry(len(file_text))
+        entry.requires_secret = requires_secret
+        if merge_data is not None:
+            entry.merge_data = merge_data
+        self._put(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+    async def create_client(self, file_stream: str, host_url: str, key_secret: str | None = None) -> tuple[AsyncPinionAIClient | None, str]:
+        """
+        Same contract as AsyncPinionAIClient.create_from_stream: returns (client, message).
+        Skips the request only for a private file already known to need a key_secret.
+        """
+        start = time.perf_counter()
+        client, init_message = await self._create_client(file_stream, host_url, key_secret)
+        get_metrics().observe("aia_load", time.perf_counter() - start, agent_label(client))
+        if client:
+            _aia_sources[client] = {"file_stream": file_stream, "key_secret": key_secret}
+            instrument_client(client)
+        return client, init_message
+
+    async def _create_client(self, file_stream: str, host_url: str, key_secret: str | None) -> tuple[AsyncPinionAIClient | None, str]:
+        file_text = file_stream
+        key = self.cache_key(file_text, key_secret)
+        entry = self._get(key)
+        if entry is not None and entry.requires_secret:
+            return None, KEY_SECRET_REQUIRED
+        client, init_message = await AsyncPinionAIClient.create_from_stream(
+            file_stream=file_text,
+            host_url=host_url,
+            key_secret=key_secret
+        )
+        if client:
+            header = parse_aia_header(file_text) or {}
+            if header.get("has_payload") and (entry is None or entry.merge_data is None):
+                agent_data = decrypted_agent_payload(client)
+                if agent_data is not None:
+                    merge_data = copy.deepcopy(agent_data if "agent" in agent_data else {"agent": agent_data})
+                    self._remember(key, file_text, merge_data=merge_data)
+        elif init_message == KEY_SECRET_REQUIRED:
+            self._remember(key, file_text, requires_secret=True)
+        return client, init_message
+
+    async def add_agent(self, client: AsyncPinionAIClient, file_stream: str, key_secret: str | None = None) -> str:
+        """Same contract as AsyncPinionAIClient.add_agent_from_aia: returns a success or error message."""
+        with get_metrics().time("aia_merge", agent_label(client)):
+            return await self._add_agent(client, file_stream, key_secret)
+
+    async def _add_agent(self, client: AsyncPinionAIClient, file_stream: str, key_secret: str | None) -> str:
+        file_text = file_stream
+        key = self.cache_key(file_text, key_secret)
+        entry = self._get(key)
+        if entry is not None and entry.requires_secret:
+            return KEY_SECRET_REQUIRED
+        if entry is not None and entry.merge_data is not None:
+            await client.merge_new_agent(copy.deepcopy(entry.merge_data))
+            return 'Agent merged successfully.'
+        result_msg = await client.add_agent_from_aia(file_stream=file_text, key_secret=key_secret)
+        if result_msg == KEY_SECRET_REQUIRED:
+            self._remember(key, file_text, requires_secret=True)
+        return result_msg
+
+_agent_file_cache: AgentFileCache | None = None
+_agent_file_cache_lock = threading.Lock()
+
+def get_agent_file_cache() -> AgentFileCache:
+    """Returns the process-wide AgentFileCache, sized by AIA_CACHE_MAX_ENTRIES and AIA_CACHE_MAX_BYTES."""
+    global _agent_file_cache
+    with _agent_file_cache_lock:
+        if _agent_file_cache is None:
+            _agent_file_cache = AgentFileCache(
+                max_entries=int(os.environ.get("AIA_CACHE_MAX_ENTRIES", 128)),
+                max_bytes=int(os.environ.get("AIA_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+            )
+    return _agent_file_cache
+
+def joining_session_data(session_id: str) -> dict:
+    """
+    Placeholder session data for AsyncPinionAIClient.create(), which starts a new server
+    session unless it is given some. It joins session_id with no agent configured;
+    sync_session_from_server() then replaces it with the session's real data.
+    """
+    return {"data": {"session": {"uid": session_id}}}
+
+def agent_config_from_env() -> dict | None:
+    """Returns AsyncPinionAIClient.create() kwargs from agent_id/host_url/client_id/client_secret, or None if any is unset."""
+    config = {
+        "agent_id": os.environ.get("agent_id"),
+        "host_url": os.environ.get("host_url"),
+        "client_id": os.environ.get("client_id"),
+        "client_secret": os.environ.get("client_secret"),
+    }
+    if not all(config.values()):
+        return None
+    config["version"] = os.environ.get("version", None)  # draft, development, test, live, archived. None loads latest in progress.
+    return config
+
+class ClientPool:
+    """
+    A pool of prewarmed AsyncPinionAIClient instances for one agent configuration.
+
+    Clients are bound to the event loop that created them, so a pool belongs to
+    a single loop. acquire() hands out a ready client when one is available
+    (creating one inline otherwise) and tops the pool back up in the background.
+    The target size follows demand: min_size plus the session-creation rate over
+    the last `rate_window` seconds times the observed creation latency, capped
+    at max_size.
+
+    Every prewarmed client opens a server session, and the client API has no way
+    to end one. So a client idle longer than max_idle is not discarded for a new
+    one: when it is next handed out, it is re-authenticated onto its own session
+    and its agent data synced. Only clients whose refresh fails are dropped, and
+    close() leaves the sessions of clients still idle to the server to expire.
+    """
+
+    def __init__(self, config: dict, min_size: int = 1, max_size: int = 8, max_idle: float = 600, rate_window: float = 60):
+        self.config = config
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.max_idle = max_idle
+        self.rate_window = rate_window
+        self._ready: deque[tuple[float, AsyncPinionAIClient]] = deque()
+        self._creating = 0
+        self._acquired_at: deque[float] = deque()
+        self._create_seconds = 2.0  # EWMA of AsyncPinionAIClient.create() latency.
+        self._refill_task: asyncio.Task | None = None
+        self._failures = 0
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+
+    def target_size(self) -> int:
+        now = time.monotonic()
+        while self._acquired_at and now - self._acquired_at[0] > self.rate_window:
+            self._acquired_at.popleft()
+        rate = len(self._acquired_at) / self.rate_window
+        # Enough clients to cover demand while replacements are being created, plus the floor.
+        return min(self.max_size, self.min_size + math.ceil(rate * self._create_seconds))
+
+    async def _create(self) -> AsyncPinionAIClient:
+        start = time.monotonic()
+        client = await AsyncPinionAIClient.create(**self.config)
+        elapsed = time.monotonic() - start
+        self._create_seconds = 0.8 * self._create_seconds + 0.2 * elapsed
+        get_metrics().observe("create_client", elapsed, agent_label(client))
+        return instrument_client(client)
+
+    async def acquire(self) -> AsyncPinionAIClient:
+        """Returns a client with its own unused session, preferring the most recently prewarmed one."""
+        self._acquired_at.append(time.monotonic())
+        client = None
+        if self._ready:
+            created_at, client = self._ready.pop()
+            if time.monotonic() - created_at > self.max_idle:
+                client = await self._refresh(client)
+        if client is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            client = await self._create()
+        self.start()
+        return client
+
+    async def _refresh(self, client: AsyncPinionAIClient) -> AsyncPinionAIClient | None:
+        """A client for an idle client's server session, with a new token and current agent data, or None if that fails."""
+        session_id = client.session_id
+        await self._close_client(client)
+        refreshed = None
+        try:
+            refreshed = await AsyncPinionAIClient.create(**self.config, session_id=session_id, raw_session_data=joining_session_data(session_id))
+            if not await refreshed.sync_session_from_server():
+                raise RuntimeError(f"could not sync session {session_id}")
+        except Exception as e:
+            logger.warning(f"Could not refresh idle prewarmed client; creating a new one: {e}")
+            if refreshed is not None:
+                await self._close_client(refreshed)
+            return None
+        self.refreshed += 1
+        return instrument_client(refreshed)
+
+    async def _close_client(self, client: AsyncPinionAIClient):
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled client: {e}")
+
+    def start(self):
+        """Starts a background refill up to target_size() if one is not already running."""
+        if self._closed or (self._refill_task is not None and not self._refill_task.done()):
+            return
+        self._refill_task = asyncio.get_running_loop().create_task(self._refill())
+
+    async def _refill(self):
+        while not self._closed and len(self._ready) + self._creating < self.target_size():
+            self._creating += 1
+            try:
+                client = await self._create()
+            except Exception as e:
+                self._failures += 1
+                logger.warning(f"Prewarming PinionAI client failed ({self._failures} in a row): {e}")
+                # Back off and let the next acquire() restart refilling.
+                await asyncio.sleep(min(60, 2 ** self._failures))
+                return
+            finally:
+                self._creating -= 1
+            self._failures = 0
+            if self._closed:
+                await client.close()
+                return
+            self._ready.append((time.monotonic(), client))
+
+    async def close(self):
+        """Stops refilling and closes every idle client."""
+        self._closed = True
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+        while self._ready:
+            _, client = self._ready.popleft()
+            await self._close_client(client)
+
+    def stats(self) -> dict:
+        return {"ready": len(self._ready), "creating": self._creating, "target": self.target_size(), "hits": self.hits, "misses": self.misses, "refreshed": self.refreshed}
+
+_client_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+_client_pools_lock = threading.Lock()
+
+def get_client_pool(config: dict) -> ClientPool:
+    """
+    Returns the running loop's ClientPool for config, sized by CLIENT_POOL_MIN_SIZE,
+    CLIENT_POOL_MAX_SIZE and CLIENT_POOL_MAX_IDLE. Must be called on an event loop.
+    """
+    loop = asyncio.get_running_loop()
+    key = tuple(sorted((k, v) for k, v in config.items() if v is not None))
+    with _client_pools_lock:
+        pools = _client_pools.setdefault(loop, {})
+        pool = pools.get(key)
+        if pool is None:
+            pool = pools[key] = ClientPool(
+                config,
+                min_size=int(os.environ.get("CLIENT_POOL_MIN_SIZE", 1)),
+                max_size=int(os.environ.get("CLIENT_POOL_MAX_SIZE", 8)),
+                max_idle=float(os.environ.get("CLIENT_POOL_MAX_IDLE", 600)),
+            )
+    return pool
+
+async def acquire_client(config: dict) -> AsyncPinionAIClient:
+    """Gets a ready client for config from the running loop's warm pool."""
+    return await get_client_pool(config).acquire()
+
+async def close_client_pools():
+    """Closes every ClientPool owned by the running event loop."""
+    with _client_pools_lock:
+        pools = _client_pools.pop(asyncio.get_running_loop(), {})
+    for pool in pools.values():
+        await pool.close()
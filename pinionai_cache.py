@@ -0,0 +1,452 @@
+"""Process-wide caches shared by the PinionAI front ends.
+
+AudioCache stores synthesized text-to-speech audio keyed by the normalized text
+and the agent's voice configuration, so greetings and canned replies that repeat
+across sessions are synthesized once.
+
+ToolCache and TokenBucket sit in front of extension tools (see cached_tool):
+repeated calls with the same arguments are answered from memory for a
+per-tool TTL, and calls to a quota-limited provider are paced, falling back
+to the last known result while the quota is exhausted.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import inspect
+import logging
+import functools
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable
+
+if TYPE_CHECKING:
+    # pinionai imports pinionai_extensions, which imports this module; keep the import out of that cycle.
+    from pinionai import AsyncPinionAIClient
+
+logger = logging.getLogger(__name__)
+
+class AudioCache:
+    """
+    A bytes-capped LRU cache of synthesized audio, with an optional on-disk tier.
+
+    Memory holds up to max_bytes of audio. If directory is set, audio is also
+    written there (bounded by max_disk_bytes, oldest files pruned first) so it
+    survives restarts and is shared by processes on the same host.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, directory: str | None = None, max_disk_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def cache_key(client: "AsyncPinionAIClient", text: str) -> str:
+        """Hash of the whitespace-normalized text and the client's TTS voice settings."""
+        tts_audio_name = client.var.get("ttsAudio")
+        tts_config = client._audios_cache.get(tts_audio_name) if tts_audio_name else None
+        voice = {"ttsAudio": tts_audio_name, "config": tts_config, "ttsServer": client.var.get("ttsServer")}
+        normalized = " ".join(str(text).split())
+        payload = json.dumps([normalized, voice], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.audio")
+
+    def get(self, key: str) -> bytes | None:
+        """Returns cached audio from memory, or None."""
+        with self._lock:
+            audio = self._entries.get(key)
+            if audio is not None:
+                self._entries.move_to_end(key)
+            return audio
+
+    def put(self, key: str, audio: bytes):
+        """Stores audio in memory, evicting least recently used entries past max_bytes."""
+        if not audio or len(audio) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = audio
+            self._bytes += len(audio)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def _read_disk(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), "rb") as f:
+                audio = f.read()
+            os.utime(self._path(key))  # Mark as recently used for pruning.
+            return audio or None
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Could not read cached audio {key}: {e}")
+            return None
+
+    def _write_disk(self, key: str, audio: bytes):
+        try:
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio)
+            os.replace(tmp_path, self._path(key))
+            self._prune_disk()
+        except OSError as e:
+            logger.warning(f"Could not write cached audio {key}: {e}")
+
+    def _prune_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".audio"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+    async def synthesize(self, client: "AsyncPinionAIClient", text: str) -> bytes:
+        """Drop-in for client.convert_text_to_audio(text) that serves repeated phrases from cache."""
+        if not text or not str(text).strip():
+            return b''
+        key = self.cache_key(client, text)
+        audio = self.get(key)
+        if audio is None and self.directory:
+            audio = await asyncio.to_thread(self._read_disk, key)
+            if audio is not None:
+                self.put(key, audio)
+        if audio is not None:
+            with self._lock:
+                self.hits += 1
+            return audio
+
+        # Identical requests already being synthesized on this loop share one call.
+        inflight_key = (id(asyncio.get_running_loop()), key)
+        pending = self._inflight.get(inflight_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        with self._lock:
+            self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[inflight_key] = future
+        try:
+            audio = await client.convert_text_to_audio(text)
+            if audio:
+                self.put(key, audio)
+                if self.directory:
+                    await asyncio.to_thread(self._write_disk, key, audio)
+            future.set_result(audio)
+            return audio
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters re-raise it; consume it here so it is not reported as unretrieved.
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(inflight_key, None)
+
+_audio_cache: AudioCache | None = None
+_audio_cache_lock = threading.Lock()
+
+def get_audio_cache() -> AudioCache:
+    """Returns the process-wide AudioCache, configured by TTS_CACHE_MAX_BYTES, TTS_CACHE_DIR and TTS_CACHE_MAX_DISK_BYTES."""
+    global _audio_cache
+    with _audio_cache_lock:
+        if _audio_cache is None:
+            _audio_cache = AudioCache(
+                max_bytes=int(os.environ.get("TTS_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+                directory=os.environ.get("TTS_CACHE_DIR") or None,
+                max_disk_bytes=int(os.environ.get("TTS_CACHE_MAX_DISK_BYTES", 256 * 1024 * 1024)),
+            )
+    return _audio_cache
+
+class ToolRateLimited(Exception):
+    """Raised by cached_tool when a rate-limited call could not get a token in time and nothing is cached."""
+
+class TokenBucket:
+    """
+    Paces calls to `rate` per `per` seconds on average, allowing bursts of up to `capacity`.
+
+    Thread-safe, so one bucket can guard a provider's quota for every event loop
+    in the process. acquire() waits asynchronously for the next token.
+    """
+
+    def __init__(self, rate: float, per: float = 60.0, capacity: float | None = None):
+        self.rate = rate / per
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.waited = 0
+        self.timed_out = 0
+
+    def _take(self) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.granted += 1
+                return 0.0
+            return (1 - self._tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def try_acquire(self) -> bool:
+        return self._take() == 0.0
+
+    async def acquire(self, timeout: float | None = None) -> bool:
+        """Waits for a token. Returns False if none becomes available within timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        while True:
+            wait = self._take()
+            if wait == 0.0:
+                if waited:
+                    with self._lock:
+                        self.waited += 1
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                with self._lock:
+                    self.timed_out += 1
+                return False
+            waited = True
+            await asyncio.sleep(wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tokens": self._tokens, "granted": self.granted, "waited": self.waited, "timed_out": self.timed_out}
+
+_rate_limiters: dict[str, TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name: str, rate: float, per: float = 60.0, capacity: float | None = None) -> TokenBucket:
+    """Returns the process-wide TokenBucket for a provider, creating it with the given quota on first use."""
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(name)
+        if limiter is None:
+            limiter = _rate_limiters[name] = TokenBucket(rate, per, capacity)
+    return limiter
+
+_MISSING = object()
+
+class ToolCache:
+    """
+    A bounded LRU cache of extension tool results, keyed by tool name and normalized arguments.
+
+    Each entry is fresh for the TTL its tool gave it. Expired entries are kept
+    until evicted (least recently used first, past max_entries or max_bytes) so
+    they can be served as stale data when the provider is rate limited or fails.
+    Identical calls in flight on the same event loop share one upstream request.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, list] = OrderedDict()  # key -> [value, expires_at, size]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.stale = 0
+        self.rate_limited = 0
+
+    @staticmethod
+    def cache_key(tool: str, arguments: dict) -> str:
+        payload = json.dumps([tool, arguments], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, allow_stale: bool = False):
+        """Returns the cached value, or _MISSING if there is none (or only an expired one and allow_stale is False)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (not allow_stale and time.monotonic() > entry[1]):
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, value, ttl: float):
+        size = len(str(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[key] = [value, time.monotonic() + ttl, size]
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+
+    def _serve_stale(self, key: str, tool: str, reason: str):
+        value = self.get(key, allow_stale=True)
+        if value is not _MISSING:
+            with self._lock:
+                self.stale += 1
+            logger.info(f"Serving cached {tool} result past its TTL ({reason}).")
+        return value
+
+    async def call(
+        self,
+        tool: str,
+        key: str,
+        fetch: Callable[[], Any],
+        ttl: float,
+        limiter: TokenBucket | None = None,
+        max_wait: float | None = None,
+        accept: Callable[[Any], bool] | None = None,
+    ):
+        """
+        Returns the cached result for key, or awaits fetch() and caches what it returns.
+
+        With a limiter, a call that finds no token serves stale data if there is
+        any, and otherwise waits up to max_wait seconds for a token before
+        raising ToolRateLimited. Results rejected by accept() (e.g. error
+        payloads) are not cached, and stale data is returned instead if available.
+        """
+        value = self.get(key)
+        if value is not _MISSING:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        inflight_key = (id(asyncio.get_running_loop()), key)
+        pending = self._inflight.get(inflight_key)
+        if pending is not None:
+            with self._lock:
+                self.shared += 1
+            return await asyncio.shield(pending)
+        with self._lock:
+            self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[inflight_key] = future
+        try:
+            value = await self._fetch(tool, key, fetch, ttl, limiter, max_wait, accept)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters re-raise it; consume it here so it is not reported as unretrieved.
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(inflight_key, None)
+
+    async def _fetch(self, tool, key, fetch, ttl, limiter, max_wait, accept):
+        if limiter is not None and not limiter.try_acquire():
+            stale = self._serve_stale(key, tool, "rate limited")
+            if stale is not _MISSING:
+                return stale
+            if not await limiter.acquire(max_wait):
+                with self._lock:
+                    self.rate_limited += 1
+                raise ToolRateLimited(f"{tool} is rate limited; no call slot became available within {max_wait} seconds.")
+        value = await fetch()
+        if accept is None or accept(value):
+            self.put(key, value, ttl)
+            return value
+        stale = self._serve_stale(key, tool, "the provider returned an unusable result")
+        return value if stale is _MISSING else stale
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared": self.shared,
+                "stale": self.stale,
+                "rate_limited": self.rate_limited,
+            }
+
+_tool_cache: ToolCache | None = None
+_tool_cache_lock = threading.Lock()
+
+def get_tool_cache() -> ToolCache:
+    """Returns the process-wide ToolCache, bounded by TOOL_CACHE_MAX_ENTRIES and TOOL_CACHE_MAX_BYTES."""
+    global _tool_cache
+    with _tool_cache_lock:
+        if _tool_cache is None:
+            _tool_cache = ToolCache(
+                max_entries=int(os.environ.get("TOOL_CACHE_MAX_ENTRIES", 1024)),
+                max_bytes=int(os.environ.get("TOOL_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+            )
+    return _tool_cache
+
+def normalize_arguments(arguments: dict) -> dict:
+    """Default cache-key normalization: drops None arguments and trims surrounding whitespace from strings."""
+    return {name: value.strip() if isinstance(value, str) else value for name, value in arguments.items() if value is not None}
+
+def cached_tool(
+    ttl: float | Callable[[dict], float],
+    limiter: TokenBucket | Callable[[dict], TokenBucket] | None = None,
+    max_wait: float | Callable[[], float] | None = 30,
+    normalize: Callable[[dict], dict] = normalize_arguments,
+    exclude: tuple[str, ...] = (),
+    accept: Callable[[Any], bool] | None = None,
+    on_rate_limited: Callable[[ToolRateLimited], Any] | None = None,
+):
+    """
+    Caches an async extension tool's results in get_tool_cache().
+
+    ttl is seconds, or a function of the normalized arguments (e.g. longer for
+    reference data than for quotes). Arguments named in exclude (e.g. API keys)
+    are left out of the cache key. limiter paces calls that miss the cache: a
+    TokenBucket, or a function of all the call's arguments that returns one
+    (e.g. one bucket per API key). max_wait may be a function, so it can be read
+    from the environment at call time. If a call is rate limited with nothing
+    cached, on_rate_limited(error) provides the result; otherwise
+    ToolRateLimited is raised.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = normalize({name: value for name, value in bound.arguments.items() if name not in exclude})
+            bucket = limiter(dict(bound.arguments)) if callable(limiter) and not isinstance(limiter, TokenBucket) else limiter
+            try:
+                return await get_tool_cache().call(
+                    func.__name__,
+                    ToolCache.cache_key(func.__name__, arguments),
+                    lambda: func(*args, **kwargs),
+                    ttl(arguments) if callable(ttl) else ttl,
+                    limiter=bucket,
+                    max_wait=max_wait() if callable(max_wait) else max_wait,
+                    accept=accept,
+                )
+            except ToolRateLimited as e:
+                if on_rate_limited is None:
+                    raise
+                logger.warning(str(e))
+                return on_rate_limited(e)
+        return wrapper
+    return decorator
@@ -0,0 +1,49 @@
+"""Streamlit chat rendering helpers for chat.py.
+
+Long conversations are rendered as a window of the most recent turns, with a
+"load earlier" button that pages older history in on demand, so script time on
+each rerun no longer grows with the full conversation length. A turn starts at
+a user message and includes the replies after it, so pages never split one.
+"""
+import os
+import json
+import streamlit as st
+
+# User turns rendered per history page. 0 renders the whole conversation.
+CHAT_HISTORY_WINDOW = int(os.environ.get("CHAT_HISTORY_WINDOW", 20))
+
+def message_markdown(content) -> str:
+    """Returns the markdown shown for a message's content; structured content is shown as JSON."""
+    if isinstance(content, str):
+        return content
+    if content is None:
+        return ""
+    if isinstance(content, (dict, list)):
+        return f"```json\n{json.dumps(content, indent=2, default=str)}\n```"
+    return str(content)
+
+def visible_history(messages: list, window: int, pages: int) -> tuple[int, list]:
+    """Returns (hidden_count, visible_messages) for the newest window * pages turns, each starting at a user message."""
+    if window <= 0:
+        return 0, messages
+    turn_starts = [i for i, message in enumerate(messages) if message.get("role") == "user"]
+    hidden_turns = len(turn_starts) - window * max(1, pages)
+    if hidden_turns <= 0:
+        return 0, messages
+    hidden = turn_starts[hidden_turns]
+    return hidden, messages[hidden:]
+
+def display_chat_messages(messages, user_img, assistant_img, window: int = CHAT_HISTORY_WINDOW, state_key: str = "history_pages"):
+    """Displays the most recent chat messages, with a button to page in earlier ones."""
+    pages = st.session_state.get(state_key, 1)
+    hidden, visible = visible_history(messages, window, pages)
+    chat_container = st.container()
+    with chat_container:
+        if hidden:
+            if st.button(f"Load earlier messages ({hidden} hidden)", key=f"{state_key}_load_earlier"):
+                st.session_state[state_key] = pages + 1
+                st.rerun()
+        for message in visible:
+            avatar = user_img if message["role"] == "user" else assistant_img
+            with st.chat_message(message["role"], avatar=avatar):
+                st.markdown(message_markdown(message["content"]))
@@ -1,7 +1,13 @@
 import json
+import hashlib
 import httpx
+import asyncio
 import logging
+import os
 import random
+from pinionai_http import get_http_client
+from pinionai_cache import cached_tool, get_rate_limiter
+from pinionai_tracing import traced
 from google.genai import types as google_genai_types
 from google.genai.types import (FunctionDeclaration, GenerateContentConfig,
                                 GoogleSearch, HarmBlockThreshold, HarmCategory,
@@ -9,8 +15,60 @@ from google.genai.types import (FunctionDeclaration, GenerateContentConfig,
 
 # This page is used to add pinionai function extensions so they can be be used in the PinionAIClient. 
 # Add functions here and can call them by creating functional declarations for each in the administration Tools page.
+# Decorate them with @traced("tool.<name>") so each call shows up as a span of the turn that made it.
+# Tools that call a metered API can add @cached_tool(...) below it to reuse recent results and pace calls.
+
+# Alpha Vantage quotas are per API key (the free tier allows 5 calls per minute), so every
+# tool that calls it shares one bucket per key.
+def alphavantage_limiter(arguments: dict):
+    api_key = arguments.get("alphavantage_key") or ""
+    key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return get_rate_limiter(f"alphavantage:{key_id}", float(os.environ.get("ALPHAVANTAGE_CALLS_PER_MINUTE", 5)))
+
+def tool_rate_limit_max_wait() -> float:
+    return float(os.environ.get("TOOL_RATE_LIMIT_MAX_WAIT", 15))
+
+def alphavantage_notice(stock_data: dict) -> str | None:
+    """The error, quota or empty-result notice in an Alpha Vantage response, or None if it carries data."""
+    if "Error Message" in stock_data:
+        return f"API Error: {stock_data['Error Message']}"
+    # Quota responses: "Information" currently, "Note" on older API versions.
+    if "Information" in stock_data:
+        return f"API Info: {stock_data['Information']}"
+    if "Note" in stock_data:
+        return f"API Note: {stock_data['Note']}"
+    if "Global Quote" in stock_data and not stock_data["Global Quote"]:
+        return "API Error: No quote returned for this symbol."
+    return None
+
+def stock_cache_ttl(arguments: dict) -> float:
+    # Quotes and intraday series move; company overviews change at most daily.
+    if arguments.get("stock_lookup_function") == "OVERVIEW":
+        return float(os.environ.get("STOCK_OVERVIEW_CACHE_TTL", 6 * 60 * 60))
+    return float(os.environ.get("STOCK_CACHE_TTL", 60))
+
+def normalize_stock_arguments(arguments: dict) -> dict:
+    arguments = {k: v.strip() for k, v in arguments.items() if isinstance(v, str)}
+    for name in ("stock_lookup_function", "stock_symbol"):
+        if name in arguments:
+            arguments[name] = arguments[name].upper()
+    return arguments
+
+def is_stock_result(result) -> bool:
+    # Errors come back as dicts, and quota or bad-symbol responses as "**API ...:**" text; don't cache either.
+    return isinstance(result, str) and not result.startswith(("**API", "**Client Error", "Error:"))
 
 # Stock Market Tool
+@traced("tool.get_stock_data")
+@cached_tool(
+    ttl=stock_cache_ttl,
+    limiter=alphavantage_limiter,
+    max_wait=tool_rate_limit_max_wait,
+    normalize=normalize_stock_arguments,
+    exclude=("alphavantage_key",),
+    accept=is_stock_result,
+    on_rate_limited=lambda e: {"error": "Rate limit exceeded", "message": str(e)},
+)
 async def get_stock_data(
     stock_lookup_function: str | None = None,
     stock_symbol: str | None = None,
@@ -29,14 +87,13 @@ async def get_stock_data(
     }
     params = {k: v for k, v in params.items() if v is not None}
     try:
-        async with httpx.AsyncClient() as client:
-            base_url = 'https://www.alphavantage.co/query'
-            response = await client.get(base_url, params=params, headers={"User-Agent": "none"})
-            logging.debug(f"Stock check Response URL: {response.url}")
-            response.raise_for_status()
-            # convert to markdown
-            stock_data = response.json()
-            return await format_stock_data_as_markdown(stock_data)
+        base_url = 'https://www.alphavantage.co/query'
+        response = await get_http_client(base_url).get(base_url, params=params, headers={"User-Agent": "none"})
+        logging.debug(f"Stock check Response URL: {response.url}")
+        response.raise_for_status()
+        # convert to markdown
+        stock_data = response.json()
+        return await format_stock_data_as_markdown(stock_data)
     except httpx.HTTPStatusError as http_err:
         logging.error(f"HTTP error occurred: {http_err} - {http_err.response.text}")
         return {"error": f"HTTP error: {http_err.response.status_code}", "message": http_err.response.text}
@@ -44,7 +101,60 @@ async def get_stock_data(
         logging.error(f"An unexpected error occurred: {e}")
         return {"error": "An unexpected error occurred.", "message": str(e)}
 
+# Multi-symbol Stock Quote Tool
+@traced("tool.get_stock_quotes")
+async def get_stock_quotes(
+    stock_symbols: list[str] | str | None = None,
+    alphavantage_key: str | None = None,
+) -> str:
+    """
+    Fetches current quotes for several symbols concurrently and returns them as one markdown table.
+    Accepts a list of symbols or a comma/space separated string, so one tool call replaces N get_stock_data calls.
+    """
+    if isinstance(stock_symbols, str):
+        stock_symbols = stock_symbols.replace(",", " ").split()
+    symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in stock_symbols or [] if symbol and symbol.strip()))
+    if not symbols:
+        return "Error: No stock symbols provided."
+
+    # Bounded so a long list doesn't open a connection per symbol; requests share the pooled client.
+    semaphore = asyncio.Semaphore(int(os.environ.get("STOCK_QUOTES_CONCURRENCY", 5)))
+    async def fetch(symbol):
+        async with semaphore:
+            return await fetch_global_quote(symbol, alphavantage_key)
+    quotes = await asyncio.gather(*(fetch(symbol) for symbol in symbols))
+    return await format_stock_quotes_as_markdown(dict(zip(symbols, quotes)))
+
+@traced("alphavantage.global_quote")
+@cached_tool(
+    ttl=stock_cache_ttl,
+    limiter=alphavantage_limiter,
+    max_wait=tool_rate_limit_max_wait,
+    normalize=normalize_stock_arguments,
+    exclude=("alphavantage_key",),
+    accept=lambda result: bool(isinstance(result, dict) and result.get("Global Quote")),
+    on_rate_limited=lambda e: {"error": "Rate limit exceeded", "message": str(e)},
+)
+async def fetch_global_quote(stock_symbol: str, alphavantage_key: str | None = None) -> dict:
+    """
+    Fetches the raw Alpha Vantage GLOBAL_QUOTE response for one symbol, or an error dict.
+    """
+    params = {"function": "GLOBAL_QUOTE", "symbol": stock_symbol, "apikey": alphavantage_key}
+    params = {k: v for k, v in params.items() if v is not None}
+    try:
+        base_url = 'https://www.alphavantage.co/query'
+        response = await get_http_client(base_url).get(base_url, params=params, headers={"User-Agent": "none"})
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPStatusError as http_err:
+        logging.error(f"HTTP error occurred for {stock_symbol}: {http_err} - {http_err.response.text}")
+        return {"error": f"HTTP error: {http_err.response.status_code}", "message": http_err.response.text}
+    except Exception as e:
+        logging.error(f"An unexpected error occurred for {stock_symbol}: {e}")
+        return {"error": "An unexpected error occurred.", "message": str(e)}
+
 # Generate Password Tool    
+@traced("tool.generate_password")
 async def generate_password(length: int = 12) -> str:
         if length < 6: length = 6 # Ensure space for all char types
         digits_chars = '0123456789'
@@ -74,11 +184,11 @@ async def format_stock_data_as_markdown(stock_data: dict) -> str:
     if not isinstance(stock_data, dict):
         return "Error: Invalid data format. Expected a dictionary."
 
-    # Handle potential error messages from the API
-    if "Error Message" in stock_data:
-        return f"**API Error:** {stock_data['Error Message']}"
-    if "Information" in stock_data:
-        return f"**API Info:** {stock_data['Information']}"
+    # Handle error and quota messages from the API before anything is formatted as data
+    notice = alphavantage_notice(stock_data)
+    if notice is not None:
+        label, _, text = notice.partition(": ")
+        return f"**{label}:** {text}"
     if "error" in stock_data:
         return f"**Client Error:** {stock_data.get('message', 'An unknown error occurred.')}"
 
@@ -137,4 +247,36 @@ async def format_stock_data_as_markdown(stock_data: dict) -> str:
     markdown_parts.append(json.dumps(stock_data, indent=2))
     markdown_parts.append("```")
     
+    return "\n".join(markdown_parts)
+
+# Makes multi-symbol quote output pretty
+async def format_stock_quotes_as_markdown(quotes: dict) -> str:
+    """
+    Formats {symbol: GLOBAL_QUOTE response} from get_stock_quotes into one markdown table,
+    with a row per symbol. Symbols that failed get a row noting why.
+    """
+    markdown_parts = [
+        "### Stock Quotes",
+        "| Symbol | Price | Change | Change % | Open | High | Low | Volume | Latest Trading Day |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    for symbol, stock_data in quotes.items():
+        quote = stock_data.get("Global Quote") if isinstance(stock_data, dict) else None
+        if quote:
+            markdown_parts.append(
+                f"| {quote.get('01. symbol', symbol)} | ${quote.get('05. price', 'N/A')} | {quote.get('09. change', 'N/A')} "
+                f"| {quote.get('10. change percent', 'N/A')} | {quote.get('02. open', 'N/A')} | {quote.get('03. high', 'N/A')} "
+                f"| {quote.get('04. low', 'N/A')} | {quote.get('06. volume', 'N/A')} | {quote.get('07. latest trading day', 'N/A')} |"
+            )
+            continue
+        if not isinstance(stock_data, dict):
+            reason = "Invalid data format."
+        elif alphavantage_notice(stock_data) is not None:
+            reason = alphavantage_notice(stock_data)
+        elif "error" in stock_data:
+            reason = f"{stock_data['error']}: {stock_data.get('message', '')}".rstrip(": ")
+        else:
+            reason = "No quote returned for this symbol."
+        reason = " ".join(reason.replace("|", "/").split())
+        markdown_parts.append(f"| {symbol} | {reason} | | | | | | | |")
     return "\n".join(markdown_parts)
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""Shared, pooled HTTP clients for the PinionAI front ends and extensions.
+
+Each event loop keeps one httpx.AsyncClient per origin (scheme://host:port),
+so repeated AIA downloads and tool calls reuse kept-alive connections instead
+of paying a fresh TCP and TLS handshake per request. Connection limits apply
+per origin, and HTTP/2 is negotiated when the `h2` package is installed.
+"""
+import os
+import asyncio
+import logging
+import threading
+import weakref
+import importlib.util
+from urllib.parse import urlsplit
+import httpx
+
+logger = logging.getLogger(__name__)
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, httpx.AsyncClient]]" = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+def _new_client() -> httpx.AsyncClient:
+    http2 = HTTP2_AVAILABLE and os.environ.get("HTTP2", "true").lower() not in ("0", "false", "no")
+    limits = httpx.Limits(
+        max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", 20)),
+        max_keepalive_connections=int(os.environ.get("HTTP_MAX_KEEPALIVE_PER_HOST", 10)),
+        keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60)),
+    )
+    return httpx.AsyncClient(http2=http2, limits=limits, timeout=float(os.environ.get("HTTP_TIMEOUT", 5)))
+
+def get_http_client(url: str) -> httpx.AsyncClient:
+    """
+    Returns the running loop's pooled client for url's origin, creating it on first use.
+
+    Do not close the returned client or use it in `async with`; it is shared.
+    Call close_http_clients() when the loop shuts down.
+    """
+    loop = asyncio.get_running_loop()
+    origin = _origin(url)
+    with _clients_lock:
+        clients = _clients.setdefault(loop, {})
+        client = clients.get(origin)
+        if client is None or client.is_closed:
+            client = clients[origin] = _new_client()
+    return client
+
+async def close_http_clients():
+    """Closes every pooled client owned by the running event loop."""
+    with _clients_lock:
+        clients = _clients.pop(asyncio.get_running_loop(), {})
+    for origin, client in clients.items():
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"Error closing HTTP client for {origin}: {e}")
+
+def http_client_stats() -> dict:
+    """Number of pooled clients per event loop, keyed by origin."""
+    with _clients_lock:
+        return {"loops": len(_clients), "origins": sorted({origin for clients in _clients.values() for origin in clients})}
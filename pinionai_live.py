@@ -0,0 +1,262 @@
+"""Live-agent (gRPC transfer) helpers shared by the PinionAI front ends.
+
+AsyncPinionAIClient's gRPC listener appends each incoming agent message to
+`client.chat_messages`. The helpers here hook that list so waiting code is woken
+the moment a message lands, instead of sleeping and re-checking timestamps.
+
+LiveAgentBridge builds on the same hook to push live-agent messages for many
+conversations to an async front end (e.g. the Slack bot) as they arrive.
+"""
+import time
+import asyncio
+import logging
+import threading
+import weakref
+from collections import deque
+from typing import Any, Awaitable, Callable
+from pinionai import AsyncPinionAIClient
+from pinionai_runtime import ConversationDispatcher
+
+logger = logging.getLogger(__name__)
+
+class LiveUpdateNotifier:
+    """Counts incoming live-agent messages and wakes threads waiting for the next one."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._version = 0
+        self._subscribers: list[Callable[[dict, bool], None]] = []
+
+    @property
+    def version(self) -> int:
+        with self._condition:
+            return self._version
+
+    def notify(self):
+        """Records a new message and wakes waiting threads. Safe to call from the event loop thread."""
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all()
+
+    def publish(self, message: dict, from_grpc: bool):
+        """Passes an appended message to subscribers as callback(message, from_grpc)."""
+        with self._condition:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(message, from_grpc)
+            except Exception as e:
+                logger.error(f"Live update subscriber failed: {e}")
+
+    def subscribe(self, callback: Callable[[dict, bool], None]) -> Callable[[], None]:
+        """Calls callback(message, from_grpc) for each appended message. Returns a function that unsubscribes."""
+        with self._condition:
+            self._subscribers.append(callback)
+
+        def unsubscribe():
+            with self._condition:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+        return unsubscribe
+
+    def wait(self, since_version: int, timeout: float) -> bool:
+        """Blocks until a message newer than since_version arrives. Returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._version > since_version, timeout=max(timeout, 0))
+
+class _NotifyingMessageList(list):
+    """
+    A chat_messages list that signals a LiveUpdateNotifier whenever messages are added.
+
+    Live-agent and bot messages have the same shape, so an appended message is
+    published as received over gRPC if the client's _grpc_last_update_time
+    moved between it and the next append (or its publication, if none came
+    sooner): the gRPC listener stamps it right after appending each message it
+    receives. Messages appended off the event loop (e.g. the user's, from a
+    Streamlit script thread) are never from gRPC.
+    """
+
+    def __init__(self, messages, notifier: LiveUpdateNotifier, client: AsyncPinionAIClient):
+        super().__init__(messages)
+        self.notifier = notifier
+        self._client = weakref.ref(client)
+        self._unpublished: deque[tuple[dict, float | None]] = deque()
+
+    def append(self, message):
+        super().append(message)
+        self.notifier.notify()
+        client = self._client()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if client is None or loop is None:
+            self.notifier.publish(message, False)
+            return
+        self._unpublished.append((message, getattr(client, "_grpc_last_update_time", None)))
+        loop.call_soon(self._publish_next)
+
+    def _publish_next(self):
+        message, stamp = self._unpublished.popleft()
+        client = self._client()
+        if self._unpublished:
+            stamp_after = self._unpublished[0][1]
+        else:
+            stamp_after = getattr(client, "_grpc_last_update_time", None) if client is not None else stamp
+        self.notifier.publish(message, stamp_after != stamp)
+
+    def extend(self, messages):
+        super().extend(messages)
+        self.notifier.notify()
+
+_notifiers: "weakref.WeakKeyDictionary[AsyncPinionAIClient, LiveUpdateNotifier]" = weakref.WeakKeyDictionary()
+_notifiers_lock = threading.Lock()
+
+def attach_update_notifier(client: AsyncPinionAIClient) -> LiveUpdateNotifier:
+    """
+    Returns the client's LiveUpdateNotifier, installing the chat_messages hook if
+    needed. Idempotent, and re-installs the hook if the client replaced its
+    message list (e.g. after sync_session_from_server).
+    """
+    with _notifiers_lock:
+        notifier = _notifiers.get(client)
+        if notifier is None:
+            notifier = _notifiers[client] = LiveUpdateNotifier()
+        if not isinstance(client.chat_messages, _NotifyingMessageList) or client.chat_messages.notifier is not notifier:
+            client.chat_messages = _NotifyingMessageList(client.chat_messages, notifier, client)
+    return notifier
+
+def wait_for_updates(
+    client: AsyncPinionAIClient,
+    timeout: float,
+    run_coroutine: Callable,
+    http_poll_start: float = 30,
+    http_poll_interval: float = 5,
+    http_poll_max_interval: float = 60,
+    on_poll_error: Callable[[Exception], None] | None = None,
+) -> bool:
+    """
+    Blocks until a live-agent message arrives and returns True, or returns False
+    after timeout seconds.
+
+    The gRPC listener wakes the waiting thread directly. As a fallback for
+    messages that bypass gRPC, the session's last-modified time is checked over
+    HTTP starting http_poll_start seconds in, with the interval doubling from
+    http_poll_interval up to http_poll_max_interval while nothing changes.
+    run_coroutine executes a coroutine on the client's event loop and returns its result.
+    """
+    notifier = attach_update_notifier(client)
+    seen_version = notifier.version
+    start_time = time.time()
+    # A message that landed just before we started waiting still counts.
+    if (start_time - client._grpc_last_update_time) < 2.0:
+        return True
+
+    deadline = start_time + timeout
+    next_http_poll_time = start_time + http_poll_start
+    interval = http_poll_interval
+    while True:
+        now = time.time()
+        if now >= deadline:
+            return False
+        if notifier.wait(seen_version, min(deadline, next_http_poll_time) - now):
+            return True
+        now = time.time()
+        if now >= next_http_poll_time and now < deadline:
+            try:
+                lastmodified_server, _ = run_coroutine(client.get_latest_session_modification_time())
+                if lastmodified_server and lastmodified_server != client.last_session_post_modified:
+                    return True
+            except Exception as e:
+                if on_poll_error:
+                    on_poll_error(e)
+            # Back off while the session stays quiet; gRPC delivery does not depend on this.
+            next_http_poll_time = time.time() + interval
+            interval = min(interval * 2, http_poll_max_interval)
+
+class LiveAgentBridge:
+    """
+    Pushes live-agent messages from many clients' gRPC listeners to a front end.
+
+    Everything runs on the caller's event loop: each client's own gRPC listener
+    task appends incoming messages, and the bridge forwards them to
+    `deliver(key, message)` in order per conversation, with at most
+    `max_workers` deliveries in flight and at most `max_pending` messages
+    buffered per conversation (further messages are dropped and counted).
+    When a listener stops on its own (e.g. the agent hands back to the AI),
+    `on_end(key)` runs after the remaining messages are delivered.
+    """
+
+    def __init__(
+        self,
+        deliver: Callable[[Any, dict], Awaitable],
+        on_end: Callable[[Any], Awaitable] | None = None,
+        max_workers: int = 8,
+        max_pending: int = 50,
+    ):
+        self.deliver = deliver
+        self.on_end = on_end
+        self._delivery = ConversationDispatcher(max_workers=max_workers, max_queue_depth=max_pending)
+        self._sessions: dict[Any, tuple[AsyncPinionAIClient, Callable[[], None]]] = {}
+        self.dropped = 0
+
+    def is_active(self, key) -> bool:
+        return key in self._sessions
+
+    async def start(self, key, client: AsyncPinionAIClient) -> bool:
+        """Starts the client's gRPC listener if needed and begins forwarding its messages. Returns False if it could not connect."""
+        if key in self._sessions and self._sessions[key][0] is client and client._grpc_stub:
+            # Re-hook in case the client replaced its message list (e.g. sync_session_from_server).
+            attach_update_notifier(client)
+            return True
+        self._detach(key)
+        if not client._grpc_stub and not await client.start_grpc_client_listener(sender_id="user"):
+            return False
+        unsubscribe = attach_update_notifier(client).subscribe(lambda message, from_grpc: self._on_message(key, message, from_grpc))
+        self._sessions[key] = (client, unsubscribe)
+        listener = client._grpc_listener_task
+        if listener is not None:
+            listener.add_done_callback(lambda _: self._on_listener_done(key, client))
+        return True
+
+    def _on_message(self, key, message: dict, from_grpc: bool):
+        # Only messages received over gRPC from the agent side are pushed. The front end echoes
+        # its own user's messages, and bot or co-pilot replies added locally are not the live agent's.
+        if not from_grpc or message.get("role") == "user":
+            return
+        if not self._delivery.submit(key, lambda: self.deliver(key, message)):
+            self.dropped += 1
+            logger.warning(f"Dropped live-agent message for {key}: delivery backlog is full.")
+
+    def _on_listener_done(self, key, client: AsyncPinionAIClient):
+        session = self._sessions.get(key)
+        if session is None or session[0] is not client:
+            return  # Stopped explicitly, or replaced by a newer session.
+        self._detach(key)
+        if self.on_end is not None:
+            self._delivery.submit(key, lambda: self.on_end(key))
+
+    def _detach(self, key):
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            session[1]()
+
+    async def stop(self, key, end_session: bool = False):
+        """Stops forwarding messages for key, optionally ending its gRPC session too (e.g. on /end)."""
+        session = self._sessions.get(key)
+        self._detach(key)
+        if session is not None and end_session:
+            await session[0].end_grpc_chat_session()
+
+    async def stop_all(self):
+        """Detaches every conversation and closes their gRPC streams without a goodbye, e.g. on shutdown."""
+        for key in list(self._sessions):
+            client = self._sessions[key][0]
+            self._detach(key)
+            try:
+                await client.end_grpc_chat_session(send_goodbye=False)
+            except Exception as e:
+                logger.warning(f"Error ending gRPC session for {key}: {e}")
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "dropped": self.dropped, **self._delivery.stats()}
@@ -0,0 +1,225 @@
+"""Latency instrumentation shared by the PinionAI front ends.
+
+instrument_client() times a client's process_user_input, update_pinion_session,
+convert_text_to_audio, convert_audio_to_text and send_grpc_message calls, and
+records each as a span of the current trace (see pinionai_tracing). Shared
+helpers time AIA loading and client creation. Durations go into per
+stage/agent/front end histograms, which are served in the Prometheus text format:
+
+    METRICS_PORT=9464   serve /metrics on this port (sidecar thread for
+                        Streamlit and the CLI, aiohttp for Slack and Teams)
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from pinionai_tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+# Seconds. Agent turns range from tens of milliseconds (cached) to a minute (tool-heavy).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Client methods timed by instrument_client(), as method name -> stage label.
+INSTRUMENTED_METHODS = {
+    "process_user_input": "process_user_input",
+    "update_pinion_session": "update_pinion_session",
+    "convert_text_to_audio": "convert_text_to_audio",
+    "convert_audio_to_text": "convert_audio_to_text",
+    "send_grpc_message": "grpc_send",
+}
+
+class Histogram:
+    """A cumulative-bucket latency histogram with interpolated quantiles."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimates the q-quantile by linear interpolation within its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower  # Beyond the largest bucket; report its bound.
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsRegistry:
+    """Stage latency histograms keyed by (stage, agent, frontend), plus gauges read from stats() callables."""
+
+    def __init__(self, frontend: str = ""):
+        self.frontend = frontend
+        self._histograms: dict[tuple[str, str, str], Histogram] = {}
+        self._stats: dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, agent: str = ""):
+        key = (stage, agent or "", self.frontend)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str, agent: str = ""):
+        """Times the enclosed block (sync or async code) as one observation of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, agent)
+
+    def register_stats(self, name: str, stats: Callable[[], dict]):
+        """Exports each numeric value of stats() as gauge pinionai_{name}_{key}."""
+        with self._lock:
+            self._stats[name] = stats
+
+    def quantiles(self, stage: str, agent: str = "") -> dict[float, float]:
+        with self._lock:
+            histogram = self._histograms.get((stage, agent, self.frontend))
+            return {q: histogram.quantile(q) for q in QUANTILES} if histogram else {}
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = [
+            "# HELP pinionai_stage_duration_seconds Duration of each agent turn stage.",
+            "# TYPE pinionai_stage_duration_seconds histogram",
+        ]
+        quantile_lines = [
+            "# HELP pinionai_stage_duration_quantile_seconds Estimated p50/p95/p99 stage durations.",
+            "# TYPE pinionai_stage_duration_quantile_seconds gauge",
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            stats = list(self._stats.items())
+            for (stage, agent, frontend), histogram in histograms:
+                labels = f'stage="{_escape(stage)}",agent="{_escape(agent)}",frontend="{_escape(frontend)}"'
+                cumulative = 0
+                for bound, bucket_count in zip([*histogram.buckets, "+Inf"], histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'pinionai_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"pinionai_stage_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+                lines.append(f"pinionai_stage_duration_seconds_count{{{labels}}} {histogram.count}")
+                for q in QUANTILES:
+                    quantile_lines.append(f'pinionai_stage_duration_quantile_seconds{{{labels},quantile="{q}"}} {histogram.quantile(q):.6f}')
+        lines.extend(quantile_lines)
+        for name, stats_fn in stats:
+            try:
+                values = stats_fn()
+            except Exception as e:
+                logger.warning(f"Could not read {name} stats for metrics: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metric = f"pinionai_{name}_{key}"
+                    lines.append(f"# TYPE {metric} gauge")
+                    lines.append(f'{metric}{{frontend="{_escape(self.frontend)}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+_metrics = MetricsRegistry()
+
+def get_metrics() -> MetricsRegistry:
+    """Returns the process-wide MetricsRegistry. Front ends set its `frontend` label at startup."""
+    return _metrics
+
+def agent_label(client) -> str:
+    return getattr(client, "_agent_id", None) or ""
+
+def instrument_client(client):
+    """Times the client's turn-stage methods into get_metrics() and the current trace. Idempotent."""
+    if getattr(client, "_pinionai_instrumented", False):
+        return client
+    for method_name, stage in INSTRUMENTED_METHODS.items():
+        method = getattr(client, method_name, None)
+        if method is None:
+            continue
+
+        def timed(method, stage):
+            @functools.wraps(method)
+            async def wrapper(*args, **kwargs):
+                with _metrics.time(stage, agent_label(client)), get_tracer().span(f"client.{stage}", session_id=client.session_id):
+                    return await method(*args, **kwargs)
+            return wrapper
+        setattr(client, method_name, timed(method, stage))
+    client._pinionai_instrumented = True
+    return client
+
+async def metrics_handler(request):
+    """aiohttp handler serving get_metrics() in the Prometheus text format."""
+    from aiohttp import web
+    return web.Response(text=_metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_site(port: int, host: str = "0.0.0.0"):
+    """Serves /metrics on its own port from the running aiohttp event loop. Returns the AppRunner to clean up."""
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_sidecar: ThreadingHTTPServer | None = None
+_sidecar_lock = threading.Lock()
+
+def start_metrics_server(port: int | None = None, host: str = "0.0.0.0") -> ThreadingHTTPServer | None:
+    """
+    Serves /metrics from a daemon thread (for Streamlit and the CLI). Uses
+    METRICS_PORT if port is not given; does nothing if neither is set. Safe to
+    call on every Streamlit rerun.
+    """
+    global _sidecar
+    port = port or int(os.environ.get("METRICS_PORT", 0) or 0)
+    if not port:
+        return None
+    with _sidecar_lock:
+        if _sidecar is None:
+            try:
+                _sidecar = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+            except OSError as e:
+                logger.warning(f"Could not start metrics server on port {port}: {e}")
+                return None
+            threading.Thread(target=_sidecar.serve_forever, name="pinionai-metrics", daemon=True).start()
+            logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return _sidecar
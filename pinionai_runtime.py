@@ -0,0 +1,201 @@
+"""Shared runtime helpers for the PinionAI front ends (Streamlit, CLI, Slack, Teams).
+
+These helpers sit between the front ends and AsyncPinionAIClient so every
+interface drives an agent turn the same way.
+"""
+import os
+import time
+import atexit
+import asyncio
+import logging
+import threading
+import weakref
+from collections import deque
+from typing import Awaitable, Callable
+from pinionai import AsyncPinionAIClient
+from pinionai_http import close_http_clients
+from pinionai_metrics import get_metrics
+from pinionai_sessions import get_session_persister
+
+logger = logging.getLogger(__name__)
+
+async def close_client(client: AsyncPinionAIClient):
+    """Saves pending session updates, ends any live-agent stream and closes the client's HTTP session, ignoring errors."""
+    try:
+        await get_session_persister().flush(client)
+    except Exception as e:
+        logger.warning(f"Error saving session during cleanup: {e}")
+    try:
+        await client.end_grpc_chat_session(send_goodbye=False)
+    except Exception as e:
+        logger.warning(f"Error ending gRPC session during cleanup: {e}")
+    try:
+        await client.close()
+    except Exception as e:
+        logger.warning(f"Error closing HTTP session during cleanup: {e}")
+
+class ConversationDispatcher:
+    """
+    Runs submitted jobs in FIFO order per conversation, and different conversations in parallel.
+
+    At most `max_workers` jobs run at once across all conversations. Each
+    conversation may have up to `max_queue_depth` jobs waiting behind the one
+    in progress; submit() returns False past that so the caller can tell the
+    user to slow down instead of queueing without bound.
+    """
+
+    def __init__(self, max_workers: int = 8, max_queue_depth: int = 5):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self._queues: dict[str, deque] = {}
+        self._drainers: dict[str, asyncio.Task] = {}
+        self._workers: asyncio.Semaphore | None = None
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def submit(self, key: str, job: Callable[[], Awaitable]) -> bool:
+        """Queues job() behind earlier work for key. Must be called on the event loop."""
+        queue = self._queues.setdefault(key, deque())
+        if len(queue) >= self.max_queue_depth:
+            self.rejected += 1
+            logger.warning(f"Work queue for {key} is full ({len(queue)} waiting); rejecting new work.")
+            return False
+        queue.append((job, time.perf_counter()))
+        if key not in self._drainers:
+            if self._workers is None:
+                self._workers = asyncio.Semaphore(self.max_workers)
+            self._drainers[key] = asyncio.get_running_loop().create_task(self._drain(key, queue))
+        return True
+
+    async def _drain(self, key: str, queue: deque):
+        try:
+            while queue:
+                job, queued_at = queue.popleft()
+                async with self._workers:
+                    get_metrics().observe("queue_wait", time.perf_counter() - queued_at)
+                    self.running += 1
+                    try:
+                        await job()
+                        self.completed += 1
+                    except Exception:
+                        self.failed += 1
+                        logger.exception(f"Unhandled error in queued work for {key}")
+                    finally:
+                        self.running -= 1
+        finally:
+            self._drainers.pop(key, None)
+            if not queue:
+                self._queues.pop(key, None)
+
+    def is_busy(self, key: str) -> bool:
+        """True while key has a job queued or running."""
+        return key in self._drainers
+
+    def queue_depth(self, key: str) -> int:
+        return len(self._queues.get(key, ()))
+
+    def stats(self) -> dict:
+        return {
+            "conversations": len(self._drainers),
+            "queued": sum(len(queue) for queue in self._queues.values()),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+class LoopLease:
+    """
+    A session's claim on one of the pool's event loops.
+
+    Clients tracked on the lease are closed on its loop when the lease is
+    released, either explicitly or when the lease is garbage collected because
+    the owning session went away.
+    """
+
+    def __init__(self, pool: "EventLoopPool", index: int, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._clients = []
+        self._finalizer = weakref.finalize(self, pool._release, index, loop, self._clients)
+
+    def track(self, client: AsyncPinionAIClient):
+        """Closes client on this lease's loop when the lease is released."""
+        if client is not None and not any(c is client for c in self._clients):
+            self._clients.append(client)
+
+    def release(self):
+        self._finalizer()
+
+class EventLoopPool:
+    """
+    A fixed number of background event loops shared by all sessions in the process.
+
+    Sessions are assigned to the least-loaded loop, so thread count stays at
+    `size` no matter how many sessions are opened. Loop threads start lazily.
+    """
+
+    def __init__(self, size: int = 4):
+        self.size = max(1, size)
+        self._lock = threading.Lock()
+        self._loops: list[asyncio.AbstractEventLoop | None] = [None] * self.size
+        self._threads: list[threading.Thread | None] = [None] * self.size
+        self._leases = [0] * self.size
+
+    def _loop_at(self, index: int) -> asyncio.AbstractEventLoop:
+        if self._loops[index] is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name=f"pinionai-loop-{index}", daemon=True)
+            thread.start()
+            self._loops[index], self._threads[index] = loop, thread
+        return self._loops[index]
+
+    def lease(self) -> LoopLease:
+        """Assigns the caller to the least-loaded loop."""
+        with self._lock:
+            index = min(range(self.size), key=lambda i: self._leases[i])
+            self._leases[index] += 1
+            loop = self._loop_at(index)
+        return LoopLease(self, index, loop)
+
+    def _release(self, index: int, loop: asyncio.AbstractEventLoop, clients: list):
+        with self._lock:
+            self._leases[index] = max(0, self._leases[index] - 1)
+        if loop.is_running():
+            for client in clients:
+                asyncio.run_coroutine_threadsafe(close_client(client), loop)
+        clients.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"loops": sum(loop is not None for loop in self._loops), "leases": list(self._leases)}
+
+    def shutdown(self, timeout: float = 5.0):
+        """Stops every loop thread. Outstanding leases become unusable."""
+        with self._lock:
+            loops, threads = list(self._loops), list(self._threads)
+            self._loops = [None] * self.size
+            self._threads = [None] * self.size
+        for loop in loops:
+            if loop is not None and loop.is_running():
+                try:
+                    asyncio.run_coroutine_threadsafe(close_http_clients(), loop).result(timeout)
+                except Exception as e:
+                    logger.warning(f"Error closing pooled HTTP clients: {e}")
+                loop.call_soon_threadsafe(loop.stop)
+        for thread in threads:
+            if thread is not None:
+                thread.join(timeout)
+
+_loop_pool: EventLoopPool | None = None
+_loop_pool_lock = threading.Lock()
+
+def get_loop_pool() -> EventLoopPool:
+    """Returns the process-wide EventLoopPool, sized by EVENT_LOOP_POOL_SIZE (default 4)."""
+    global _loop_pool
+    with _loop_pool_lock:
+        if _loop_pool is None:
+            _loop_pool = EventLoopPool(int(os.environ.get("EVENT_LOOP_POOL_SIZE", 4)))
+            atexit.register(_loop_pool.shutdown)
+    return _loop_pool
@@ -0,0 +1,307 @@
+"""Session persistence helpers shared by the PinionAI front ends.
+
+SessionPersister takes `update_pinion_session()` off the critical path of a
+turn: front ends schedule a write and move on, and the persister posts the
+session in the background, coalescing repeated schedules for the same client
+into a single update that carries the latest state.
+
+SessionStore is the bounded conversation_id -> client map used by the Slack
+and Teams bots, evicting idle and least recently used sessions.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+from pinionai import AsyncPinionAIClient
+
+logger = logging.getLogger(__name__)
+
+class _PendingWrite:
+    __slots__ = ("task", "dirty", "wake")
+
+    def __init__(self):
+        self.task: asyncio.Task | None = None
+        self.dirty = False
+        self.wake = asyncio.Event()
+
+class SessionPersister:
+    """
+    Write-behind, coalescing persister for AsyncPinionAIClient sessions.
+
+    schedule() must be called on the client's event loop. Writes wait up to
+    `delay` seconds so back-to-back turns (e.g. a next_intent follow-up) share
+    one update; a schedule that arrives while a write is in flight triggers
+    exactly one more write afterwards. flush() forces pending writes out now.
+    """
+
+    def __init__(self, delay: float = 0.25):
+        self.delay = delay
+        self._pending: "weakref.WeakKeyDictionary[AsyncPinionAIClient, _PendingWrite]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.scheduled = 0
+        self.written = 0
+        self.failed = 0
+
+    def schedule(self, client: AsyncPinionAIClient):
+        """Queues a session update for client. Returns immediately."""
+        with self._lock:
+            self.scheduled += 1
+            pending = self._pending.get(client)
+            if pending is not None and pending.task is not None and not pending.task.done():
+                pending.dirty = True
+                return
+            pending = _PendingWrite()
+            pending.task = asyncio.get_running_loop().create_task(self._write_loop(client, pending))
+            self._pending[client] = pending
+
+    async def _write_loop(self, client: AsyncPinionAIClient, pending: _PendingWrite):
+        while True:
+            if self.delay and not pending.wake.is_set():
+                try:
+                    await asyncio.wait_for(pending.wake.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            pending.dirty = False
+            try:
+                await client.update_pinion_session()
+                with self._lock:
+                    self.written += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"Background session update failed for {client.session_id}: {e}")
+            if not pending.dirty:
+                return
+
+    def is_pending(self, client: AsyncPinionAIClient) -> bool:
+        with self._lock:
+            pending = self._pending.get(client)
+            return pending is not None and pending.task is not None and not pending.task.done()
+
+    async def write(self, client: AsyncPinionAIClient):
+        """Schedules an update for client and waits until it has been written, e.g. before relaying to a live agent."""
+        self.schedule(client)
+        await self.flush(client)
+
+    async def flush(self, client: AsyncPinionAIClient):
+        """Writes any pending update for client immediately and waits for it."""
+        with self._lock:
+            pending = self._pending.get(client)
+        if pending is None or pending.task is None or pending.task.done():
+            return
+        pending.wake.set()
+        await asyncio.shield(pending.task)
+
+    async def flush_all(self):
+        """Flushes every pending write owned by the running event loop, e.g. on shutdown."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = [client for client, pending in self._pending.items()
+                       if pending.task is not None and not pending.task.done() and pending.task.get_loop() is loop]
+        await asyncio.gather(*(self.flush(client) for client in clients), return_exceptions=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"scheduled": self.scheduled, "written": self.written, "failed": self.failed}
+
+_session_persister: SessionPersister | None = None
+_session_persister_lock = threading.Lock()
+
+def get_session_persister() -> SessionPersister:
+    """Returns the process-wide SessionPersister, with its coalescing window set by SESSION_WRITE_DELAY."""
+    global _session_persister
+    with _session_persister_lock:
+        if _session_persister is None:
+            _session_persister = SessionPersister(delay=float(os.environ.get("SESSION_WRITE_DELAY", 0.25)))
+    return _session_persister
+
+# Rough fixed cost of a live client (agent config, vars, HTTP session) on top of its history.
+CLIENT_BASE_BYTES = 64 * 1024
+
+def estimate_client_bytes(client: AsyncPinionAIClient) -> int:
+    """Approximate memory held by a client, dominated by its chat history."""
+    return CLIENT_BASE_BYTES + sum(len(str(message.get("content") or "")) for message in client.chat_messages)
+
+class SessionStore:
+    """
+    A dict-like map of conversation id -> session value with idle TTL and LRU limits.
+
+    Entries idle for longer than `ttl` seconds, or least recently used once
+    `max_entries` or `max_bytes` (as measured by `size_of`) is exceeded, are
+    evicted. Evicted values are passed to the async `on_evict` callback on the
+    running event loop, e.g. to end gRPC streams and close HTTP sessions.
+    Explicit deletes (`del`, `pop`) do not call `on_evict`.
+
+    Limits are enforced on insert and in sweep(), never on reads. Keys for
+    which `is_busy(key)` is true (e.g. with queued or running turns, see
+    ConversationDispatcher.is_busy) are never evicted; the store may exceed its
+    limits until they finish.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float = 3600,
+        max_entries: int = 1000,
+        max_bytes: int | None = None,
+        on_evict: Callable[[Any], Awaitable] | None = None,
+        size_of: Callable[[Any], int] | None = None,
+        is_busy: Callable[[str], bool] | None = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size_of = size_of
+        self.is_busy = is_busy
+        self._entries: OrderedDict[str, list] = OrderedDict()  # key -> [value, last_access, size]
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {"ttl": 0, "lru": 0}
+
+    def _size(self, value) -> int:
+        return self.size_of(value) if self.size_of else 0
+
+    def _busy(self, key: str) -> bool:
+        return self.is_busy is not None and self.is_busy(key)
+
+    def _expired(self, key: str, entry: list, now: float) -> bool:
+        return self.ttl is not None and now - entry[1] > self.ttl and not self._busy(key)
+
+    def _remove(self, key: str) -> list:
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+        return entry
+
+    def _evict(self, key: str, reason: str):
+        value = self._remove(key)[0]
+        self.evictions[reason] += 1
+        logger.info(f"Evicted {self.name} entry {key} ({reason}).")
+        if self.on_evict is not None:
+            try:
+                asyncio.get_running_loop().create_task(self._run_on_evict(key, value))
+            except RuntimeError:
+                logger.warning(f"No running event loop to clean up evicted {self.name} entry {key}.")
+
+    async def _run_on_evict(self, key: str, value):
+        try:
+            await self.on_evict(value)
+        except Exception as e:
+            logger.error(f"Error cleaning up evicted {self.name} entry {key}: {e}")
+
+    def _over_limits(self) -> bool:
+        return len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 1
+        )
+
+    def _enforce_limits(self):
+        if not self._over_limits():
+            return
+        for key in list(self._entries):
+            if not self._over_limits():
+                break
+            if not self._busy(key):
+                self._evict(key, "lru")
+
+    def __contains__(self, key) -> bool:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if self._expired(key, entry, time.monotonic()):
+            self._evict(key, "ttl")
+            return False
+        return True
+
+    def __getitem__(self, key):
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is None or self._expired(key, entry, now):
+            if entry is not None:
+                self._evict(key, "ttl")
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        entry[1] = now
+        # Re-measure on access: histories grow between turns. Growth is enforced on the next insert or sweep.
+        size = self._size(entry[0])
+        self._bytes += size - entry[2]
+        entry[2] = size
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._entries:
+            self._remove(key)
+        size = self._size(value)
+        self._entries[key] = [value, time.monotonic(), size]
+        self._bytes += size
+        self._enforce_limits()
+
+    def __delitem__(self, key):
+        self._remove(key)
+
+    def pop(self, key, *default):
+        if key not in self._entries:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self._remove(key)[0]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def items(self):
+        return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def sweep(self) -> int:
+        """Evicts every expired entry, then enforces the size limits. Returns how many were evicted."""
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if self._expired(key, entry, now)]
+        for key in expired:
+            self._evict(key, "ttl")
+        before = len(self._entries)
+        self._enforce_limits()
+        return len(expired) + before - len(self._entries)
+
+    async def run_sweeper(self, interval: float = 60):
+        """Sweeps expired entries every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            if self.sweep():
+                logger.info(f"{self.name} store: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions_ttl": self.evictions["ttl"],
+            "evictions_lru": self.evictions["lru"],
+        }
+
+def session_store_from_env(name: str, **kwargs) -> SessionStore:
+    """Builds a SessionStore with limits from SESSION_TTL, SESSION_MAX_ENTRIES and SESSION_MAX_BYTES."""
+    max_bytes = os.environ.get("SESSION_MAX_BYTES")
+    options = {
+        "ttl": float(os.environ.get("SESSION_TTL", 3600)),
+        "max_entries": int(os.environ.get("SESSION_MAX_ENTRIES", 1000)),
+        "max_bytes": int(max_bytes) if max_bytes else 256 * 1024 * 1024,
+    }
+    options.update(kwargs)
+    return SessionStore(name, **options)
@@ -0,0 +1,299 @@
+"""Per-turn tracing for the PinionAI front ends.
+
+A sampled user turn becomes one trace: a root "turn" span with child spans for
+each client call, extension tool, gRPC send and outbound Slack/Teams post.
+Finished spans are handed to an exporter without blocking the event loop; the
+default JsonlExporter appends them to rotating JSONL files from a background
+thread.
+
+    TRACE_SAMPLE_RATE=0.1        fraction of turns traced (0 disables tracing)
+    TRACE_DIR=traces             directory for the JSONL files
+    TRACE_FILE_MAX_BYTES=10MB    rotate the file past this size
+    TRACE_FILE_BACKUPS=5         rotated files kept (spans.jsonl.1 ... .5)
+
+Summarize the slowest traces with:
+
+    python pinionai_tracing.py [TRACE_DIR] [--top 10]
+"""
+import os
+import sys
+import json
+import glob
+import time
+import queue
+import random
+import logging
+import argparse
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class Span:
+    """One timed operation within a trace."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start", "duration", "error")
+
+    def __init__(self, trace_id: str, parent_id: str | None, name: str, attributes: dict):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+class SpanExporter:
+    """Receives finished spans. export() is called on the event loop and must not block."""
+
+    def export(self, span: Span):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+class JsonlExporter(SpanExporter):
+    """
+    Appends spans as JSON lines to `directory`/spans.jsonl from a daemon thread.
+
+    The file is rotated past max_bytes, keeping `backups` older files. Spans
+    are queued in memory (up to max_queue); when the writer falls behind, new
+    spans are dropped and counted rather than slowing down turns.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 10 * 1024 * 1024, backups: int = 5, max_queue: int = 10000):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "spans.jsonl")
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.exported = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._write_loop, name="pinionai-trace-export", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            batch = [record]
+            # Drain whatever else is queued so a busy turn costs one write, not one per span.
+            while len(batch) < 1000:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._write(batch)
+                    return
+                batch.append(record)
+            self._write(batch)
+
+    def _write(self, batch: list):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(record, default=str) + "\n" for record in batch)
+            self.exported += len(batch)
+        except OSError as e:
+            self.dropped += len(batch)
+            logger.warning(f"Could not write {len(batch)} trace spans to {self.path}: {e}")
+
+    def shutdown(self, timeout: float = 5.0):
+        """Writes out queued spans and stops the writer thread."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {"exported": self.exported, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("pinionai_current_span", default=None)
+
+class Tracer:
+    """
+    Starts sampled traces and the child spans within them.
+
+    The current span is tracked with a context variable, so spans opened in
+    asyncio tasks spawned during a turn attach to that turn. span() outside a
+    sampled trace is a no-op, which keeps unsampled turns almost free.
+    """
+
+    def __init__(self, exporter: SpanExporter | None = None, sample_rate: float = 0.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.traces_started = 0
+        self.traces_sampled = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and self.sample_rate > 0
+
+    @contextmanager
+    def start_trace(self, name: str, **attributes):
+        """Opens a root span if this trace is sampled. Yields the span, or None if it is not."""
+        self.traces_started += 1
+        if not self.enabled or random.random() >= self.sample_rate:
+            token = _current_span.set(None)
+            try:
+                yield None
+            finally:
+                _current_span.reset(token)
+            return
+        self.traces_sampled += 1
+        with self._open(Span(os.urandom(16).hex(), None, name, attributes)) as span:
+            yield span
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Opens a child of the current span. Yields the span, or None outside a sampled trace."""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        with self._open(Span(parent.trace_id, parent.span_id, name, attributes)) as span:
+            yield span
+
+    @contextmanager
+    def _open(self, span: Span):
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            _current_span.reset(token)
+            try:
+                self.exporter.export(span)
+            except Exception as e:
+                logger.warning(f"Could not export trace span {span.name}: {e}")
+
+    def set_attribute(self, key: str, value):
+        """Sets an attribute on the current span, if any."""
+        span = _current_span.get()
+        if span is not None:
+            span.set_attribute(key, value)
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+    def stats(self) -> dict:
+        stats = {"traces_started": self.traces_started, "traces_sampled": self.traces_sampled}
+        if hasattr(self.exporter, "stats"):
+            stats.update(self.exporter.stats())
+        return stats
+
+_tracer: Tracer | None = None
+_tracer_lock = threading.Lock()
+
+def get_tracer() -> Tracer:
+    """Returns the process-wide Tracer, configured from TRACE_SAMPLE_RATE and the TRACE_* file settings."""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", 0) or 0)
+            exporter = None
+            if sample_rate > 0:
+                exporter = JsonlExporter(
+                    os.environ.get("TRACE_DIR", "traces"),
+                    max_bytes=int(os.environ.get("TRACE_FILE_MAX_BYTES", 10 * 1024 * 1024)),
+                    backups=int(os.environ.get("TRACE_FILE_BACKUPS", 5)),
+                )
+            _tracer = Tracer(exporter, sample_rate)
+    return _tracer
+
+def traced(name: str):
+    """Decorates an async function so each call is a child span of the current trace."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with get_tracer().span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def load_traces(directory: str) -> dict[str, list[dict]]:
+    """Reads every spans.jsonl* file in directory, grouping spans by trace id."""
+    traces: dict[str, list[dict]] = {}
+    for path in sorted(glob.glob(os.path.join(directory, "spans.jsonl*"))):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut short by a crash or rotation.
+                traces.setdefault(span["trace_id"], []).append(span)
+    return traces
+
+def summarize(directory: str, top: int = 10, out=sys.stdout):
+    """Prints the slowest traces with the time each child span took."""
+    roots = []
+    for spans in load_traces(directory).values():
+        root = next((span for span in spans if span["parent_id"] is None), None)
+        if root is not None and root["duration"] is not None:
+            roots.append((root, spans))
+    roots.sort(key=lambda item: item[0]["duration"], reverse=True)
+    print(f"{len(roots)} traces in {directory}; slowest {min(top, len(roots))}:", file=out)
+    for root, spans in roots[:top]:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(root["start"]))
+        ids = " ".join(f"{key}={value}" for key, value in root["attributes"].items())
+        print(f"\n{root['duration'] * 1000:9.1f} ms  {root['name']}  {started}  {ids}", file=out)
+        children: dict[str, list[dict]] = {}
+        for span in spans:
+            children.setdefault(span["parent_id"], []).append(span)
+
+        def show(parent_id: str, depth: int):
+            for span in sorted(children.get(parent_id, []), key=lambda s: s["start"]):
+                share = span["duration"] / root["duration"] * 100 if root["duration"] else 0
+                error = f"  ERROR {span['error']}" if span["error"] else ""
+                print(f"{span['duration'] * 1000:9.1f} ms  {share:5.1f}%  {'  ' * depth}{span['name']}{error}", file=out)
+                show(span["span_id"], depth + 1)
+        show(root["span_id"], 1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the slowest PinionAI turn traces.")
+    parser.add_argument("directory", nargs="?", default=os.environ.get("TRACE_DIR", "traces"))
+    parser.add_argument("--top", type=int, default=10, help="Number of traces to show.")
+    args = parser.parse_args()
+    summarize(args.directory, args.top)
+
+if __name__ == "__main__":
+    main()
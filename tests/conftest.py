@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FakeClient:
+    """Stands in for AsyncPinionAIClient: just the attributes the session helpers read and write."""
+
+    def __init__(self, session_id: str = "session-1"):
+        self._agent_id = "agent-1"
+        self._host_url = "https://example.invalid"
+        self._client_id = "client-1"
+        self._version = None
+        self._token = "token"
+        self._session_id = session_id
+        self._raw_session_data = {"agent": "data"}
+        self.chat_messages = []
+        self.var = {}
+        self.closed = False
+
+    @property
+    def session_id(self):
+        return self._session_id
+
+    async def close(self):
+        self.closed = True
+
+class FakeLiveClient(FakeClient):
+    """A FakeClient with a gRPC listener that appends messages the way AsyncPinionAIClient's does."""
+
+    def __init__(self, session_id: str = "session-1"):
+        super().__init__(session_id)
+        self._grpc_stub = None
+        self._grpc_listener_task = None
+        self._grpc_last_update_time = time.time()
+
+    async def start_grpc_client_listener(self, sender_id: str = "user"):
+        self._grpc_stub = object()
+        return True
+
+    def receive(self, message: str, sender_id: str = "assistant"):
+        self.chat_messages.append({"role": sender_id, "content": message})
+        self._grpc_last_update_time = time.time()
+
+@pytest.fixture
+def fake_client():
+    return FakeClient
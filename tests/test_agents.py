@@ -0,0 +1,48 @@
+import asyncio
+import time
+import pinionai_agents
+from pinionai_agents import ClientPool
+
+class PooledClient:
+    """Stands in for AsyncPinionAIClient.create(): every call without session data opens a new server session."""
+    sessions_opened = 0
+
+    def __init__(self, session_id: str):
+        self._session_id = session_id
+        self.closed = False
+
+    @property
+    def session_id(self):
+        return self._session_id
+
+    @classmethod
+    async def create(cls, session_id=None, raw_session_data=None, **config):
+        if session_id is None or not raw_session_data:
+            cls.sessions_opened += 1
+            session_id = f"session-{cls.sessions_opened}"
+        return cls(session_id)
+
+    async def sync_session_from_server(self):
+        return True
+
+    async def close(self):
+        self.closed = True
+
+def test_idle_prewarmed_client_is_refreshed_onto_its_session(monkeypatch):
+    monkeypatch.setattr(pinionai_agents, "AsyncPinionAIClient", PooledClient)
+    monkeypatch.setattr(pinionai_agents, "instrument_client", lambda client: client)
+
+    async def main():
+        pool = ClientPool({"agent_id": "agent-1"}, min_size=1, max_size=1, max_idle=0.01)
+        pool.start()
+        await pool._refill_task
+        idle = pool._ready[-1][1]
+        time.sleep(0.02)
+        client = await pool.acquire()
+        await pool.close()
+        return idle, client, pool.stats()
+
+    idle, client, stats = asyncio.run(main())
+    assert client.session_id == idle.session_id == "session-1"
+    assert idle.closed and not client.closed
+    assert stats["refreshed"] == 1 and stats["hits"] == 1
@@ -0,0 +1,80 @@
+import asyncio
+import time
+import pytest
+from pinionai_cache import TokenBucket, ToolCache, ToolRateLimited
+
+def test_identical_calls_in_flight_share_one_fetch():
+    async def main():
+        cache = ToolCache()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return "quote"
+
+        results = await asyncio.gather(*(cache.call("quote", "k", fetch, ttl=60) for _ in range(5)))
+        cached = await cache.call("quote", "k", fetch, ttl=60)
+        return results, cached, calls, cache.stats()
+
+    results, cached, calls, stats = asyncio.run(main())
+    assert results == ["quote"] * 5
+    assert cached == "quote"
+    assert len(calls) == 1
+    assert (stats["misses"], stats["shared"], stats["hits"]) == (1, 4, 1)
+
+def test_errors_reach_every_waiter():
+    async def main():
+        cache = ToolCache()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("provider down")
+
+        return await asyncio.gather(*(cache.call("quote", "k", fetch, ttl=60) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_stale_result_served_when_rate_limited():
+    async def main():
+        cache = ToolCache()
+        limiter = TokenBucket(rate=1, per=60)
+
+        async def fetch():
+            return "fresh"
+
+        first = await cache.call("quote", "k", fetch, ttl=0.01, limiter=limiter)
+        time.sleep(0.02)
+        # Expired, and the limiter has no token left: the expired result is served.
+        second = await cache.call("quote", "k", fetch, ttl=0.01, limiter=limiter)
+        with pytest.raises(ToolRateLimited):
+            await cache.call("quote", "other", fetch, ttl=60, limiter=limiter, max_wait=0.01)
+        return first, second, cache.stats()
+
+    first, second, stats = asyncio.run(main())
+    assert first == second == "fresh"
+    assert stats["stale"] == 1
+    assert stats["rate_limited"] == 1
+
+def test_rejected_result_is_not_cached_and_stale_is_served():
+    async def main():
+        cache = ToolCache()
+        responses = iter(["good", "**API Note:** limit", "**API Note:** limit"])
+
+        async def fetch():
+            return next(responses)
+
+        def accept(value):
+            return not value.startswith("**API")
+
+        await cache.call("quote", "k", fetch, ttl=0.01, accept=accept)
+        time.sleep(0.02)
+        served = await cache.call("quote", "k", fetch, ttl=0.01, accept=accept)
+        uncached = await cache.call("quote", "new", fetch, ttl=60, accept=accept)
+        return served, uncached, cache.stats()
+
+    served, uncached, stats = asyncio.run(main())
+    assert served == "good"
+    assert uncached == "**API Note:** limit"
+    assert stats["entries"] == 1
@@ -0,0 +1,35 @@
+import asyncio
+from conftest import FakeLiveClient
+from pinionai_live import LiveAgentBridge, attach_update_notifier
+
+def test_published_messages_are_marked_by_origin():
+    async def main():
+        client = FakeLiveClient()
+        seen = []
+        attach_update_notifier(client).subscribe(lambda message, from_grpc: seen.append((message["content"], from_grpc)))
+        client.chat_messages.append({"role": "assistant", "content": "bot reply"})
+        client.receive("agent reply")
+        await asyncio.sleep(0)
+        await asyncio.to_thread(client.chat_messages.append, {"role": "user", "content": "from a script thread"})
+        return seen
+
+    assert asyncio.run(main()) == [("bot reply", False), ("agent reply", True), ("from a script thread", False)]
+
+def test_bridge_relays_only_live_agent_messages():
+    async def main():
+        delivered = []
+
+        async def deliver(key, message):
+            delivered.append((key, message["content"]))
+
+        bridge = LiveAgentBridge(deliver=deliver)
+        client = FakeLiveClient()
+        assert await bridge.start("c1", client)
+        client.chat_messages.append({"role": "user", "content": "hello"})
+        client.chat_messages.append({"role": "assistant", "content": "bot reply"})
+        client.receive("agent reply")
+        client.receive("echo of the user's message", sender_id="user")
+        await asyncio.sleep(0.01)
+        return delivered
+
+    assert asyncio.run(main()) == [("c1", "agent reply")]
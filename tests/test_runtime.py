@@ -0,0 +1,60 @@
+import asyncio
+from pinionai_runtime import ConversationDispatcher
+
+def test_jobs_run_in_order_per_conversation():
+    async def main():
+        dispatcher = ConversationDispatcher(max_workers=4, max_queue_depth=10)
+        ran = []
+        done = asyncio.Event()
+
+        def job(key, n, delay):
+            async def run():
+                await asyncio.sleep(delay)
+                ran.append((key, n))
+                if len(ran) == 6:
+                    done.set()
+            return run
+
+        # Earlier jobs are slower, so only the per-conversation queue keeps them in order.
+        for n, delay in enumerate((0.03, 0.02, 0.01)):
+            assert dispatcher.submit("a", job("a", n, delay))
+            assert dispatcher.submit("b", job("b", n, delay))
+        busy = dispatcher.is_busy("a")
+        await asyncio.wait_for(done.wait(), 5)
+        await asyncio.sleep(0)
+        return ran, busy, dispatcher
+
+    ran, busy, dispatcher = asyncio.run(main())
+    assert [n for key, n in ran if key == "a"] == [0, 1, 2]
+    assert [n for key, n in ran if key == "b"] == [0, 1, 2]
+    assert busy is True
+    assert dispatcher.is_busy("a") is False
+    assert dispatcher.stats()["completed"] == 6
+
+def test_submit_rejects_past_queue_depth():
+    async def main():
+        dispatcher = ConversationDispatcher(max_workers=1, max_queue_depth=2)
+        release = asyncio.Event()
+
+        async def blocked():
+            await release.wait()
+
+        async def quick():
+            pass
+
+        assert dispatcher.submit("a", blocked)
+        await asyncio.sleep(0)  # the first job starts, leaving the queue empty
+        accepted = [dispatcher.submit("a", quick) for _ in range(3)]
+        other = dispatcher.submit("b", quick)
+        depth = dispatcher.queue_depth("a")
+        release.set()
+        while dispatcher.is_busy("a") or dispatcher.is_busy("b"):
+            await asyncio.sleep(0.01)
+        return accepted, other, depth, dispatcher.stats()
+
+    accepted, other, depth, stats = asyncio.run(main())
+    assert accepted == [True, True, False]
+    assert other is True
+    assert depth == 2
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 4
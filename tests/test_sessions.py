@@ -0,0 +1,67 @@
+import asyncio
+import time
+from pinionai_sessions import SessionStore
+
+def test_ttl_eviction_skips_busy_keys(fake_client):
+    async def main():
+        evicted = []
+
+        async def on_evict(client):
+            evicted.append(client)
+            await client.close()
+
+        busy = {"busy"}
+        store = SessionStore("sessions", ttl=0.01, on_evict=on_evict, is_busy=lambda key: key in busy)
+        store["busy"] = fake_client("busy")
+        store["idle"] = fake_client("idle")
+        time.sleep(0.02)
+        swept = store.sweep()
+        await asyncio.sleep(0)
+        return store, swept, evicted
+
+    store, swept, evicted = asyncio.run(main())
+    assert swept == 1
+    assert "busy" in store and store["busy"].closed is False
+    assert [client._session_id for client in evicted] == ["idle"]
+    assert evicted[0].closed is True
+
+def test_lru_eviction_skips_busy_keys(fake_client):
+    async def main():
+        evicted = []
+
+        async def on_evict(client):
+            evicted.append(client._session_id)
+
+        busy = {"a"}
+        store = SessionStore("sessions", max_entries=2, on_evict=on_evict, is_busy=lambda key: key in busy)
+        store["a"] = fake_client("a")
+        store["b"] = fake_client("b")
+        store["c"] = fake_client("c")
+        await asyncio.sleep(0)
+        # "a" was skipped while busy; using it again makes it the most recently used.
+        store.get("a")
+        busy.clear()
+        store["d"] = fake_client("d")
+        await asyncio.sleep(0)
+        return store, evicted
+
+    store, evicted = asyncio.run(main())
+    assert evicted == ["b", "c"]
+    assert sorted(store) == ["a", "d"]
+
+def test_reads_do_not_evict(fake_client):
+    async def main():
+        store = SessionStore("sessions", max_bytes=2, size_of=lambda client: len(client.chat_messages))
+        store["a"] = fake_client("a")
+        store["b"] = fake_client("b")
+        # History grows during a turn; the read re-measures it but leaves eviction to the next sweep.
+        store["a"].chat_messages.extend(["hi", "hello", "bye"])
+        store.get("a")
+        during = sorted(store)
+        store.sweep()
+        return during, sorted(store), store.stats()
+
+    during, after, stats = asyncio.run(main())
+    assert during == ["a", "b"]
+    assert after == ["a"]
+    assert stats["evictions_lru"] == 1
@@ -0,0 +1,270 @@
+import asyncio
+import pytest
+import pinionai_agents
+import pinionai_store
+from pinionai.exceptions import PinionAIConfigurationError
+from conftest import FakeLiveClient
+from pinionai_live import LiveAgentBridge
+from pinionai_sessions import SessionStore
+from pinionai_store import (
+    FileSessionBackend, SQLiteSessionBackend, SharedConversations,
+    apply_client_state, decode_state, encode_state, snapshot_cipher_from_env,
+)
+
+def test_concurrent_turns_on_two_workers_are_merged(tmp_path, fake_client):
+    async def main():
+        backend = SQLiteSessionBackend(str(tmp_path / "sessions.db"))
+        worker1 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+        worker2 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+
+        first = fake_client()
+        first.var = {"count": 0}
+        worker1.sessions["k"] = first
+        await worker1.save("k")
+
+        second = fake_client()
+        worker2.sessions["k"] = second
+        await worker2.load("k")
+        await worker1.load("k")
+
+        # Both workers run a turn from revision 1; worker1 saves first.
+        first.chat_messages.append({"role": "user", "content": "from worker 1"})
+        first.var["a"] = 1
+        second.chat_messages.append({"role": "user", "content": "from worker 2"})
+        second.var["b"] = 2
+        await worker1.save("k")
+        await worker2.save("k")
+
+        record = await backend.load("session", "k")
+        await backend.close()
+        return record, worker2.stats()
+
+    record, stats = asyncio.run(main())
+    assert record["revision"] == 3
+    assert [m["content"] for m in record["state"]["chat_messages"]] == ["from worker 1", "from worker 2"]
+    assert record["state"]["var"] == {"count": 0, "a": 1, "b": 2}
+    assert stats["conflicts"] == 1
+
+def test_file_backend_compare_and_set(tmp_path):
+    async def main():
+        backend = FileSessionBackend(str(tmp_path))
+        created = await backend.save("session", "k", {"revision": 1, "state": {}}, expected_revision=0)
+        stale = await backend.save("session", "k", {"revision": 1, "state": {}}, expected_revision=0)
+        updated = await backend.save("session", "k", {"revision": 2, "state": {}}, expected_revision=1)
+        return created, stale, updated, await backend.load("session", "k")
+
+    created, stale, updated, record = asyncio.run(main())
+    assert (created, stale, updated) == (True, False, True)
+    assert record["revision"] == 2
+
+def test_snapshot_round_trip(tmp_path, fake_client, monkeypatch):
+    restored_from = []
+
+    async def restore(state, token=None):
+        restored_from.append(state)
+        client = fake_client(state["session_id"])
+        apply_client_state(client, state)
+        return client
+
+    monkeypatch.setattr(pinionai_store, "client_from_state", restore)
+    monkeypatch.setenv("SESSION_STORE_KEY", "test-key")
+
+    async def main():
+        backend = FileSessionBackend(str(tmp_path))
+        backend.cipher = snapshot_cipher_from_env()
+        before = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"), write_through=False)
+        client = fake_client()
+        client.chat_messages = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+        client.var = {"name": "Ada", "unstorable": object()}
+        client.next_intent = "billing"
+        before.sessions["k"] = client
+        before.pending_agents["k"] = {"aia": "pending"}
+        await before.save("k")
+        await before.close()
+
+        # A new worker process: nothing in memory, restored lazily on first load.
+        after = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"), write_through=False)
+        await after.load("k")
+        return after.sessions["k"], after.pending_agents["k"], after.stats()
+
+    client, pending, stats = asyncio.run(main())
+    assert client.chat_messages == [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    assert client.var == {"name": "Ada"}
+    assert client.next_intent == "billing"
+    assert pending == {"aia": "pending"}
+    assert stats["restored"] == 1
+    # The token is never stored; agent data only because the snapshot is encrypted.
+    assert "token" not in restored_from[0]
+    assert restored_from[0]["raw_session_data"] == {"agent": "data"}
+
+def test_encrypted_snapshot_needs_key(monkeypatch):
+    monkeypatch.setenv("SESSION_STORE_KEY", "test-key")
+    cipher = snapshot_cipher_from_env()
+    data = encode_state({"revision": 1, "state": {"secret": "value"}}, cipher)
+    assert b"value" not in data
+    assert decode_state(data, cipher) == {"revision": 1, "state": {"secret": "value"}}
+    with pytest.raises(ValueError):
+        decode_state(data)
+
+def test_live_agent_relay_survives_state_from_other_workers(tmp_path, fake_client):
+    async def main():
+        delivered = []
+
+        async def deliver(key, message):
+            delivered.append(message["content"])
+
+        backend = SQLiteSessionBackend(str(tmp_path / "sessions.db"))
+        worker1 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+        worker2 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+        bridge = LiveAgentBridge(deliver=deliver)
+
+        client = FakeLiveClient()
+        worker1.sessions["k"] = client
+        await worker1.save("k")
+        assert await bridge.start("k", client)
+
+        # Another worker's turn is loaded onto the bridged client...
+        other = fake_client()
+        worker2.sessions["k"] = other
+        await worker2.load("k")
+        other.chat_messages.append({"role": "user", "content": "via worker 2"})
+        await worker2.save("k")
+        await worker1.load("k")
+        client.receive("after load")
+
+        # ...or merged into it when both saved the same revision.
+        other.chat_messages.append({"role": "user", "content": "again via worker 2"})
+        await worker2.save("k")
+        client.chat_messages.append({"role": "user", "content": "via worker 1"})
+        await worker1.save("k")
+        client.receive("after merge")
+
+        # A client that replaced its list outright is re-hooked by start().
+        client.chat_messages = list(client.chat_messages)
+        assert await bridge.start("k", client)
+        client.receive("after replace")
+        await asyncio.sleep(0.01)
+        await backend.close()
+        return delivered, worker1.stats()
+
+    delivered, stats = asyncio.run(main())
+    assert delivered == ["after load", "after merge", "after replace"]
+    assert stats["conflicts"] == 1
+
+class RecordingClient:
+    """Stands in for AsyncPinionAIClient.create() and sync_session_from_server(), recording the calls."""
+    created = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._session_id = kwargs["session_id"]
+        self.chat_messages = []
+        self.var = {}
+        self.synced = False
+
+    @classmethod
+    async def create(cls, **kwargs):
+        client = cls(**kwargs)
+        cls.created.append(client)
+        return client
+
+    async def sync_session_from_server(self):
+        self.synced = True
+        return True
+
+    async def close(self):
+        pass
+
+def test_restore_joins_the_stored_session_with_env_credentials(monkeypatch):
+    monkeypatch.setattr(pinionai_store, "AsyncPinionAIClient", RecordingClient)
+    monkeypatch.setenv("client_id", "client-1")
+    monkeypatch.setenv("client_secret", "secret")
+    state = {
+        "agent_id": "agent-1", "host_url": "https://example.invalid", "client_id": "client-1", "version": None,
+        "session_id": "session-1", "chat_messages": [{"role": "user", "content": "hi"}], "var": {"a": 1}, "attrs": {},
+    }
+    client = asyncio.run(pinionai_store.client_from_state(state))
+    assert client.kwargs["client_secret"] == "secret"
+    assert client.kwargs["session_id"] == "session-1"
+    # Session data is what stops create() from starting a new session; without stored data it is synced.
+    assert client.kwargs["raw_session_data"]
+    assert client.synced is True
+    assert client.chat_messages == [{"role": "user", "content": "hi"}]
+
+def test_unsupported_pinionai_release_is_refused(tmp_path, monkeypatch):
+    monkeypatch.setattr(pinionai_store.importlib.metadata, "version", lambda name: "0.5.0")
+    with pytest.raises(PinionAIConfigurationError):
+        SharedConversations(FileSessionBackend(str(tmp_path)), SessionStore("sessions"), SessionStore("pending"))
+
+def test_conversation_that_cannot_be_restored_is_reported(tmp_path, fake_client, monkeypatch):
+    monkeypatch.delenv("client_id", raising=False)
+
+    async def main():
+        backend = SQLiteSessionBackend(str(tmp_path / "sessions.db"))
+        worker1 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+        worker2 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+        client = fake_client()
+        pinionai_agents._aia_sources[client] = {"file_stream": "aia_v1_key_now_", "key_secret": None}
+        worker1.sessions["k"] = client
+        await worker1.save("k")
+
+        # Unencrypted, so only the session record was stored, and worker2 can't authenticate it.
+        await worker2.load("k")
+        lost = worker2.pop_lost("k"), worker2.pop_lost("k")
+        record = await backend.load("session", "k")
+        await backend.close()
+        return lost, record, "k" in worker2.sessions, worker2.stats()
+
+    (reason, again), record, kept, stats = asyncio.run(main())
+    assert reason and again is None
+    assert record is None and not kept
+    assert stats["lost"] == 1
+
+def test_aia_conversation_reloads_its_file_when_the_token_is_rejected(tmp_path, fake_client, monkeypatch):
+    monkeypatch.setenv("SESSION_STORE_KEY", "test-key")
+    loaded = []
+
+    class RejectedTokenClient(fake_client):
+        async def get_latest_session_modification_time(self):
+            raise RuntimeError("401 Unauthorized")
+
+    async def join(state, token=None):
+        assert token == "token"
+        return RejectedTokenClient(state["session_id"])
+
+    class Files:
+        async def create_client(self, file_stream, host_url, key_secret=None):
+            loaded.append((file_stream, key_secret))
+            client = fake_client("session-2")
+            client._raw_session_data = {"agent": "new session"}
+            pinionai_agents._aia_sources[client] = {"file_stream": file_stream, "key_secret": key_secret}
+            return client, "ok"
+
+    monkeypatch.setattr(pinionai_store, "client_from_state", join)
+    monkeypatch.setattr(pinionai_store, "get_agent_file_cache", Files)
+
+    async def main():
+        backend = SQLiteSessionBackend(str(tmp_path / "sessions.db"))
+        backend.cipher = snapshot_cipher_from_env()
+        worker1 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+        worker2 = SharedConversations(backend, SessionStore("sessions"), SessionStore("pending"))
+        client = fake_client()
+        client.chat_messages.append({"role": "user", "content": "hi"})
+        pinionai_agents._aia_sources[client] = {"file_stream": "aia_v1_key_now_payload", "key_secret": "secret"}
+        worker1.sessions["k"] = client
+        await worker1.save("k")
+
+        await worker2.load("k")
+        restored = worker2.sessions["k"]
+        await worker2.save("k")
+        aia = await backend.load("aia", "k")
+        await backend.close()
+        return restored, aia, worker2.pop_lost("k")
+
+    restored, aia, lost = asyncio.run(main())
+    assert loaded == [("aia_v1_key_now_payload", "secret")]
+    assert restored.session_id == "session-2"
+    assert restored.chat_messages == [{"role": "user", "content": "hi"}]
+    assert restored._raw_session_data == {"agent": "new session"}
+    assert aia["session_id"] == "session-2"
+    assert lost is None